@@ -1,91 +1,179 @@
 """
-    複数日のdount-*.csvファイルからドメインごとのクエリ数の平均と分散を計算
+    複数日のcount-*.csvファイルからドメインごとのクエリ数の平均と分散を計算
+
+    対象日は従来の -y -m -d パターン、または --start-date / --end-date の日付範囲で指定する。
+    -w は複数指定でき、1 回の実行で権威・リゾルバをまとめて集計する。
+    対象ファイルは一括で読み込み、(where, domain) の groupby で平均・分散を求める
+    （ファイルに出現しない日は従来どおり 0 として扱う）。
+
+    --state-dir を指定すると集計状態 (n, mean, m2) を保存し、
+    次回同じ期間を実行したときは未集計の日のファイルだけを読み込んで状態を更新する。
+    集計済みの日のファイルが変わっていれば（サイズ・更新時刻で判定）状態を作り直す。
+
+    例:
+        python3 count-ave-distr.py -y 2025 -m 04 -d '\\d{2}' -w 1
+        python3 count-ave-distr.py --start-date 2025-04-01 --end-date 2025-06-30 -w 0 1 \\
+            --state-dir /home/shimada/analysis/output-2025/ave-distr/state
 """
 
 import argparse
 import csv
 import glob
 import os
-import pandas as pd
 import re
-import statistics
-
-def FindFile(year, month, day, where):
-    dir_path = "/home/shimada/analysis/output-2025/"
-    pattern = re.compile(fr"count-{where}-{year}-{month}-{day}\.csv")
-    files = sorted(glob.glob(os.path.join(dir_path, "*.csv")))
-
-    found_file_list = [file for file in files if pattern.search(os.path.basename(file))]
-    print("Found files:", found_file_list)
-
-    if not found_file_list:
-        print("No CSV files found.")
-        return []
-    return found_file_list
-
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-y', help="year", required=True)
-    parser.add_argument('-m', help="month", required=True)
-    parser.add_argument('-d', help="day", required=True)
-    parser.add_argument('-w', help="where")
-
-    args = parser.parse_args()
-
-    year = args.y.zfill(4)
-    month = args.m.zfill(2)
-    day = args.d.zfill(2)
-    where = args.w
+from datetime import datetime, timedelta
 
-    file_list = FindFile(year, month, day, where)
-    if not file_list:
-        exit()
-
-    total_dict = dict()
-    all_domains = set()
-
-    # すべてのCSVファイルを読み込み、全ドメインを収集
-    for file in file_list:
-        df = pd.read_csv(file)
-        all_domains.update(df['domain'].unique())
-
-    # 各ドメインの値をリストに初期化
-    for dom in all_domains:
-        total_dict[dom] = []
-
-    # CSVファイルごとに値をリストに追加（存在しない場合は0を追加）
-    for file in file_list:
-        df = pd.read_csv(file)
-        domain_to_value = dict(zip(df['domain'], df['count']))
-
-        for dom in all_domains:
-            if dom in domain_to_value:
-                total_dict[dom].append(float(domain_to_value[dom]))
-            else:
-                total_dict[dom].append(0.0)
-
-    # 平均値を計算
-    average_dict = {dom: statistics.mean(vals) for dom, vals in total_dict.items()}
-    average_dict = dict(sorted(average_dict.items(), key=lambda item: item[1], reverse=True))
+import pandas as pd
 
-    # 分散を計算
-    distribution_dict = {dom: statistics.pvariance(vals) for dom, vals in total_dict.items()}
-    distribution_dict = dict(sorted(distribution_dict.items(), key=lambda item: item[1], reverse=True))
+import func
+from runstats import running_stats, merge_running_stats, finalize_running_stats, \
+    input_fingerprint, load_state, save_state  # func が src/ を sys.path に追加する
+import warehouse
+
+COUNT_DIR = "/home/shimada/analysis/output-2025/"
+OUTPUT_DIR = "/home/shimada/analysis/output-2025/ave-distr/"
+
+def file_prefix(where, packet_type=None):
+    """count-{where}- または count-{packet_type}-{where}- （write_csv の新フォーマット）"""
+    return f"count-{packet_type}-{where}-" if packet_type else f"count-{where}-"
+
+def FindFile(year, month, day, where, packet_type=None, dir_path=COUNT_DIR):
+    """パターンに一致する count ファイルを探す。戻り値: [(date_str, path), ...]"""
+    prefix = file_prefix(where, packet_type)
+    pattern = re.compile(fr"{re.escape(prefix)}({year}-{month}-{day})\.csv")
+    files = sorted(glob.glob(os.path.join(dir_path, f"{prefix}*.csv")))
+
+    found = []
+    for file in files:
+        m = pattern.fullmatch(os.path.basename(file))
+        if m:
+            found.append((m.group(1), file))
+    print(f"Found files (where={where}): {len(found)}")
+    return found
+
+def FindFileRange(start_date, end_date, where, packet_type=None, dir_path=COUNT_DIR):
+    """日付範囲の count ファイルをディレクトリ走査なしで列挙する"""
+    prefix = file_prefix(where, packet_type)
+    start_dt = datetime.strptime(start_date, "%Y-%m-%d")
+    end_dt = datetime.strptime(end_date, "%Y-%m-%d")
+
+    found, missing = [], 0
+    cur = start_dt
+    while cur <= end_dt:
+        date_str = cur.strftime("%Y-%m-%d")
+        path = os.path.join(dir_path, f"{prefix}{date_str}.csv")
+        if os.path.exists(path):
+            found.append((date_str, path))
+        else:
+            missing += 1
+        cur += timedelta(days=1)
+    print(f"Found files (where={where}): {len(found)}, missing: {missing}")
+    return found
+
+def load_counts(entries):
+    """(date_str, path) のリストを一括で読み込み columns=[date, domain, count] にする"""
+    frames = []
+    for date_str, path in entries:
+        try:
+            df = pd.read_csv(path, usecols=['domain', 'count'])
+        except Exception as e:
+            print(f"読み込み失敗: {path}: {e}")
+            continue
+        frames.append(df.assign(date=date_str))
+    if not frames:
+        return pd.DataFrame(columns=['date', 'domain', 'count'])
+    out = pd.concat(frames, ignore_index=True)
+    out['count'] = pd.to_numeric(out['count'], errors='coerce').astype(float)
+    out = out.dropna(subset=['domain', 'count'])
+    # 同じ日に同じドメインが複数行ある場合は合算してから日次値とする
+    return out.groupby(['date', 'domain'], as_index=False)['count'].sum()
+
+# ===== 出力 =====
+
+def write_outputs(stats, where, label, packet_type=None, output_dir=OUTPUT_DIR):
+    # ウェアハウスには期間の統計量として追記する（key に mean / pvariance、time_range に期間のラベル）
+    warehouse.append('count_stats',
+                     [(d, k, v) for k in ('mean', 'pvariance') for d, v in zip(stats['domain'], stats[k])],
+                     where=where, date=label.split('_to_')[0], time_range=label, packet_type=packet_type)
+    if not warehouse.csv_enabled():
+        return
+    os.makedirs(output_dir, exist_ok=True)
+    name = f"{packet_type}-{where}-{label}" if packet_type else f"{where}-{label}"
 
     # 平均値のCSV出力
-    output_csv = f"/home/shimada/analysis/output-2025/ave-distr/ave-{where}-{year}-{month}-{day}.csv"
+    output_csv = os.path.join(output_dir, f"ave-{name}.csv")
     with open(output_csv, "w", newline='') as f:
         writer = csv.writer(f, delimiter=',')
         writer.writerow(['domain', 'average'])
-        for domain, average in average_dict.items():
+        for domain, average in stats.sort_values('mean', ascending=False)[['domain', 'mean']].itertuples(index=False):
             writer.writerow([domain, average])
 
     # 分散値のCSV出力
-    output_csv = f"/home/shimada/analysis/output-2025/ave-distr/distr-{where}-{year}-{month}-{day}.csv"
+    output_csv = os.path.join(output_dir, f"distr-{name}.csv")
     with open(output_csv, "w", newline='') as f:
         writer = csv.writer(f, delimiter=',')
         writer.writerow(['domain', 'distribution'])
-        for domain, distribution in distribution_dict.items():
+        for domain, distribution in stats.sort_values('pvariance', ascending=False)[['domain', 'pvariance']].itertuples(index=False):
             writer.writerow([domain, distribution])
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-y', help="year (パターンモード)")
+    parser.add_argument('-m', help="month (パターンモード)")
+    parser.add_argument('-d', help="day (パターンモード)")
+    parser.add_argument('--start-date', help="開始日 YYYY-MM-DD (範囲モード)")
+    parser.add_argument('--end-date', help="終了日 YYYY-MM-DD (範囲モード)")
+    parser.add_argument('-w', nargs='+', required=True, help="where（複数指定可: -w 0 1）")
+    parser.add_argument('--packet-type', choices=['query', 'response'],
+                        help="count-{packet_type}-{where}-*.csv（run_analysis_v2.py の出力）を対象にする")
+    parser.add_argument('--input-dir', default=COUNT_DIR, help="count ファイルのディレクトリ")
+    parser.add_argument('--output-dir', default=OUTPUT_DIR, help="出力ディレクトリ")
+    parser.add_argument('--state-dir', help="集計状態の保存先（指定時は未集計の日だけを読み込む）")
+
+    args = parser.parse_args()
+
+    range_mode = bool(args.start_date and args.end_date)
+    if not range_mode and not all([args.y, args.m, args.d]):
+        parser.error("-y -m -d か --start-date --end-date のどちらかを指定してください")
+
+    if range_mode:
+        label = f"{args.start_date}_to_{args.end_date}"
+    else:
+        year = args.y.zfill(4)
+        month = args.m.zfill(2)
+        day = args.d.zfill(2)
+        label = f"{year}-{month}-{day}"
+
+    for where in args.w:
+        if range_mode:
+            entries = FindFileRange(args.start_date, args.end_date, where, args.packet_type, args.input_dir)
+        else:
+            entries = FindFile(year, month, day, where, args.packet_type, args.input_dir)
+        if not entries:
+            print(f"No CSV files found (where={where}).")
+            continue
+
+        state_name = f"{file_prefix(where, args.packet_type)}{label}"
+        state, _, done_days = (None, None, {})
+        if args.state_dir:
+            state, _, done_days = load_state(args.state_dir, state_name, entries, ['domain'])
+        new_entries = [(d, p) for d, p in entries if d not in done_days]
+        print(f"where={where}: 新規 {len(new_entries)}日 / 集計済み {len(done_days)}日")
+
+        counts = load_counts(new_entries)
+        if not counts.empty:
+            state = merge_running_stats(state, running_stats(counts, ['domain'], 'count'), ['domain'])
+        if state is None or state.empty:
+            print(f"No data (where={where}).")
+            continue
+
+        days = {**done_days, **{d: input_fingerprint(p) for d, p in new_entries}}
+        if args.state_dir:
+            save_state(args.state_dir, state_name, state, days)
+
+        # 出現しなかった日は 0 として平均・分散を計算
+        stats = finalize_running_stats(state, total_n=len(days))
+        write_outputs(stats, where, label, args.packet_type, args.output_dir)
+        print(f"where={where}: {len(stats)}ドメイン, {len(days)}日")
+
     print("Output files generated successfully.")
@@ -7,6 +7,14 @@ import statistics
 import argparse
 import io
 import ipaddress
+import sys
+
+import numpy as np
+
+# src/ 直下の共通モジュール（warehouse.py）を読み込めるようにする
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import memo
+import warehouse
 
 
 def file_lst(year, month, day, where):
@@ -39,7 +47,11 @@ def count_query(df, domain_dict, packet_type="query"):
         domain_dict[dom] = domain_dict.get(dom, 0) + c
 
 def write_csv(dic, year, month, day, where, packet_type="query"):
-    """新フォーマット対応: パケットタイプ情報を含むCSV出力"""
+    """新フォーマット対応: パケットタイプ情報を含むCSV出力（ウェアハウスにも追記）"""
+    dic = list(dic)
+    warehouse.append('count', dic, where=where, date=f"{year}-{month}-{day}", packet_type=packet_type)
+    if not warehouse.csv_enabled():
+        return
     csv_file_path = f"/home/shimada/analysis/output-2025/count-{packet_type}-{where}-{year}-{month}-{day}.csv"
     with open(csv_file_path, "w", newline='') as f:
         writer = csv.writer(f, delimiter=',')
@@ -167,6 +179,11 @@ def open_reader_safe(year, month, day, hour, where):
         print(f"ファイル {file_path} の読み込み中にエラーが発生しました: {str(e)}")
         return pd.DataFrame()
 
+# ===== クライアントキー =====
+# ip.dst（IPv4）と ipv6.dst（IPv6）のどちらか存在する方から作る 17 バイトのキー。
+# 実体は src/netclass.py（magnitude_engine / rollup と同じコード化）。ここからも import できるように残す。
+from netclass import client_keys
+
 def extract_subdomain(qname):
     suffix = '.tsukuba.ac.jp'
     if isinstance(qname, str):
@@ -182,6 +199,76 @@ def extract_subdomain(qname):
                 return subdom
     return None
 
+def qtype_ratio_path(where, date_str):
+    return f"/home/shimada/analysis/output-2025/qtype/qtype-response-{where}-{date_str}.csv"
+
+def qtype_ratio_day(date_str, daily_hours, where):
+    """1 日分の (サブドメイン, qtype) ごとの件数と比率を集計して書き出す"""
+    current_year = date_str[:4]
+    current_month = date_str[5:7]
+    current_day = date_str[8:10]
+
+    daily_subdomain_qtype_counts = {}
+
+    for hour_str in daily_hours:
+        print(f"処理中: {date_str} {hour_str}:00")
+        
+        df = open_reader_safe(current_year, current_month, current_day, hour_str, where)
+        if df.empty:
+            continue
+
+        # サブドメイン抽出
+        df['subdom'] = df['dns.qry.name'].apply(lambda x: extract_subdomain(x) if pd.notnull(x) else None)
+        
+        # dns.qry.type と subdom の両方が null でない行のみをフィルタリング
+        df_sub_filtered = df[df['subdom'].notnull() & df['dns.qry.type'].notnull()].copy()
+        
+        if df_sub_filtered.empty:
+            print(f"  有効なデータなし: {date_str} {hour_str}")
+            continue
+        
+        # 文字列として正規化
+        df_sub_filtered['subdom'] = df_sub_filtered['subdom'].astype(str).str.strip()
+        df_sub_filtered['dns.qry.type'] = df_sub_filtered['dns.qry.type'].astype(str).str.strip()
+        
+        # サブドメインとqtypeでグループ化し、カウント
+        subdomain_qtype_counts_hourly = df_sub_filtered.groupby(['subdom', 'dns.qry.type']).size().reset_index(name='count')
+        
+        # 時間ごとの集計結果を日ごとの集計辞書に累積加算
+        for _, row in subdomain_qtype_counts_hourly.iterrows():
+            subdom = row['subdom']
+            qtype = row['dns.qry.type']
+            count = row['count']
+            
+            if subdom not in daily_subdomain_qtype_counts:
+                daily_subdomain_qtype_counts[subdom] = {}
+            daily_subdomain_qtype_counts[subdom][qtype] = daily_subdomain_qtype_counts[subdom].get(qtype, 0) + count
+    
+    # 日ごとの結果をウェアハウスに追記し、CSVファイルに書き出し
+    warehouse.append('qtype', [(subdom, qtype, count) for subdom, qtype_counts in daily_subdomain_qtype_counts.items()
+                               for qtype, count in qtype_counts.items()],
+                     where=where, date=date_str, packet_type='response')
+    if not warehouse.csv_enabled():
+        return
+    output_csv_path = qtype_ratio_path(where, date_str)
+    os.makedirs(os.path.dirname(output_csv_path), exist_ok=True)
+    
+    with open(output_csv_path, "w", newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['date', 'subdomain', 'qtype', 'count', 'ratio'])
+        
+        for subdom, qtype_counts in daily_subdomain_qtype_counts.items():
+            total_queries_for_subdom = sum(qtype_counts.values())
+            
+            sorted_qtypes = sorted(qtype_counts.keys())
+            
+            for qtype in sorted_qtypes:
+                count = qtype_counts[qtype]
+                ratio = count / total_queries_for_subdom if total_queries_for_subdom > 0 else 0
+                writer.writerow([date_str, subdom, qtype, count, f"{ratio:.4f}"])
+    
+    print(f"Qtype ratio analysis (response) for {date_str} completed and saved to {output_csv_path}")
+
 def qtype_ratio(year_pattern, month_pattern, day_pattern, where):
     """
     応答パケット専用版: Qtype比率分析
@@ -195,12 +282,6 @@ def qtype_ratio(year_pattern, month_pattern, day_pattern, where):
     unique_dates = sorted(list(set([os.path.basename(f)[:10] for f in all_files])))
 
     for date_str in unique_dates:
-        current_year = date_str[:4]
-        current_month = date_str[5:7]
-        current_day = date_str[8:10]
-
-        daily_subdomain_qtype_counts = {}
-
         # この日付に該当するファイルのみを抽出
         daily_files = [f for f in all_files if os.path.basename(f).startswith(date_str)]
         daily_hours = sorted(list(set([os.path.basename(f)[11:13] for f in daily_files])))
@@ -209,60 +290,10 @@ def qtype_ratio(year_pattern, month_pattern, day_pattern, where):
             print(f"No hourly data found for {date_str}. Skipping this date.")
             continue
 
-        for hour_str in daily_hours:
-            print(f"処理中: {date_str} {hour_str}:00")
-            
-            df, _ = open_reader_safe(current_year, current_month, current_day, hour_str, where)
-            if df.empty:
-                continue
-
-            # サブドメイン抽出
-            df['subdom'] = df['dns.qry.name'].apply(lambda x: extract_subdomain(x) if pd.notnull(x) else None)
-            
-            # dns.qry.type と subdom の両方が null でない行のみをフィルタリング
-            df_sub_filtered = df[df['subdom'].notnull() & df['dns.qry.type'].notnull()].copy()
-            
-            if df_sub_filtered.empty:
-                print(f"  有効なデータなし: {date_str} {hour_str}")
-                continue
-            
-            # 文字列として正規化
-            df_sub_filtered['subdom'] = df_sub_filtered['subdom'].astype(str).str.strip()
-            df_sub_filtered['dns.qry.type'] = df_sub_filtered['dns.qry.type'].astype(str).str.strip()
-            
-            # サブドメインとqtypeでグループ化し、カウント
-            subdomain_qtype_counts_hourly = df_sub_filtered.groupby(['subdom', 'dns.qry.type']).size().reset_index(name='count')
-            
-            # 時間ごとの集計結果を日ごとの集計辞書に累積加算
-            for _, row in subdomain_qtype_counts_hourly.iterrows():
-                subdom = row['subdom']
-                qtype = row['dns.qry.type']
-                count = row['count']
-                
-                if subdom not in daily_subdomain_qtype_counts:
-                    daily_subdomain_qtype_counts[subdom] = {}
-                daily_subdomain_qtype_counts[subdom][qtype] = daily_subdomain_qtype_counts[subdom].get(qtype, 0) + count
-        
-        # 日ごとの結果をCSVファイルに書き出し
-        output_dir = "/home/shimada/analysis/output-2025/qtype/"
-        os.makedirs(output_dir, exist_ok=True)
-        output_csv_path = os.path.join(output_dir, f"qtype-response-{where}-{date_str}.csv")
-        
-        with open(output_csv_path, "w", newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(['date', 'subdomain', 'qtype', 'count', 'ratio'])
-            
-            for subdom, qtype_counts in daily_subdomain_qtype_counts.items():
-                total_queries_for_subdom = sum(qtype_counts.values())
-                
-                sorted_qtypes = sorted(qtype_counts.keys())
-                
-                for qtype in sorted_qtypes:
-                    count = qtype_counts[qtype]
-                    ratio = count / total_queries_for_subdom if total_queries_for_subdom > 0 else 0
-                    writer.writerow([date_str, subdom, qtype, count, f"{ratio:.4f}"])
-        
-        print(f"Qtype ratio analysis (response) for {date_str} completed and saved to {output_csv_path}")
+        # 入力ファイル・コードが前回と同じ日は計算せずにキャッシュの CSV を使う
+        memo.run_cached("qtype_ratio", date_str, daily_files, {"where": where}, [__file__],
+                        [qtype_ratio_path(where, date_str)],
+                        lambda: qtype_ratio_day(date_str, daily_hours, where))
 
 def qtype_ratio_total(year_pattern, month_pattern, day_pattern, where):
     """
@@ -297,7 +328,7 @@ def qtype_ratio_total(year_pattern, month_pattern, day_pattern, where):
         for hour_str in daily_hours:
             print(f"処理中: {date_str} {hour_str}:00")
             
-            df, _ = open_reader_safe(current_year, current_month, current_day, hour_str, where)
+            df = open_reader_safe(current_year, current_month, current_day, hour_str, where)
             if df.empty:
                 continue
             
@@ -395,7 +426,7 @@ def qtype_ratio_total_by_date_range(start_date, end_date, where):
         
         for hour_str in daily_hours:
             print(f"処理中: {date_str} {hour_str}:00")
-            df, _ = open_reader_safe(year, month, day, hour_str, where)
+            df = open_reader_safe(year, month, day, hour_str, where)
             if df.empty:
                 continue
             
@@ -480,4 +511,169 @@ def count_ip_in_subnet(file_name, subnet):
                         pass
         return count
     except ValueError as e:
-        return f"Error {e}"
\ No newline at end of file
+        return f"Error {e}"
+
+# ===== 逐次更新できる平均・分散の集計状態 =====
+# 実体は src/runstats.py（magnitude-ave-distr.py などと共通）。ここからも import できるように残す。
+from runstats import RUNNING_STATS_COLUMNS, running_stats, merge_running_stats, finalize_running_stats
+
+# ===== クエリ・応答の一括分類 =====
+# クエリ+レスポンス形式の CSV（dns.flags.response, dns.flags.rcode 列あり）の各行を 1 回だけ
+# query / response（rcode=0）/ response_error（rcode≠0）に分類し、DataFrame をコピーせずに
+# 行番号のマスクでカウント・qtype・マグニチュードの集計へ渡す。
+PACKET_CLASSES = ['query', 'response', 'response_error']
+# パケット種別ごとのクライアント（問い合わせは送信元、応答は送信先）
+CLIENT_COLUMNS = {'query': 'ip.src', 'response': 'ip.dst', 'response_error': 'ip.dst'}
+
+def classify_packets(df):
+    """
+    各行のパケット種別コード (0=query, 1=response, 2=response_error) を返す。
+    filter_query_response_data と同じく、response 欠損は問い合わせ、応答の rcode 欠損はエラー扱い。
+    """
+    is_resp = df['dns.flags.response'].isin(['1', 'True', 'true']).to_numpy()
+    if 'dns.flags.rcode' in df.columns:
+        is_error = (df['dns.flags.rcode'].fillna('1') != '0').to_numpy()
+    else:
+        is_error = np.zeros(len(df), dtype=bool)
+    return np.where(is_resp, np.where(is_error, 2, 1), 0).astype(np.int8)
+
+def subdomain_codes(qnames):
+    """qname 列をサブドメインの整数コードに変換（抽出はユニークな qname に対してのみ、対象外は -1）"""
+    qname_codes, qname_uniques = pd.factorize(qnames)
+    sub_of_qname, subdomains = pd.factorize(pd.Series(qname_uniques, dtype=object).map(extract_subdomain))
+    return np.append(sub_of_qname, -1)[qname_codes], np.asarray(subdomains, dtype=object)
+
+def new_split_counts():
+    """split_count_hour で加算していく日次の集計辞書"""
+    return {
+        'count': {cls: {} for cls in PACKET_CLASSES},        # {種別: {サブドメイン: 件数}}
+        'qtype': {cls: {} for cls in PACKET_CLASSES},        # {種別: {(サブドメイン, qtype): 件数}}
+        'rcode': {},                                         # {(サブドメイン, rcode): 件数}（応答のみ）
+        'clients': {cls: {} for cls in PACKET_CLASSES},      # {種別: {サブドメイン: クライアントの set}}
+        'all_clients': {cls: set() for cls in PACKET_CLASSES},
+    }
+
+def _add_pairs(target, first_codes, first_names, second_codes, second_names, n_second):
+    """(first, second) のコード組を数えて {(first名, second名): 件数} に加算"""
+    cells = np.bincount(first_codes * n_second + second_codes)
+    for cell in np.flatnonzero(cells):
+        key = (first_names[cell // n_second], second_names[cell % n_second])
+        target[key] = target.get(key, 0) + int(cells[cell])
+
+def split_count_hour(df, acc):
+    """
+    1 時間分のクエリ+レスポンス DataFrame を分類し、acc（new_split_counts()）へ加算する。
+    分類・サブドメイン抽出は 1 回だけで、種別ごとの集計は行マスクで行う。
+    """
+    classes = classify_packets(df)
+    sub_codes, subs = subdomain_codes(df['dns.qry.name'])
+    qtype_codes, qtypes = pd.factorize(df['dns.qry.type'].str.strip()) if 'dns.qry.type' in df.columns \
+        else (np.full(len(df), -1), [])
+    rcode_codes, rcodes = pd.factorize(df['dns.flags.rcode']) if 'dns.flags.rcode' in df.columns \
+        else (np.full(len(df), -1), [])
+    # クライアント列の factorize は列ごとに 1 回（response と response_error は同じ ip.dst）
+    client_factors = {}
+    for col in set(CLIENT_COLUMNS.values()):
+        if col in df.columns:
+            codes, uniques = pd.factorize(df[col])
+            client_factors[col] = (codes, np.asarray(uniques, dtype=object))
+    n_subs = len(subs)
+    valid = sub_codes >= 0
+
+    # 種別ごとのクエリ数
+    counts = np.bincount(classes[valid].astype(np.int64) * n_subs + sub_codes[valid],
+                         minlength=len(PACKET_CLASSES) * n_subs).reshape(len(PACKET_CLASSES), n_subs)
+    for c, cls in enumerate(PACKET_CLASSES):
+        target = acc['count'][cls]
+        for j in np.flatnonzero(counts[c]):
+            target[subs[j]] = target.get(subs[j], 0) + int(counts[c, j])
+
+    # 応答の rcode 別
+    mask = valid & (classes > 0) & (rcode_codes >= 0)
+    if mask.any():
+        _add_pairs(acc['rcode'], sub_codes[mask], subs, rcode_codes[mask], rcodes, len(rcodes))
+
+    for c, cls in enumerate(PACKET_CLASSES):
+        in_class = valid & (classes == c)
+        if not in_class.any():
+            continue
+
+        # qtype 別
+        mask = in_class & (qtype_codes >= 0)
+        if mask.any():
+            _add_pairs(acc['qtype'][cls], sub_codes[mask], subs, qtype_codes[mask], qtypes, len(qtypes))
+
+        # マグニチュード用のクライアント集合（サブドメイン抽出前の全行で A_tot を数える）
+        if CLIENT_COLUMNS[cls] not in client_factors:
+            continue
+        client_codes, clients = client_factors[CLIENT_COLUMNS[cls]]
+        acc['all_clients'][cls].update(clients[np.unique(client_codes[(classes == c) & (client_codes >= 0)])])
+        mask = in_class & (client_codes >= 0)
+        n_clients = max(len(clients), 1)
+        pairs = np.unique(sub_codes[mask].astype(np.int64) * n_clients + client_codes[mask])
+        pair_subs = pairs // n_clients
+        bounds = np.flatnonzero(np.diff(pair_subs)) + 1
+        for sub_pairs in np.split(pairs, bounds):
+            if len(sub_pairs) == 0:
+                continue
+            sub = subs[sub_pairs[0] // n_clients]
+            acc['clients'][cls].setdefault(sub, set()).update(clients[sub_pairs % n_clients])
+
+# split の出力は入力（クエリ+レスポンス CSV）が run_count_analysis / qtype_ratio と異なるため、
+# CSV は別ディレクトリ、ウェアハウスは別の metric に書いて互いに上書きしないようにする
+SPLIT_OUTPUT_DIR = "/home/shimada/analysis/output-2025/split/"
+SPLIT_METRICS = {'count': 'split_count', 'qtype': 'split_qtype', 'rcode': 'split_rcode', 'magnitude': 'split_magnitude'}
+
+def write_split_outputs(acc, year, month, day, where):
+    """split_count_hour の集計結果をウェアハウスに追記し、SPLIT_OUTPUT_DIR 以下のカウント・qtype・rcode・マグニチュードの各CSVに書き出す"""
+    date_str = f"{year}-{month}-{day}"
+
+    magnitudes = {}
+    for cls in PACKET_CLASSES:
+        A_tot = len(acc['all_clients'][cls])
+        magnitudes[cls] = {}
+        if A_tot > 1:
+            for subdom, client_set in acc['clients'][cls].items():
+                magnitudes[cls][subdom] = 10 * np.log(len(client_set)) / np.log(A_tot)
+
+    for cls in PACKET_CLASSES:
+        warehouse.append(SPLIT_METRICS['count'], acc['count'][cls].items(), where=where, date=date_str, packet_type=cls)
+        warehouse.append(SPLIT_METRICS['qtype'], [(s, q, c) for (s, q), c in acc['qtype'][cls].items()],
+                         where=where, date=date_str, packet_type=cls)
+        warehouse.append(SPLIT_METRICS['magnitude'], magnitudes[cls].items(), where=where, date=date_str, packet_type=cls)
+    warehouse.append(SPLIT_METRICS['rcode'], [(s, r, c) for (s, r), c in acc['rcode'].items()],
+                     where=where, date=date_str, packet_type='response')
+    if not warehouse.csv_enabled():
+        return
+
+    os.makedirs(SPLIT_OUTPUT_DIR, exist_ok=True)
+    for cls in PACKET_CLASSES:
+        sorted_domains = sorted(acc['count'][cls].items(), key=lambda x: x[1], reverse=True)
+        with open(os.path.join(SPLIT_OUTPUT_DIR, f"count-{cls}-{where}-{date_str}.csv"), "w", newline='') as f:
+            writer = csv.writer(f, delimiter=',')
+            writer.writerow(['day', 'packet_type', 'domain', 'count'])
+            for subdom, c in sorted_domains:
+                writer.writerow([f"{day}", cls, subdom, c])
+
+        per_sub = {}
+        for (subdom, qtype), count in acc['qtype'][cls].items():
+            per_sub.setdefault(subdom, {})[qtype] = count
+        with open(os.path.join(SPLIT_OUTPUT_DIR, f"qtype-{cls}-{where}-{date_str}.csv"), "w", newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['date', 'subdomain', 'qtype', 'count', 'ratio'])
+            for subdom, qtype_counts in per_sub.items():
+                total = sum(qtype_counts.values())
+                for qtype in sorted(qtype_counts.keys()):
+                    writer.writerow([date_str, subdom, qtype, qtype_counts[qtype], f"{qtype_counts[qtype] / total:.4f}"])
+
+        with open(os.path.join(SPLIT_OUTPUT_DIR, f"magnitude-{cls}-{where}-{date_str}.csv"), "w", newline='') as f:
+            writer = csv.writer(f, delimiter=',')
+            writer.writerow(['day', 'domain', 'dnsmagnitude'])
+            for subdom, magnitude in sorted(magnitudes[cls].items(), key=lambda x: x[1], reverse=True):
+                writer.writerow([f"{day}", subdom, str(magnitude)])
+
+    with open(os.path.join(SPLIT_OUTPUT_DIR, f"rcode-{where}-{date_str}.csv"), "w", newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['date', 'subdomain', 'rcode', 'count'])
+        for (subdom, rcode), count in sorted(acc['rcode'].items()):
+            writer.writerow([date_str, subdom, rcode, count])
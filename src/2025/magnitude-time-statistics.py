@@ -28,6 +28,8 @@ dnsmagnitude-time.pyで生成された時間範囲指定のDNS Magnitudeデー
     --time-range: 時間範囲 (例: 08-18)
     --input-dir: 入力ディレクトリ (デフォルト: /home/shimada/analysis/output-time/)
     --output-dir: 出力ディレクトリ (デフォルト: /home/shimada/analysis/output-time/statistics/)
+    --state-dir: 集計状態の保存先。指定すると次回は未集計の日のファイルだけを読み込む
+                 （magnitude-ave-distr.py と同じ runstats.py の集計状態）
 
 例:
     # 2025年4月の権威サーバー(8-18時)の統計を計算
@@ -41,11 +43,16 @@ import pandas as pd
 import glob
 import os
 import csv
-from collections import defaultdict
-import statistics
 from datetime import datetime, timedelta
 import argparse
 import re
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import warehouse
+from runstats import magnitude_statistics
+
+STAT_KEYS = ['mean', 'variance', 'std_dev', 'median', 'min', 'max', 'q25', 'q75', 'count']
 
 def parse_time_magnitude_filename(filename, where, time_range):
     """
@@ -61,12 +68,19 @@ def parse_time_magnitude_filename(filename, where, time_range):
         return f"{year}-{month}-{day}"
     return None
 
+def append_statistics(subdomain_statistics, where, date, time_range, period):
+    """統計量をウェアハウスに追記する（key に統計量の名前、time_range に '時間範囲/期間'）"""
+    warehouse.append('magnitude_stats',
+                     [(subdomain, key, stats[key]) for subdomain, stats in subdomain_statistics.items()
+                      for key in STAT_KEYS],
+                     where=where, date=date, time_range=f"{time_range}/{period}")
+
 def get_server_type_label(where):
     """サーバータイプのラベルを取得"""
     return "権威サーバー" if where == 0 else "リゾルバ"
 
 def calculate_time_magnitude_statistics_range(start_date, end_date, where, time_range, 
-                                              input_dir, output_dir):
+                                              input_dir, output_dir, state_dir=None):
     """
     指定した日付範囲の時間範囲別Magnitudeファイルから統計情報を計算
     
@@ -77,16 +91,14 @@ def calculate_time_magnitude_statistics_range(start_date, end_date, where, time_
         time_range: 時間範囲 (例: "08-18")
         input_dir: Magnitudeファイルが格納されているディレクトリ
         output_dir: 結果を出力するディレクトリ
+        state_dir: 集計状態の保存先（指定時は未集計の日だけを読み込む）
     """
     
     # 日付文字列をdatetimeオブジェクトに変換
     start_dt = datetime.strptime(start_date, "%Y-%m-%d")
     end_dt = datetime.strptime(end_date, "%Y-%m-%d")
     
-    # サブドメインごとのMagnitude値を格納
-    subdomain_magnitudes = defaultdict(list)
-    
-    processed_files = []
+    entries = []
     missing_files = []
     
     server_type = get_server_type_label(where)
@@ -97,117 +109,64 @@ def calculate_time_magnitude_statistics_range(start_date, end_date, where, time_
     print(f"入力ディレクトリ: {input_dir}")
     print(f"サーバータイプ: {server_type} (where={where})")
     
-    # 日付範囲内の各日を処理
+    # 日付範囲内の各日のファイル (形式: {where}-YYYY-MM-DD-HH-HH.csv)
     current_dt = start_dt
     while current_dt <= end_dt:
         date_str = current_dt.strftime("%Y-%m-%d")
-        
-        # ファイルパスを構築 (形式: {where}-YYYY-MM-DD-HH-HH.csv)
         csv_file_path = os.path.join(input_dir, f"{where}-{date_str}-{time_range}.csv")
-        
-        if not os.path.exists(csv_file_path):
+        if os.path.exists(csv_file_path):
+            entries.append((date_str, csv_file_path))
+        else:
             missing_files.append(csv_file_path)
-            current_dt += timedelta(days=1)
-            continue
-        
-        try:
-            # CSVファイルを読み込み
-            df = pd.read_csv(csv_file_path)
-            processed_files.append(csv_file_path)
-            
-            print(f"処理中: {os.path.basename(csv_file_path)} (レコード数: {len(df)})")
-            
-            # 各行を処理してサブドメインごとのMagnitude値を記録
-            for _, row in df.iterrows():
-                # カラム名の確認と取得
-                if 'domain' in df.columns:
-                    subdomain = str(row['domain']).strip()
-                elif 'subdomain' in df.columns:
-                    subdomain = str(row['subdomain']).strip()
-                else:
-                    print(f"警告: サブドメイン列が見つかりません")
-                    continue
-                
-                # magnitudeカラムの確認
-                if 'dnsmagnitude' in df.columns:
-                    magnitude = float(row['dnsmagnitude'])
-                elif 'magnitude' in df.columns:
-                    magnitude = float(row['magnitude'])
-                else:
-                    print(f"警告: magnitude列が見つかりません")
-                    continue
-                
-                subdomain_magnitudes[subdomain].append(magnitude)
-        
-        except Exception as e:
-            print(f"エラー: {csv_file_path} の処理中 - {str(e)}")
-        
         current_dt += timedelta(days=1)
     
-    print(f"\n処理完了: {len(processed_files)}ファイル")
+    period_str = f"{start_date}_to_{end_date}"
+    subdomain_statistics, processed_days = magnitude_statistics(
+        entries, state_dir, f"magnitude-time-statistics-{where}-{time_range}-{period_str}")
+    
+    print(f"\n処理完了: {processed_days}ファイル")
     if missing_files:
         print(f"欠落ファイル: {len(missing_files)}個")
         if len(missing_files) <= 5:
             for f in missing_files:
                 print(f"  - {os.path.basename(f)}")
     
-    if not subdomain_magnitudes:
+    if not subdomain_statistics:
         print("処理するデータが見つかりませんでした")
         return
     
-    # 統計情報を計算
-    subdomain_statistics = {}
-    
-    for subdomain, magnitudes in subdomain_magnitudes.items():
-        if len(magnitudes) == 0:
-            continue
-        
-        # 統計値を計算
-        stats = {
-            'mean': statistics.mean(magnitudes),
-            'variance': statistics.variance(magnitudes) if len(magnitudes) > 1 else 0.0,
-            'std_dev': statistics.stdev(magnitudes) if len(magnitudes) > 1 else 0.0,
-            'median': statistics.median(magnitudes),
-            'min': min(magnitudes),
-            'max': max(magnitudes),
-            'count': len(magnitudes),
-            'q25': pd.Series(magnitudes).quantile(0.25),
-            'q75': pd.Series(magnitudes).quantile(0.75)
-        }
-        
-        subdomain_statistics[subdomain] = stats
-    
     # 結果を出力ディレクトリに保存
     os.makedirs(output_dir, exist_ok=True)
-    period_str = f"{start_date}_to_{end_date}"
     output_csv_path = os.path.join(output_dir, 
                                    f"magnitude-time-statistics-{where}-{time_range}-{period_str}.csv")
     
-    with open(output_csv_path, "w", newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow([
-            'server_type', 'time_range', 'period', 'subdomain', 'mean', 'variance', 
-            'std_dev', 'median', 'min', 'max', 'q25', 'q75', 'data_points'
-        ])
-        
-        # 平均値の降順でソート
-        for subdomain, stats in sorted(subdomain_statistics.items(), 
-                                      key=lambda x: x[1]['mean'], reverse=True):
+    append_statistics(subdomain_statistics, where, start_date, time_range, period_str)
+    if warehouse.csv_enabled():
+        with open(output_csv_path, "w", newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
             writer.writerow([
-                where,
-                time_range,
-                period_str,
-                subdomain,
-                f"{stats['mean']:.6f}",
-                f"{stats['variance']:.6f}",
-                f"{stats['std_dev']:.6f}",
-                f"{stats['median']:.6f}",
-                f"{stats['min']:.6f}",
-                f"{stats['max']:.6f}",
-                f"{stats['q25']:.6f}",
-                f"{stats['q75']:.6f}",
-                stats['count']
+                'server_type', 'time_range', 'period', 'subdomain', 'mean', 'variance', 
+                'std_dev', 'median', 'min', 'max', 'q25', 'q75', 'data_points'
             ])
+        
+            # 平均値の降順でソート
+            for subdomain, stats in sorted(subdomain_statistics.items(), 
+                                          key=lambda x: x[1]['mean'], reverse=True):
+                writer.writerow([
+                    where,
+                    time_range,
+                    period_str,
+                    subdomain,
+                    f"{stats['mean']:.6f}",
+                    f"{stats['variance']:.6f}",
+                    f"{stats['std_dev']:.6f}",
+                    f"{stats['median']:.6f}",
+                    f"{stats['min']:.6f}",
+                    f"{stats['max']:.6f}",
+                    f"{stats['q25']:.6f}",
+                    f"{stats['q75']:.6f}",
+                    stats['count']
+                ])
     
     print(f"\n=== 統計結果サマリー ===")
     print(f"サーバータイプ: {server_type}")
@@ -236,7 +195,7 @@ def calculate_time_magnitude_statistics_range(start_date, end_date, where, time_
               f"{stats['std_dev']:<10.4f} {stats['mean']:<10.4f}")
 
 def calculate_time_magnitude_statistics_pattern(year_pattern, month_pattern, day_pattern, 
-                                               where, time_range, input_dir, output_dir):
+                                               where, time_range, input_dir, output_dir, state_dir=None):
     """
     パターンマッチングによってファイルを選択し、統計情報を計算
     
@@ -248,6 +207,7 @@ def calculate_time_magnitude_statistics_pattern(year_pattern, month_pattern, day
         time_range: 時間範囲 (例: "08-18")
         input_dir: Magnitudeファイルが格納されているディレクトリ
         output_dir: 結果を出力するディレクトリ
+        state_dir: 集計状態の保存先（指定時は未集計の日だけを読み込む）
     """
     
     # ファイルパターンを構築
@@ -269,100 +229,49 @@ def calculate_time_magnitude_statistics_pattern(year_pattern, month_pattern, day
     print(f"パターン: {where}-{year_pattern}-{month_pattern}-{day_pattern}-{time_range}")
     print(f"一致ファイル数: {len(matching_files)}")
     
-    # サブドメインごとのMagnitude値を格納
-    subdomain_magnitudes = defaultdict(list)
-    processed_files = []
-    
-    for csv_file_path in matching_files:
-        try:
-            # CSVファイルを読み込み
-            df = pd.read_csv(csv_file_path)
-            processed_files.append(csv_file_path)
-            
-            # ファイル名から日付を取得
-            date_str = parse_time_magnitude_filename(csv_file_path, where, time_range)
-            print(f"処理中: {os.path.basename(csv_file_path)} (レコード数: {len(df)})")
-            
-            # 各行を処理
-            for _, row in df.iterrows():
-                # カラム名の確認と取得
-                if 'domain' in df.columns:
-                    subdomain = str(row['domain']).strip()
-                elif 'subdomain' in df.columns:
-                    subdomain = str(row['subdomain']).strip()
-                else:
-                    continue
-                
-                # magnitudeカラムの確認
-                if 'dnsmagnitude' in df.columns:
-                    magnitude = float(row['dnsmagnitude'])
-                elif 'magnitude' in df.columns:
-                    magnitude = float(row['magnitude'])
-                else:
-                    continue
-                
-                subdomain_magnitudes[subdomain].append(magnitude)
-        
-        except Exception as e:
-            print(f"エラー: {csv_file_path} の処理中 - {str(e)}")
+    entries = [(parse_time_magnitude_filename(path, where, time_range) or os.path.basename(path), path)
+               for path in matching_files]
+    pattern_str = f"{year_pattern}-{month_pattern}-{day_pattern}"
+    subdomain_statistics, processed_days = magnitude_statistics(
+        entries, state_dir, f"magnitude-time-statistics-{where}-{time_range}-{pattern_str}")
     
-    print(f"\n処理完了: {len(processed_files)}ファイル")
+    print(f"\n処理完了: {processed_days}ファイル")
     
-    if not subdomain_magnitudes:
+    if not subdomain_statistics:
         print("処理するデータが見つかりませんでした")
         return
     
-    # 統計情報を計算
-    subdomain_statistics = {}
-    
-    for subdomain, magnitudes in subdomain_magnitudes.items():
-        if len(magnitudes) == 0:
-            continue
-        
-        stats = {
-            'mean': statistics.mean(magnitudes),
-            'variance': statistics.variance(magnitudes) if len(magnitudes) > 1 else 0.0,
-            'std_dev': statistics.stdev(magnitudes) if len(magnitudes) > 1 else 0.0,
-            'median': statistics.median(magnitudes),
-            'min': min(magnitudes),
-            'max': max(magnitudes),
-            'count': len(magnitudes),
-            'q25': pd.Series(magnitudes).quantile(0.25),
-            'q75': pd.Series(magnitudes).quantile(0.75)
-        }
-        
-        subdomain_statistics[subdomain] = stats
-    
     # 結果を保存
     os.makedirs(output_dir, exist_ok=True)
-    pattern_str = f"{year_pattern}-{month_pattern}-{day_pattern}"
     output_csv_path = os.path.join(output_dir, 
                                    f"magnitude-time-statistics-{where}-{time_range}-{pattern_str}.csv")
     
-    with open(output_csv_path, "w", newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow([
-            'server_type', 'time_range', 'pattern', 'subdomain', 'mean', 'variance', 
-            'std_dev', 'median', 'min', 'max', 'q25', 'q75', 'data_points'
-        ])
-        
-        for subdomain, stats in sorted(subdomain_statistics.items(), 
-                                      key=lambda x: x[1]['mean'], reverse=True):
+    append_statistics(subdomain_statistics, where, pattern_str, time_range, pattern_str)
+    if warehouse.csv_enabled():
+        with open(output_csv_path, "w", newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
             writer.writerow([
-                where,
-                time_range,
-                pattern_str,
-                subdomain,
-                f"{stats['mean']:.6f}",
-                f"{stats['variance']:.6f}",
-                f"{stats['std_dev']:.6f}",
-                f"{stats['median']:.6f}",
-                f"{stats['min']:.6f}",
-                f"{stats['max']:.6f}",
-                f"{stats['q25']:.6f}",
-                f"{stats['q75']:.6f}",
-                stats['count']
+                'server_type', 'time_range', 'pattern', 'subdomain', 'mean', 'variance', 
+                'std_dev', 'median', 'min', 'max', 'q25', 'q75', 'data_points'
             ])
+        
+            for subdomain, stats in sorted(subdomain_statistics.items(), 
+                                          key=lambda x: x[1]['mean'], reverse=True):
+                writer.writerow([
+                    where,
+                    time_range,
+                    pattern_str,
+                    subdomain,
+                    f"{stats['mean']:.6f}",
+                    f"{stats['variance']:.6f}",
+                    f"{stats['std_dev']:.6f}",
+                    f"{stats['median']:.6f}",
+                    f"{stats['min']:.6f}",
+                    f"{stats['max']:.6f}",
+                    f"{stats['q25']:.6f}",
+                    f"{stats['q75']:.6f}",
+                    stats['count']
+                ])
     
     print(f"\n統計結果を保存: {output_csv_path}")
     print(f"サーバータイプ: {server_type}")
@@ -410,6 +319,8 @@ def main():
     parser.add_argument('--output-dir', 
                        default='/home/shimada/analysis/output-time/statistics/',
                        help='統計結果を出力するディレクトリ')
+    parser.add_argument('--state-dir',
+                       help='集計状態の保存先（指定時は未集計の日だけを読み込む）')
     
     args = parser.parse_args()
     
@@ -421,7 +332,7 @@ def main():
         
         calculate_time_magnitude_statistics_range(
             args.start_date, args.end_date, args.w, args.time_range,
-            args.input_dir, args.output_dir
+            args.input_dir, args.output_dir, args.state_dir
         )
     
     elif args.mode == 'pattern':
@@ -432,7 +343,7 @@ def main():
         
         calculate_time_magnitude_statistics_pattern(
             args.y, args.m, args.d, args.w, args.time_range,
-            args.input_dir, args.output_dir
+            args.input_dir, args.output_dir, args.state_dir
         )
     
     return 0
@@ -2,38 +2,17 @@
     時間指定をして、サブドメインごとのDNSクエリ数を集計する
     クエリのパーセンテージも出力
 """
-import re
-import pandas as pd
 import os
-import glob
 import csv
-import math
-import operator
 import argparse
-import io
 
 import func
-
-# サブドメインを抽出する関数
-def extract_subdomain(qname):
-    suffix = '.tsukuba.ac.jp'
-    if isinstance(qname, str):
-        qname_lower = qname.lower()
-        # dns.qry.name に tsukuba.ac.jp が 1 回だけ出現する場合のみ処理する
-        if qname_lower.count(suffix) != 1:
-            return None
-        if qname_lower.endswith(suffix):
-            # サフィックスを取り除く
-            qname_no_suffix = qname_lower[:-len(suffix)]
-            if qname_no_suffix.endswith('.'):
-                qname_no_suffix = qname_no_suffix[:-1]
-            if qname_no_suffix:
-                # ドットで分割し、最後の要素を取得
-                subdomain = qname_no_suffix.split('.')[-1]
-                return subdomain
-    return None
+import rollup  # func が src/ を sys.path に追加する
+import warehouse
+from magnitude_engine import hourly_files
 
 # サブドメイン別のクエリ数を集計
+# 生 CSV は rollup.py の時間の集計に変わった時間だけ取り込み、範囲内の時間の集計から数える
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='サブドメイン別クエリ数を集計')
@@ -46,6 +25,8 @@ if __name__ == "__main__":
                         help='開始時刻(0-23、デフォルト: 0)')
     parser.add_argument('--end-hour', type=int, default=23, 
                         help='終了時刻(0-23、デフォルト: 23)')
+    parser.add_argument('--input-dir', help='入力ディレクトリ（省略時は where から決定）')
+    parser.add_argument('--rollup-dir', default=rollup.ROLLUP_DIR, help=f'ロールアップの保存先（デフォルト: {rollup.ROLLUP_DIR}）')
     args = parser.parse_args()
 
     year = args.y
@@ -67,65 +48,23 @@ if __name__ == "__main__":
     
     print(f"時間範囲: {start_hour:02d}:00 - {end_hour:02d}:59")
 
-    # パターンにあうファイルの時間をリストへ
-    r = func.file_lst(year, month, day, where)
-    time_lst = func.file_time(r)
-    
-    # keyに日にち、値に時間
-    file_dict = {}
-
-    # 日にちごとに時間リストへ入れる（時間範囲でフィルタリング）
-    for time in time_lst:
-        month = time[4:6]
-        day = time[6:8]
-        hour = time[8:10]
-        hour_int = int(hour)
-        
-        # 指定された時間範囲内の時間のみを追加
-        if start_hour <= hour_int <= end_hour:
-            if day not in file_dict.keys():
-                file_dict[day] = []
-            file_dict[day].append(hour)
+    # パターンにあうファイルの日付をリストへ
+    dates = sorted(set(os.path.basename(f)[:10] for f in hourly_files(year, month, day, where, args.input_dir)))
 
     # 総エラー行数のカウントとエラー行の保存
     total_error_lines = []
     file_error_counts = {}
 
-    for day in file_dict.keys():
-        # クエリ数を集計する辞書
-        domain_query_count = {}
-        total_queries = 0  # 総クエリ数
-
-        # 1時間ごとにファイルにアクセス
-        for hour in file_dict[day]:
-            print(month + day + hour)
-            # データフレームを読み込む
-            input_file_name = f"{year}-{month}-{day}-{hour}.csv"
-            df = func.open_reader_safe(year, month, day, hour, where)
-            
-            # 空のデータフレームならスキップ
-            if df.empty:
-                print(f"空のデータフレーム: {input_file_name} - スキップします")
-                continue
-
-            # 'dns.qry.name' からサブドメインを抽出して新しい列を追加
-            df['subdomain'] = df['dns.qry.name'].apply(extract_subdomain)
-
-            # サブドメインが存在する行のみを抽出（extract_subdomain が None を返した行はスキップ）
-            df_sub = df[df['subdomain'].notnull()]
-            
-            # この時間のサブドメイン別クエリ数を集計
-            hour_query_count = df_sub['subdomain'].value_counts().to_dict()
-
-            # 総クエリ数に加算
-            total_queries += len(df_sub)
+    for date_str in dates:
+        print(date_str)
+        year, month, day = date_str.split('-')
+        # 変わった時間だけを時間の集計に取り込み、範囲内の時間の集計をマージして数える
+        rollup.build(where, date_str, date_str, args.input_dir, args.rollup_dir, upper=False)
+        agg = rollup.read_hours(where, date_str, start_hour, end_hour, args.rollup_dir)
+        domain_query_count = {s: int(c) for s, c in zip(agg['subdomains'], agg['counts']) if c > 0}
 
-            # 日ごとの集計に追加
-            for subdomain, count in hour_query_count.items():
-                if subdomain in domain_query_count:
-                    domain_query_count[subdomain] += count
-                else:
-                    domain_query_count[subdomain] = count
+        # 総クエリ数（サブドメインが抽出できた行の数）
+        total_queries = sum(domain_query_count.values())
 
         # クエリ数の降順でソート
         sorted_domain_count = dict(sorted(domain_query_count.items(), 
@@ -136,14 +75,17 @@ if __name__ == "__main__":
         time_range_str = f"{start_hour:02d}-{end_hour:02d}"
         csv_file_path = f"/home/shimada/analysis/output-time/count-{where}-{year}-{month}-{day}-{time_range_str}.csv"
         
-        with open(csv_file_path, "w", newline='') as f:
-            writer = csv.writer(f, delimiter=',')
-            writer.writerow(['day', 'time_range', 'subdomain', 'query_count', 'percentage'])
-            
-            for subdomain, count in sorted_domain_count.items():
-                # パーセンテージを計算
-                percentage = (count / total_queries * 100) if total_queries > 0 else 0
-                writer.writerow([f"{day}", time_range_str, subdomain, count, f"{percentage:.2f}"])
+        warehouse.append('count', sorted_domain_count.items(), where=where, date=f"{year}-{month}-{day}",
+                         time_range=time_range_str)
+        if warehouse.csv_enabled():
+            with open(csv_file_path, "w", newline='') as f:
+                writer = csv.writer(f, delimiter=',')
+                writer.writerow(['day', 'time_range', 'subdomain', 'query_count', 'percentage'])
+                
+                for subdomain, count in sorted_domain_count.items():
+                    # パーセンテージを計算
+                    percentage = (count / total_queries * 100) if total_queries > 0 else 0
+                    writer.writerow([f"{day}", time_range_str, subdomain, count, f"{percentage:.2f}"])
         
         print(f"\n=== 集計結果 ===")
         print(f"日付: {year}-{month}-{day}")
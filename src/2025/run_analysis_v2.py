@@ -9,7 +9,10 @@
     python3 run_analysis_v2.py <analysis_type> <year> <month> <day> <where> [packet_type]
 
 引数:
-    analysis_type: count, qtype, qtype_total のいずれか
+    analysis_type: count, qtype, qtype_total, split のいずれか
+                   split はクエリ+レスポンス CSV（/mnt/qnap2/shimada/resolver-q-r/）を 1 回だけ読み、
+                   query / response / response_error のカウント・qtype・rcode・マグニチュードをまとめて出力する
+                   （packet_type は不要）
     year: 年（4桁）
     month: 月（2桁、例: 04）
     day: 日（2桁、例: 01）
@@ -25,16 +28,28 @@
     
     # 問い合わせパケットの期間Qtype分析
     python3 run_analysis_v2.py qtype_total 2025 04 * 1 query
+
+    # クエリ・応答を 1 回の読み込みで分類して全集計
+    python3 run_analysis_v2.py split 2025 04 01 1
 """
 
 import sys
 import os
+import re
+import glob
+
+import pandas as pd
+
 from func import (
     file_lst, file_time, count_query, write_csv, 
     qtype_ratio, qtype_ratio_total,
-    open_reader_safe
+    open_reader_safe,
+    new_split_counts, split_count_hour, write_split_outputs
 )
 
+QUERY_RESPONSE_DIR = "/mnt/qnap2/shimada/resolver-q-r/"
+SPLIT_COLUMNS = ['ip.src', 'ip.dst', 'dns.qry.name', 'dns.qry.type', 'dns.flags.response', 'dns.flags.rcode']
+
 def run_count_analysis(year, month, day, where, packet_type="query"):
     """カウント分析実行"""
     files = file_lst(year, month, day, where)
@@ -65,6 +80,33 @@ def run_count_analysis(year, month, day, where, packet_type="query"):
     print(f"カウント分析完了: {len(domain_dict)}ドメイン")
     print(f"総クエリ数: {sum(domain_dict.values()):,}")
 
+def run_split_analysis(year, month, day, where, input_dir=QUERY_RESPONSE_DIR):
+    """クエリ+レスポンス CSV を 1 時間ずつ 1 回だけ読み、全パケット種別の集計をまとめて行う"""
+    pat = re.compile(rf"{year}-{month}-{day}-\d{{2}}\.csv")
+    files = [f for f in sorted(glob.glob(os.path.join(input_dir, "*.csv"))) if pat.match(os.path.basename(f))]
+    if not files:
+        print(f"対象ファイルが見つかりません: {year}-{month}-{day}")
+        return
+    
+    dates = sorted(set(os.path.basename(f)[:10] for f in files))
+    for date_str in dates:
+        acc = new_split_counts()
+        for file_path in [f for f in files if os.path.basename(f).startswith(date_str)]:
+            print(f"処理中: {os.path.basename(file_path)}")
+            try:
+                df = pd.read_csv(file_path, dtype=str, usecols=lambda c: c in SPLIT_COLUMNS)
+            except Exception as e:
+                print(f"ファイル {file_path} の読み込み中にエラーが発生しました: {str(e)}")
+                continue
+            if df.empty:
+                continue
+            split_count_hour(df, acc)
+        
+        d_year, d_month, d_day = date_str.split('-')
+        write_split_outputs(acc, d_year, d_month, d_day, where)
+        for cls, counts in acc['count'].items():
+            print(f"{date_str} {cls}: {sum(counts.values()):,}件, {len(counts)}ドメイン")
+
 def main():
     if len(sys.argv) < 6:
         print(__doc__)
@@ -77,6 +119,11 @@ def main():
     where = sys.argv[5]
     packet_type = sys.argv[6] if len(sys.argv) > 6 else "query"
     
+    if analysis_type == "split":
+        print(f"=== クエリ・応答の一括分類 ({year}-{month}-{day}) ===")
+        run_split_analysis(year, month, day, where)
+        return
+    
     # パケットタイプ検証
     if packet_type not in ["query", "response"]:
         print("パケットタイプは 'query' または 'response' を指定してください")
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+サブドメイン別 Magnitude / クエリ数 の逐次（ストリーミング）異常検知。
+
+新しい 1 期間（1日 または 時間範囲）の結果 CSV が出力されるたびに呼び出し、
+サブドメインごとの EWMA 平均・EWMA 分散を更新しながら z スコアを計算する。
+状態は CSV に保存するため、1 回の更新コストは O(サブドメイン数) で、過去の履歴は再読込しない。
+
+入力ファイル（どちらか一方でも可）:
+- Magnitude: {where}-YYYY-MM-DD.csv（列: day,domain,dnsmagnitude）
+             または {where}-YYYY-MM-DD-HH-HH.csv（dnsmagnitude-time.py の出力）
+- クエリ数:  count-{where}-YYYY-MM-DD.csv（列: day,domain,count）
+             または count-{where}-YYYY-MM-DD-HH-HH.csv（query-count.py の出力、列: query_count）
+  ※ クエリ数は裾が重いため log1p(count) に対して EWMA をかける
+
+出力（--state-dir 配下）:
+- anomaly_state_{where}.csv … 状態（metric, subdomain, mean, var, n, last_period）
+- anomalies_{where}.csv     … 検知結果を追記（period, metric, subdomain, value, expected, std, zscore, direction）
+
+実行例:
+    python3 anomaly_stream.py -w 1 --period 2025-04-02 \
+        --mag-file /home/shimada/analysis/output/1-2025-04-02.csv \
+        --count-file /home/shimada/analysis/output-2025/count-1-2025-04-02.csv \
+        --state-dir /home/shimada/analysis/anomaly
+"""
+
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+STATE_COLUMNS = ["metric", "subdomain", "mean", "var", "n", "last_period"]
+ANOMALY_COLUMNS = ["period", "metric", "subdomain", "value", "expected", "std", "zscore", "direction"]
+
+# ==== 入力 ====
+
+def read_period_values(path: str, metric: str) -> pd.DataFrame:
+    """
+    1 期間分の CSV を読み、columns=[subdomain, value] を返す。
+    列名の揺れ（domain/subdomain, dnsmagnitude/magnitude, count/query_count）を吸収する。
+    """
+    df = pd.read_csv(path)
+    sd_col = "subdomain" if "subdomain" in df.columns else "domain"
+    if metric == "magnitude":
+        candidates = ["dnsmagnitude", "magnitude"]
+    else:
+        candidates = ["count", "query_count"]
+    val_col = next((c for c in candidates if c in df.columns), None)
+    if sd_col not in df.columns or val_col is None:
+        raise ValueError(f"必要列がありません: {path}")
+
+    return period_values(df[sd_col], df[val_col], metric)
+
+
+def period_values(subdomains, values, metric: str) -> pd.DataFrame:
+    """サブドメインと値の列から columns=[subdomain, value] を作る（count は log1p をとる）"""
+    out = pd.DataFrame({
+        "subdomain": pd.Series(subdomains).astype(str).str.strip().str.lower().to_numpy(),
+        "value": pd.to_numeric(pd.Series(values), errors="coerce").to_numpy(),
+    }).dropna()
+    if metric == "count":
+        out = out.groupby("subdomain", as_index=False)["value"].sum()
+        out["value"] = np.log1p(out["value"])
+        return out
+    return out.groupby("subdomain", as_index=False)["value"].mean()
+
+# ==== 状態 ====
+
+def load_state(path: str) -> pd.DataFrame:
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=STATE_COLUMNS)
+    state = pd.read_csv(path, dtype={"subdomain": str, "last_period": str})
+    return state[STATE_COLUMNS]
+
+
+def save_state(state: pd.DataFrame, path: str):
+    """一時ファイルへ書いてから置き換える（更新途中で落ちても状態が壊れないように）"""
+    tmp_path = path + ".tmp"
+    state.to_csv(tmp_path, index=False, float_format="%.10g")
+    os.replace(tmp_path, path)
+
+
+def update_metric(state: pd.DataFrame, values: pd.DataFrame, metric: str, period: str,
+                  alpha: float, threshold: float, warmup: int):
+    """
+    1 指標分の EWMA 状態を更新し、(新しい状態, 異常テーブル) を返す。
+    z スコアは更新前の状態（＝過去のみから予測した値）に対して計算する。
+    今期に出現しなかったサブドメインの状態は変更しない。
+    """
+    prev = state[state["metric"] == metric].drop(columns="metric")
+    merged = values.merge(prev, on="subdomain", how="left")
+
+    last = merged["last_period"]
+    if (last.notna() & (last.astype(str) >= period)).any():
+        print(f"[WARN] {metric}: period={period} は処理済みのためスキップ")
+        return state[state["metric"] == metric], pd.DataFrame(columns=ANOMALY_COLUMNS)
+
+    x = merged["value"].to_numpy(dtype=np.float64)
+    seen = merged["n"].notna().to_numpy()
+    mean = np.where(seen, merged["mean"].to_numpy(dtype=np.float64), x)
+    var = np.where(seen, merged["var"].to_numpy(dtype=np.float64), 0.0)
+    n = np.where(seen, merged["n"].fillna(0).to_numpy(dtype=np.int64), 0)
+
+    std = np.sqrt(var)
+    diff = x - mean
+    with np.errstate(invalid="ignore", divide="ignore"):
+        z = np.where(std > 0, diff / std, 0.0)
+
+    is_anomaly = (n >= warmup) & (np.abs(z) >= threshold)
+    anomalies = pd.DataFrame({
+        "period": period,
+        "metric": metric,
+        "subdomain": merged["subdomain"].to_numpy(),
+        "value": np.expm1(x) if metric == "count" else x,
+        "expected": np.expm1(mean) if metric == "count" else mean,
+        "std": std,
+        "zscore": z,
+        "direction": np.where(diff >= 0, "up", "down"),
+    })[is_anomaly]
+
+    # EWMA 更新（West の指数重み付き分散）
+    new_mean = mean + alpha * diff
+    new_var = (1.0 - alpha) * (var + alpha * diff * diff)
+    updated = pd.DataFrame({
+        "metric": metric,
+        "subdomain": merged["subdomain"].to_numpy(),
+        "mean": new_mean,
+        "var": new_var,
+        "n": n + 1,
+        "last_period": period,
+    })
+
+    untouched = prev[~prev["subdomain"].isin(updated["subdomain"])].assign(metric=metric)
+    new_state = pd.concat([untouched[STATE_COLUMNS], updated], ignore_index=True)
+    return new_state, anomalies.sort_values("zscore", key=np.abs, ascending=False)
+
+
+def append_anomalies(anomalies: pd.DataFrame, path: str):
+    if anomalies.empty:
+        return
+    write_header = not os.path.exists(path)
+    anomalies[ANOMALY_COLUMNS].to_csv(path, mode="a", header=write_header, index=False, float_format="%.6f")
+
+
+def update_period(state_dir, where, period, values, alpha=0.1, threshold=3.0, warmup=7):
+    """
+    1 期間分の値（{指標: read_period_values の形 または None}）で状態を更新し、異常を追記する。
+    戻り値: (異常テーブル, 状態のパス, 検知結果のパス)
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    state_path = os.path.join(state_dir, f"anomaly_state_{where}.csv")
+    anomaly_path = os.path.join(state_dir, f"anomalies_{where}.csv")
+
+    state = load_state(state_path)
+    new_states = [state[~state["metric"].isin(["magnitude", "count"])]]
+    found = []
+
+    for metric in ("magnitude", "count"):
+        if values.get(metric) is None:
+            new_states.append(state[state["metric"] == metric])
+            continue
+        metric_state, anomalies = update_metric(state, values[metric], metric, period,
+                                                alpha, threshold, warmup)
+        new_states.append(metric_state)
+        found.append(anomalies)
+        print(f"[INFO] {metric}: {len(values[metric])}サブドメイン更新, 異常 {len(anomalies)}件")
+
+    save_state(pd.concat(new_states, ignore_index=True)[STATE_COLUMNS], state_path)
+    anomalies = pd.concat(found, ignore_index=True) if found else pd.DataFrame(columns=ANOMALY_COLUMNS)
+    append_anomalies(anomalies, anomaly_path)
+    return anomalies, state_path, anomaly_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="サブドメイン別 Magnitude / クエリ数 の逐次異常検知（EWMA）")
+    parser.add_argument("-w", type=int, required=True, choices=[0, 1], help="0=権威, 1=リゾルバ")
+    parser.add_argument("--period", required=True,
+                        help="今回の期間ラベル（例: 2025-04-02 や 2025-04-02T08-18）。辞書順で単調増加させること")
+    parser.add_argument("--mag-file", help="今回期間の Magnitude CSV")
+    parser.add_argument("--count-file", help="今回期間のクエリ数 CSV")
+    parser.add_argument("--state-dir", default="/home/shimada/analysis/anomaly", help="状態と検知結果の保存先")
+    parser.add_argument("--alpha", type=float, default=0.1, help="EWMA の平滑化係数（デフォルト: 0.1）")
+    parser.add_argument("--threshold", type=float, default=3.0, help="異常とみなす |z| の閾値（デフォルト: 3.0）")
+    parser.add_argument("--warmup", type=int, default=7, help="判定を始めるまでの観測回数（デフォルト: 7）")
+    args = parser.parse_args()
+
+    if not args.mag_file and not args.count_file:
+        print("エラー: --mag-file か --count-file のどちらかを指定してください")
+        return 1
+
+    values = {metric: read_period_values(path, metric) if path else None
+              for metric, path in (("magnitude", args.mag_file), ("count", args.count_file))}
+    anomalies, state_path, anomaly_path = update_period(args.state_dir, args.w, args.period, values,
+                                                        args.alpha, args.threshold, args.warmup)
+
+    for _, r in anomalies.head(10).iterrows():
+        print(f"  [{r['metric']}] {r['subdomain']:<20} value={r['value']:.4f} "
+              f"expected={r['expected']:.4f} z={r['zscore']:+.2f}")
+    print(f"[DONE] 状態: {state_path}, 異常: {anomaly_path}")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
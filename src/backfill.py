@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+期間のバックフィル（再開可能・並列）
+
+日付範囲を (where, 日) のタスクに展開し、プロセスプールで --jobs 個ずつ並列に実行する。
+  - 新しい日から順に実行する（最近のデータが先に揃う）
+  - タスクが終わるたびにチェックポイント（CSV: where,date,seconds,finished）を一時ファイル + os.replace で書き換える
+  - 同じチェックポイントで再実行すると、終わっているタスクは飛ばす（中断・異常終了からの再開）
+  - 失敗したタスクはチェックポイントに載せないので、次回の実行でもう一度試す
+  - --memory-budget を指定すると、合計が上限に収まるよう並列数を減らし、上限を各タスクに分ける（membudget.py）
+
+タスクの中身は
+  - 既定: multi_analysis.run_day（--analyses の分析を 1 回の読み込みで実行）
+  - --command を指定した場合: そのコマンドを日ごとに実行する。{year} {month} {day} {date} {where} が置き換わる
+    出力は {チェックポイント}.logs/{where}-YYYY-MM-DD.log に保存する
+
+実行例:
+    # 2023 年の権威・リゾルバを 8 並列で（中断したら同じコマンドで再開）
+    python3 backfill.py -w 0 1 --start-date 2023-01-01 --end-date 2023-12-31 --jobs 8 --name 2023
+    # 既存スクリプトを日ごとに実行
+    python3 backfill.py -w 1 --start-date 2023-04-01 --end-date 2023-04-30 --jobs 4 \\
+        --command "python3 new-tshark-mag.py -y {year} -m {month} -d {day} -w {where}" --name tshark-mag-2023-04
+"""
+
+import os
+import time
+import shlex
+import argparse
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from membudget import parse_size, estimate_row_bytes, plan, format_size, report_peak_rss
+from multi_analysis import ANALYSES, COLUMNS, parse_window
+
+CHECKPOINT_DIR = "/home/shimada/analysis/backfill"
+
+# ==== チェックポイント ====
+
+def load_checkpoint(path):
+    """終わっているタスクの {(where, date): (秒数, 終了時刻)}"""
+    if not os.path.exists(path):
+        return {}
+    done = pd.read_csv(path, dtype={"date": str, "finished": str})
+    return {(int(w), d): (float(s), f) for w, d, s, f in zip(done["where"], done["date"], done["seconds"], done["finished"])}
+
+
+def save_checkpoint(path, done):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    rows = [(w, d, f"{s:.1f}", f) for (w, d), (s, f) in sorted(done.items())]
+    tmp_path = path + ".tmp"
+    pd.DataFrame(rows, columns=["where", "date", "seconds", "finished"]).to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+# ==== タスク ====
+
+def expand_tasks(wheres, start_date, end_date):
+    """(where, 日) のタスクを新しい日から順に並べる（同じ日は where 順）"""
+    dates = [d.strftime("%Y-%m-%d") for d in pd.date_range(start_date, end_date)]
+    return [(w, d) for d in reversed(dates) for w in wheres]
+
+
+def run_task(where, date_str, job):
+    """1 タスクを実行して所要秒数を返す（ワーカープロセスで実行される）"""
+    t0 = time.time()
+    if job["command"]:
+        year, month, day = date_str.split("-")
+        cmd = job["command"].format(year=year, month=month, day=day, date=date_str, where=where)
+        os.makedirs(job["log_dir"], exist_ok=True)
+        with open(os.path.join(job["log_dir"], f"{where}-{date_str}.log"), "w") as log:
+            subprocess.run(shlex.split(cmd), stdout=log, stderr=subprocess.STDOUT, check=True)
+    else:
+        from magnitude_engine import hourly_files
+        from multi_analysis import run_day
+        files = hourly_files(*date_str.split("-"), where, job["input_dir"])
+        if files:
+            run_day(files, where, date_str, job["analyses"], job["time_windows"], job["table"], job["packet_type"],
+                    job["budget"])
+        else:
+            print(f"対象ファイルが見つかりませんでした: {where} {date_str}")
+    return time.time() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='期間のバックフィル（(where, 日) ごとに並列実行、中断後は再開）')
+    parser.add_argument('-w', type=int, nargs='+', choices=[0, 1], required=True, help='0は権威1はリゾルバ（複数指定可）')
+    parser.add_argument('--start-date', required=True, help='開始日 YYYY-MM-DD')
+    parser.add_argument('--end-date', required=True, help='終了日 YYYY-MM-DD')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='同時に実行するタスク数（デフォルト: CPU 数）')
+    parser.add_argument('--name', default='backfill', help='チェックポイントの名前（ジョブごとに変える）')
+    parser.add_argument('--checkpoint', help=f'チェックポイントのパス（デフォルト: {CHECKPOINT_DIR}/{{name}}.csv）')
+    parser.add_argument('--command', help='日ごとに実行するコマンド（{year} {month} {day} {date} {where} を置換）')
+    parser.add_argument('--analyses', nargs='+', choices=ANALYSES, default=ANALYSES, help='multi_analysis で実行する分析')
+    parser.add_argument('--time-windows', nargs='+', type=parse_window, default=[(0, 23)], help='time 分析の時間帯')
+    parser.add_argument('--input-dir', help='入力ディレクトリ（省略時は where から決定）')
+    parser.add_argument('--prefix-table', help='network 分析のプレフィックス表')
+    parser.add_argument('--packet-type', default='response', help='count / qtype の出力に付ける種別')
+    parser.add_argument('--redo', action='store_true', help='チェックポイントを無視してすべて実行し直す')
+    parser.add_argument('--memory-budget', type=parse_size,
+                        help='全ワーカー合計のメモリ上限（例: 32G）。収まるよう並列数を減らし、各タスクに上限を分ける')
+    args = parser.parse_args()
+
+    checkpoint = args.checkpoint or os.path.join(CHECKPOINT_DIR, f"{args.name}.csv")
+    done = {} if args.redo else load_checkpoint(checkpoint)
+    tasks = [t for t in expand_tasks(args.w, args.start_date, args.end_date) if t not in done]
+    print(f"タスク: {len(tasks)}件（完了済み {len(done)}件）, 並列数: {args.jobs}")
+    if not tasks:
+        return 0
+
+    table = None
+    if not args.command and "network" in args.analyses:
+        from netclass import load_prefix_table
+        table = load_prefix_table(args.prefix_table)
+    jobs, budget = args.jobs, None
+    if args.memory_budget and not args.command:
+        from magnitude_engine import hourly_files
+        sample = next((f for w, d in tasks for f in hourly_files(*d.split("-"), w, args.input_dir)), None)
+        if sample:
+            _, jobs = plan(args.memory_budget, estimate_row_bytes(sample, COLUMNS), args.jobs)
+            budget = args.memory_budget // jobs
+            print(f"メモリ上限 {format_size(args.memory_budget)}: 並列数 {jobs}, タスクごとに {format_size(budget)}")
+    job = {
+        "command": args.command,
+        "log_dir": checkpoint + ".logs",
+        "analyses": args.analyses,
+        "time_windows": args.time_windows,
+        "input_dir": args.input_dir,
+        "table": table,
+        "packet_type": args.packet_type,
+        "budget": budget,
+    }
+
+    failed = []
+    t0 = time.time()
+    pool = ProcessPoolExecutor(max_workers=jobs)
+    try:
+        futures = {pool.submit(run_task, w, d, job): (w, d) for w, d in tasks}
+        for i, fut in enumerate(as_completed(futures), 1):
+            w, d = futures[fut]
+            try:
+                done[(w, d)] = (fut.result(), time.strftime("%Y-%m-%d %H:%M:%S"))
+            except Exception as e:
+                failed.append((w, d))
+                print(f"[WARN] 失敗: where={w} {d}: {e}")
+                continue
+            save_checkpoint(checkpoint, done)
+            print(f"[{i}/{len(tasks)}] where={w} {d}: {done[(w, d)][0]:.1f}秒")
+    except KeyboardInterrupt:
+        print("[WARN] 中断しました。同じコマンドで再実行すると続きから実行します")
+        pool.shutdown(wait=False, cancel_futures=True)
+        return 130
+    pool.shutdown()
+
+    print(f"[DONE] {len(tasks) - len(failed)}/{len(tasks)}件 ({time.time() - t0:.1f}秒) -> {checkpoint}")
+    report_peak_rss(budget)
+    if failed:
+        print(f"[WARN] 失敗 {len(failed)}件（再実行すると再度試します）: "
+              + ", ".join(f"{w}:{d}" for w, d in sorted(failed)))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+日次 DNS Magnitude の変化点検出（PELT）
+
+/home/shimada/analysis/output の {where}-YYYY-MM-DD.csv を期間分読み込み、
+サブドメインごとの日次系列に対して平均シフト（L2 コスト）の PELT を適用し、
+人気度が切り替わった日（サービス開始・移行など）を求める。
+PELT は枝刈りによりほぼ系列長に線形で動くため、1 年分でも毎晩再実行できる。
+サブドメイン単位でプロセスプールに分配して並列計算する。
+
+ペナルティは  beta * log(n)  （系列はノイズ幅 sigma で正規化済み）。
+sigma は 1 階差分の MAD から推定するので、レベルシフト自体には引きずられない。
+
+出力（--out-dir 配下）:
+- changepoints_{where}.csv … 変化点（列: subdomain,break_date,mean_before,mean_after,delta）
+- segments_{where}.csv     … 区間（列: subdomain,segment,start_date,end_date,n_days,mean,std）
+
+実行例:
+    python3 changepoint.py --mag-dir /home/shimada/analysis/output \
+        --start-date 2025-04-01 --end-date 2026-03-31 -w 1 --out-dir ./changepoints
+"""
+
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from visual import read_daily_magnitude_for_range
+
+# ==== PELT ====
+
+def pelt_mean_shift(y: np.ndarray, penalty: float, min_size: int = 3) -> list:
+    """
+    L2 コスト（区間平均からの二乗誤差）の PELT。
+    戻り値: 各区間の終端インデックス（最後は len(y)）。変化点なしなら [len(y)]
+    """
+    n = len(y)
+    if n < 2 * min_size:
+        return [n]
+
+    s1 = np.concatenate(([0.0], np.cumsum(y)))
+    s2 = np.concatenate(([0.0], np.cumsum(y * y)))
+
+    def cost(starts, end):
+        length = end - starts
+        seg_sum = s1[end] - s1[starts]
+        return (s2[end] - s2[starts]) - seg_sum * seg_sum / length
+
+    F = np.full(n + 1, np.inf)
+    F[0] = -penalty
+    last_cp = np.zeros(n + 1, dtype=np.int64)
+    candidates = np.array([0], dtype=np.int64)
+
+    for t in range(min_size, n + 1):
+        admissible = t - candidates >= min_size
+        usable = candidates[admissible]
+        total = F[usable] + cost(usable, t)
+        best = np.argmin(total)
+        F[t] = total[best] + penalty
+        last_cp[t] = usable[best]
+
+        # 枝刈り: 今後も最適になり得ない候補を捨てる（短すぎてまだ評価できない候補は残す）
+        keep = np.ones(len(candidates), dtype=bool)
+        keep[admissible] = total <= F[t]
+        candidates = np.append(candidates[keep], t)
+
+    ends = []
+    t = n
+    while t > 0:
+        ends.append(int(t))
+        t = last_cp[t]
+    return ends[::-1]
+
+
+def estimate_sigma(y: np.ndarray) -> float:
+    """1 階差分の MAD からノイズの標準偏差を推定（レベルシフトに頑健）"""
+    if len(y) < 3:
+        return 0.0
+    d = np.diff(y)
+    return float(1.4826 * np.median(np.abs(d - np.median(d))) / np.sqrt(2.0))
+
+
+def detect_series(args):
+    """
+    1 サブドメイン分の検出（プロセスプールから呼ばれる）
+    args = (subdomain, dates, values, beta, min_size)
+    戻り値: (segments のリスト, changepoints のリスト)
+    """
+    subdomain, dates, values, beta, min_size = args
+    mask = ~np.isnan(values)
+    dates, y = dates[mask], values[mask]
+    n = len(y)
+    if n == 0:
+        return [], []
+
+    sigma = estimate_sigma(y)
+    if sigma > 0:
+        ends = pelt_mean_shift(y / sigma, beta * np.log(max(n, 2)), min_size)
+    else:
+        ends = [n]
+
+    segments, changepoints = [], []
+    start = 0
+    for i, end in enumerate(ends):
+        seg = y[start:end]
+        segments.append((subdomain, i, dates[start], dates[end - 1], len(seg),
+                         float(seg.mean()), float(seg.std(ddof=1)) if len(seg) > 1 else 0.0))
+        start = end
+    for prev, cur in zip(segments[:-1], segments[1:]):
+        changepoints.append((subdomain, cur[2], prev[5], cur[5], cur[5] - prev[5]))
+    return segments, changepoints
+
+
+def detect_all(mat: pd.DataFrame, beta: float, min_size: int, workers=None):
+    """日付×サブドメイン の行列に対して全サブドメインを並列処理"""
+    dates = mat.index.to_numpy()
+    tasks = [(sd, dates, mat[sd].to_numpy(dtype=np.float64), beta, min_size) for sd in mat.columns]
+
+    segments, changepoints = [], []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for segs, cps in pool.map(detect_series, tasks, chunksize=max(1, len(tasks) // 64)):
+            segments.extend(segs)
+            changepoints.extend(cps)
+
+    seg_df = pd.DataFrame(segments, columns=["subdomain", "segment", "start_date", "end_date",
+                                             "n_days", "mean", "std"])
+    cp_df = pd.DataFrame(changepoints, columns=["subdomain", "break_date", "mean_before",
+                                                "mean_after", "delta"])
+    return seg_df, cp_df
+
+
+def main():
+    parser = argparse.ArgumentParser(description="日次DNS Magnitudeの変化点検出（PELT, サブドメイン並列）")
+    parser.add_argument("--mag-dir", default="/home/shimada/analysis/output", help="日次Magnitude CSVのディレクトリ")
+    parser.add_argument("--start-date", required=True, help="開始日 YYYY-MM-DD")
+    parser.add_argument("--end-date", required=True, help="終了日 YYYY-MM-DD")
+    parser.add_argument("-w", type=int, required=True, choices=[0, 1], help="0=権威, 1=リゾルバ")
+    parser.add_argument("--beta", type=float, default=3.0, help="ペナルティ係数（大きいほど変化点が減る。デフォルト: 3.0）")
+    parser.add_argument("--min-size", type=int, default=7, help="最小区間長（日、デフォルト: 7）")
+    parser.add_argument("--min-days", type=int, default=14, help="対象とする最小観測日数（デフォルト: 14）")
+    parser.add_argument("--workers", type=int, default=None, help="並列プロセス数")
+    parser.add_argument("--out-dir", default="./changepoints", help="出力先（デフォルト: ./changepoints）")
+    args = parser.parse_args()
+
+    mags = read_daily_magnitude_for_range(args.mag_dir, args.w, args.start_date, args.end_date)
+    if mags.empty:
+        print(f"[ERROR] 入力が空です（where={args.w}）")
+        return 1
+
+    mat = mags.pivot_table(index="date", columns="subdomain", values="magnitude", aggfunc="mean").sort_index()
+    mat = mat.loc[:, mat.notna().sum(axis=0) >= args.min_days]
+    print(f"[INFO] where={args.w}: {mat.shape[0]}日 × {mat.shape[1]}サブドメイン")
+
+    seg_df, cp_df = detect_all(mat, args.beta, args.min_size, args.workers)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    seg_path = os.path.join(args.out_dir, f"segments_{args.w}.csv")
+    cp_path = os.path.join(args.out_dir, f"changepoints_{args.w}.csv")
+    seg_df.to_csv(seg_path, index=False, float_format="%.6f")
+    cp_df.sort_values(["break_date", "subdomain"]).to_csv(cp_path, index=False, float_format="%.6f")
+
+    print(f"[INFO] 変化点 {len(cp_df)}件 / {cp_df['subdomain'].nunique()}サブドメイン")
+    for _, r in cp_df.reindex(cp_df["delta"].abs().sort_values(ascending=False).index).head(10).iterrows():
+        print(f"  {r['break_date']} {r['subdomain']:<20} {r['mean_before']:.3f} -> {r['mean_after']:.3f}")
+    print(f"[DONE] {seg_path}, {cp_path}")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+日次クエリ数と日次 DNS Magnitude の相関をサブドメインごと・ラグごとに計算する。
+
+visual.py は月次の q_mean と mag_mean を結合して where ごとに 1 つの相関を出すが、
+本スクリプトは 日付×サブドメイン の行列を作り、各サブドメインについて
+  count(t) と magnitude(t + lag)  (lag = 0..N 日)
+の Pearson / Spearman 相関を行列演算で一括計算する（Python のループはラグ方向のみ）。
+
+入力ファイルの形式（visual.py と同じ）：
+- クエリ数: {count_dir}/count-{where}-YYYY-MM-DD.csv  （列: day,domain,count）
+- Magnitude: {mag_dir}/{where}-YYYY-MM-DD.csv          （列: day,domain,dnsmagnitude）
+  where: 0 = 権威DNS, 1 = リゾルバ
+
+出力（--out-dir 配下）：
+- corr_lag_{where}.csv       … 全 (subdomain, lag) の相関（列: subdomain,lag,n,pearson,spearman）
+- corr_lag_rank_{where}.csv  … サブドメイン別の要約。lag=0 の Spearman 昇順
+                               （人気度とトラフィックが乖離しているものほど上位）
+
+実行例:
+    python3 correlation_lag.py --count-dir /home/shimada/analysis/output-2025 \
+        --mag-dir /home/shimada/analysis/output \
+        --start-date 2025-04-01 --end-date 2025-06-30 --max-lag 7 --out-dir ./corr
+"""
+
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from visual import read_daily_counts_for_range, read_daily_magnitude_for_range
+
+# ======== 行列化 ========
+
+def build_date_subdomain_matrices(df_counts: pd.DataFrame, df_mag: pd.DataFrame,
+                                  start_date: str, end_date: str):
+    """
+    日次の count / magnitude を 日付×サブドメイン の行列に揃える。
+    欠損日・欠損サブドメインは NaN のまま残す（相関はペアが揃った日だけで計算する）。
+    戻り値: (dates, subdomains, count_mat, mag_mat)  ※ mat は shape=(日数, サブドメイン数)
+    """
+    dates = pd.date_range(start_date, end_date, freq="D").strftime("%Y-%m-%d")
+    subdomains = pd.Index(sorted(set(df_counts["subdomain"]) & set(df_mag["subdomain"])))
+
+    def to_matrix(df, value_col):
+        mat = df.pivot_table(index="date", columns="subdomain", values=value_col, aggfunc="mean")
+        mat = mat.reindex(index=dates, columns=subdomains)
+        return mat.to_numpy(dtype=np.float64)
+
+    return dates, subdomains, to_matrix(df_counts, "count"), to_matrix(df_mag, "magnitude")
+
+
+# ======== 相関 ========
+
+def _masked_pearson(x: np.ndarray, y: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """列ごとの Pearson 相関（mask が True の行だけを使用）。shape=(T,S) -> (S,)"""
+    n = mask.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_x = np.where(mask, x, 0.0).sum(axis=0) / n
+        mean_y = np.where(mask, y, 0.0).sum(axis=0) / n
+        dx = np.where(mask, x - mean_x, 0.0)
+        dy = np.where(mask, y - mean_y, 0.0)
+        r = (dx * dy).sum(axis=0) / np.sqrt((dx * dx).sum(axis=0) * (dy * dy).sum(axis=0))
+    return r
+
+
+def _masked_rank(x: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """列ごとに mask 内の値を平均順位へ変換（同順位は平均）。mask 外は NaN"""
+    return pd.DataFrame(np.where(mask, x, np.nan)).rank(axis=0, method="average").to_numpy()
+
+
+def lagged_correlations(count_mat: np.ndarray, mag_mat: np.ndarray, max_lag: int,
+                        min_pairs: int = 5) -> dict:
+    """
+    lag = 0..max_lag について count(t) と magnitude(t+lag) の相関を全サブドメイン同時に計算。
+    戻り値: {'n','pearson','spearman'} それぞれ shape=(max_lag+1, サブドメイン数)
+    ペア数が min_pairs 未満の組は NaN とする。
+    """
+    n_days, n_sub = count_mat.shape
+    n_out = np.zeros((max_lag + 1, n_sub), dtype=np.int64)
+    pearson = np.full((max_lag + 1, n_sub), np.nan)
+    spearman = np.full((max_lag + 1, n_sub), np.nan)
+
+    for lag in range(max_lag + 1):
+        if lag >= n_days:
+            break
+        x = count_mat[:n_days - lag]
+        y = mag_mat[lag:]
+        mask = ~np.isnan(x) & ~np.isnan(y)
+        n = mask.sum(axis=0)
+        valid = n >= min_pairs
+
+        n_out[lag] = n
+        pearson[lag] = np.where(valid, _masked_pearson(x, y, mask), np.nan)
+        spearman[lag] = np.where(valid, _masked_pearson(_masked_rank(x, mask),
+                                                        _masked_rank(y, mask), mask), np.nan)
+
+    return {"n": n_out, "pearson": pearson, "spearman": spearman}
+
+
+def to_long_table(subdomains: pd.Index, corr: dict) -> pd.DataFrame:
+    """相関行列を (subdomain, lag) の縦持ちテーブルに変換"""
+    n_lag, n_sub = corr["n"].shape
+    return pd.DataFrame({
+        "subdomain": np.tile(subdomains.to_numpy(), n_lag),
+        "lag": np.repeat(np.arange(n_lag), n_sub),
+        "n": corr["n"].ravel(),
+        "pearson": corr["pearson"].ravel(),
+        "spearman": corr["spearman"].ravel(),
+    }).dropna(subset=["pearson", "spearman"], how="all")
+
+
+def rank_subdomains(subdomains: pd.Index, corr: dict) -> pd.DataFrame:
+    """
+    サブドメインごとの要約:
+      lag=0 の相関、|Spearman| が最大となるラグとその値
+    lag=0 の Spearman が低い（乖離が大きい）順に並べる
+    """
+    sp = corr["spearman"]
+    has_any = ~np.all(np.isnan(sp), axis=0)
+    best_lag = np.full(sp.shape[1], -1)
+    best_lag[has_any] = np.nanargmax(np.abs(sp[:, has_any]), axis=0)
+    cols = np.arange(sp.shape[1])
+
+    out = pd.DataFrame({
+        "subdomain": subdomains.to_numpy(),
+        "n_lag0": corr["n"][0],
+        "pearson_lag0": corr["pearson"][0],
+        "spearman_lag0": sp[0],
+        "best_lag": best_lag,
+        "best_spearman": np.where(has_any, sp[np.maximum(best_lag, 0), cols], np.nan),
+    })
+    out = out[has_any].sort_values("spearman_lag0", ascending=True, na_position="last")
+    out.insert(0, "rank", np.arange(1, len(out) + 1))
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="日次クエリ数と日次Magnitudeのサブドメイン別ラグ相関を計算")
+    parser.add_argument("--count-dir", required=True, help="日次クエリ数CSVのディレクトリ（例: /home/shimada/analysis/output-2025）")
+    parser.add_argument("--mag-dir",   required=True, help="日次Magnitude CSVのディレクトリ（例: /home/shimada/analysis/output）")
+    parser.add_argument("--start-date", default="2025-04-01", help="開始日 YYYY-MM-DD（デフォルト: 2025-04-01）")
+    parser.add_argument("--end-date",   default="2025-04-30", help="終了日 YYYY-MM-DD（デフォルト: 2025-04-30）")
+    parser.add_argument("--max-lag",    type=int, default=7, help="最大ラグ日数（デフォルト: 7）")
+    parser.add_argument("--min-pairs",  type=int, default=5, help="相関計算に必要な最小ペア日数（デフォルト: 5）")
+    parser.add_argument("-w", type=int, choices=[0, 1], action="append",
+                        help="対象 where（複数指定可。省略時は 0 と 1）")
+    parser.add_argument("--out-dir",    default="./corr", help="出力先（デフォルト: ./corr）")
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    wheres = args.w if args.w else [0, 1]
+
+    for where in wheres:
+        counts = read_daily_counts_for_range(args.count_dir, where, args.start_date, args.end_date)
+        mags   = read_daily_magnitude_for_range(args.mag_dir, where, args.start_date, args.end_date)
+        if counts.empty or mags.empty:
+            print(f"[INFO] データ無しのためスキップ（where={where}）")
+            continue
+
+        dates, subdomains, count_mat, mag_mat = build_date_subdomain_matrices(
+            counts, mags, args.start_date, args.end_date)
+        print(f"[INFO] where={where}: {len(dates)}日 × {len(subdomains)}サブドメイン")
+
+        corr = lagged_correlations(count_mat, mag_mat, args.max_lag, args.min_pairs)
+
+        long_path = os.path.join(args.out_dir, f"corr_lag_{where}.csv")
+        to_long_table(subdomains, corr).to_csv(long_path, index=False, float_format="%.6f")
+
+        rank_path = os.path.join(args.out_dir, f"corr_lag_rank_{where}.csv")
+        ranked = rank_subdomains(subdomains, corr)
+        ranked.to_csv(rank_path, index=False, float_format="%.6f")
+
+        print(f"[INFO] 保存: {long_path}, {rank_path}")
+        print(f"--- 乖離の大きい上位10サブドメイン（where={where}, lag=0 Spearman 昇順） ---")
+        for _, r in ranked.head(10).iterrows():
+            print(f"{int(r['rank']):2d}. {r['subdomain']:<20} spearman={r['spearman_lag0']:.4f} "
+                  f"pearson={r['pearson_lag0']:.4f} best_lag={int(r['best_lag'])}")
+
+    print("完了 ->", os.path.abspath(args.out_dir))
+
+if __name__ == "__main__":
+    main()
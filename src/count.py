@@ -19,11 +19,92 @@ DNS集計分析ツール (2025年版)
 
 import sys
 import os
+
+import func
+import warehouse
+import memo
 from func import (
     file_lst, safe_read_csv, qtype_ratio, calculate_dns_magnitude,
     write_magnitude_csv, ensure_output_dir, write_error_log
 )
 
+def analyze_day(csv_files, date_str, count_output_dir, magnitude_output_dir):
+    """1 日分の qtype 比率と DNS Magnitude を計算して CSV に保存"""
+    # ファイルごとにqtype比率を計算し、統合データを作成
+    all_data = []
+    total_error_lines = []
+    file_error_counts = {}
+    
+    for file_path in csv_files:
+        file_name = os.path.basename(file_path)
+        print(f"処理中: {file_name}")
+        
+        # CSVファイルを安全に読み込み
+        df, error_lines = safe_read_csv(file_path)
+        
+        if not df.empty:
+            all_data.append(df)
+        
+        # エラー行の記録
+        if error_lines:
+            file_error_counts[file_name] = len(error_lines)
+            total_error_lines.extend([(file_name, line_num, content) for line_num, content in error_lines])
+    
+    if not all_data:
+        print("エラー: 有効なデータが見つかりませんでした")
+        sys.exit(1)
+    
+    print(f"有効ファイル数: {len(all_data)}")
+    
+    # データを統合
+    import pandas as pd
+    combined_df = pd.concat(all_data, ignore_index=True)
+    print(f"統合データサイズ: {len(combined_df)}行")
+    
+    # qtype比率を計算
+    ratios = qtype_ratio(combined_df)
+    if ratios:
+        print("\n=== Qtype比率 ===")
+        for qtype, ratio in sorted(ratios.items(), key=lambda x: x[1], reverse=True):
+            print(f"{qtype}: {ratio:.6f}")
+        
+        # qtype比率をCSVに保存
+        # 日全体の比率なので subdomain は空、key に qtype
+        warehouse.append('qtype_ratio', [('', qtype, ratio) for qtype, ratio in ratios.items()], date=date_str)
+        if warehouse.csv_enabled():
+            count_csv_path = os.path.join(count_output_dir, f"qtype-ratio-{date_str}.csv")
+            with open(count_csv_path, 'w', newline='') as csvfile:
+                import csv
+                writer = csv.writer(csvfile)
+                writer.writerow(['date', 'qtype', 'ratio'])
+                for qtype, ratio in sorted(ratios.items(), key=lambda x: x[1], reverse=True):
+                    writer.writerow([date_str, qtype, f"{ratio:.6f}"])
+            
+            print(f"qtype比率をCSVに保存: {count_csv_path}")
+    
+    # DNS Magnitudeを計算（IPアドレスとqnameカラムが必要）
+    if 'ip' in combined_df.columns and 'qname' in combined_df.columns:
+        magnitude_dict = calculate_dns_magnitude(combined_df, date_str)
+        
+        if magnitude_dict:
+            print(f"\n=== DNS Magnitude (上位10件) ===")
+            for i, (domain, magnitude) in enumerate(list(magnitude_dict.items())[:10], 1):
+                print(f"{i:2d}. {domain:<30} {magnitude:8.6f}")
+            
+            # MagnitudeをCSVに保存
+            magnitude_csv_path = os.path.join(magnitude_output_dir, f"magnitude-{date_str}.csv")
+            write_magnitude_csv(magnitude_dict, date_str, magnitude_csv_path)
+        else:
+            print("DNS Magnitudeの計算に失敗しました")
+    else:
+        print("警告: DNS Magnitude計算に必要なカラム（ip, qname）が見つかりません")
+    
+    # エラーログの出力
+    if total_error_lines:
+        print(f"\n警告: {len(total_error_lines)}行のエラーが発見されました")
+        error_log_file = f"error_log_{date_str}.txt"
+        write_error_log(total_error_lines, file_error_counts, error_log_file)
+
 def main():
     if len(sys.argv) != 4:
         print(__doc__)
@@ -57,77 +138,11 @@ def main():
         count_output_dir = ensure_output_dir("count")
         magnitude_output_dir = ensure_output_dir("magnitude")
         
-        # ファイルごとにqtype比率を計算し、統合データを作成
-        all_data = []
-        total_error_lines = []
-        file_error_counts = {}
-        
-        for file_path in csv_files:
-            file_name = os.path.basename(file_path)
-            print(f"処理中: {file_name}")
-            
-            # CSVファイルを安全に読み込み
-            df, error_lines = safe_read_csv(file_path)
-            
-            if not df.empty:
-                all_data.append(df)
-            
-            # エラー行の記録
-            if error_lines:
-                file_error_counts[file_name] = len(error_lines)
-                total_error_lines.extend([(file_name, line_num, content) for line_num, content in error_lines])
-        
-        if not all_data:
-            print("エラー: 有効なデータが見つかりませんでした")
-            sys.exit(1)
-        
-        print(f"有効ファイル数: {len(all_data)}")
-        
-        # データを統合
-        import pandas as pd
-        combined_df = pd.concat(all_data, ignore_index=True)
-        print(f"統合データサイズ: {len(combined_df)}行")
-        
-        # qtype比率を計算
-        ratios = qtype_ratio(combined_df)
-        if ratios:
-            print("\n=== Qtype比率 ===")
-            for qtype, ratio in sorted(ratios.items(), key=lambda x: x[1], reverse=True):
-                print(f"{qtype}: {ratio:.6f}")
-            
-            # qtype比率をCSVに保存
-            count_csv_path = os.path.join(count_output_dir, f"qtype-ratio-{date_str}.csv")
-            with open(count_csv_path, 'w', newline='') as csvfile:
-                import csv
-                writer = csv.writer(csvfile)
-                writer.writerow(['date', 'qtype', 'ratio'])
-                for qtype, ratio in sorted(ratios.items(), key=lambda x: x[1], reverse=True):
-                    writer.writerow([date_str, qtype, f"{ratio:.6f}"])
-            
-            print(f"qtype比率をCSVに保存: {count_csv_path}")
-        
-        # DNS Magnitudeを計算（IPアドレスとqnameカラムが必要）
-        if 'ip' in combined_df.columns and 'qname' in combined_df.columns:
-            magnitude_dict = calculate_dns_magnitude(combined_df, date_str)
-            
-            if magnitude_dict:
-                print(f"\n=== DNS Magnitude (上位10件) ===")
-                for i, (domain, magnitude) in enumerate(list(magnitude_dict.items())[:10], 1):
-                    print(f"{i:2d}. {domain:<30} {magnitude:8.6f}")
-                
-                # MagnitudeをCSVに保存
-                magnitude_csv_path = os.path.join(magnitude_output_dir, f"magnitude-{date_str}.csv")
-                write_magnitude_csv(magnitude_dict, date_str, magnitude_csv_path)
-            else:
-                print("DNS Magnitudeの計算に失敗しました")
-        else:
-            print("警告: DNS Magnitude計算に必要なカラム（ip, qname）が見つかりません")
-        
-        # エラーログの出力
-        if total_error_lines:
-            print(f"\n警告: {len(total_error_lines)}行のエラーが発見されました")
-            error_log_file = f"error_log_{date_str}.txt"
-            write_error_log(total_error_lines, file_error_counts, error_log_file)
+        # 入力ファイル・コードが前回と同じ日は計算せずにキャッシュの CSV を使う
+        outputs = [os.path.join(count_output_dir, f"qtype-ratio-{date_str}.csv"),
+                   os.path.join(magnitude_output_dir, f"magnitude-{date_str}.csv")]
+        memo.run_cached("count", date_str, csv_files, {}, [__file__, func.__file__], outputs,
+                        lambda: analyze_day(csv_files, date_str, count_output_dir, magnitude_output_dir))
         
         print(f"\n=== 処理完了: {date_str} ===")
         
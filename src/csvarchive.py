@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+時間ごとの抽出 CSV のシーク可能な圧縮アーカイブ（ブロック gzip）
+
+YYYY-MM-DD-HH.csv を、独立に展開できる gzip メンバー（フレーム）を連結した
+YYYY-MM-DD-HH.csv.bgz と、フレームの索引 YYYY-MM-DD-HH.csv.bgz.idx に変換する。
+  - フレーム 0 はヘッダー行だけ、以降は --block-rows 行ずつ
+  - 連結した gzip なので zcat / pandas.read_csv(compression='gzip') でもそのまま読める
+  - 索引（CSV）: frame,offset,length,rows,time_min,time_max
+      time_min / time_max はフレーム内の frame.time の最小・最大（秒、query_response_join.parse_frame_time と同じ基準）
+
+読み込み（read_hourly / read_archive）は
+  - 時間の一部（start〜end）だけが必要なら、その範囲と重なるフレームだけを読む（ランダムアクセス）
+  - フレームの展開と CSV の解析をスレッドで並列に行う（zlib と pandas の C パーサは GIL を解放する）
+magnitude_engine.hourly_files / load_columns（と rollup.py・membudget.py）は .csv と .csv.bgz のどちらも扱う。
+変換しても元の CSV は消さない（2025/func.open_reader_safe、func.py のローダー、run_analysis_v2.py、
+query_response_join.py、rawstore.py などは *.csv しか読まないため）。
+
+実行例:
+    # ディレクトリ内の指定期間の CSV をアーカイブに変換
+    python3 csvarchive.py compress --input-dir /mnt/qnap2/shimada/resolver/ --start-date 2025-04-01 --end-date 2025-04-30
+    # 09:15〜09:20 の行だけを取り出す
+    python3 csvarchive.py cat /mnt/qnap2/shimada/resolver/2025-04-01-09.csv.bgz \\
+        --start "2025-04-01 09:15:00" --end "2025-04-01 09:20:00" -o part.csv
+"""
+
+import io
+import os
+import re
+import gzip
+import glob
+import argparse
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+ARCHIVE_SUFFIX = ".csv.bgz"
+INDEX_SUFFIX = ".idx"
+BLOCK_ROWS = 65536
+COMPRESS_LEVEL = 6
+# 圧縮待ちのブロックはスレッド数のこの倍まで（読み込みが圧縮より速くてもメモリに溜めない）
+IN_FLIGHT_PER_WORKER = 2
+TIME_COLUMN = "frame.time"
+
+
+def parse_frame_time(values: pd.Series) -> np.ndarray:
+    # query_response_join → magnitude_engine → csvarchive の循環 import を避けるため、使うときに読み込む
+    from query_response_join import parse_frame_time as parse
+    return parse(values)
+
+# ==== 書き込み ====
+
+def _iter_blocks(f, block_rows):
+    block = []
+    for line in f:
+        block.append(line)
+        if len(block) >= block_rows:
+            yield b"".join(block), len(block)
+            block = []
+    if block:
+        yield b"".join(block), len(block)
+
+
+def _compress_block(header, block, rows):
+    """1 フレーム分を圧縮し、frame.time の範囲を求める"""
+    t_min = t_max = np.nan
+    try:
+        times = parse_frame_time(pd.read_csv(io.BytesIO(header + block), dtype=str, usecols=[TIME_COLUMN])[TIME_COLUMN])
+        if np.isfinite(times).any():
+            t_min, t_max = np.nanmin(times), np.nanmax(times)
+    except (ValueError, pd.errors.ParserError):
+        pass
+    return gzip.compress(block, compresslevel=COMPRESS_LEVEL, mtime=0), rows, t_min, t_max
+
+
+def compress_csv(src, dst=None, block_rows=BLOCK_ROWS, workers=None):
+    """CSV をブロック gzip に変換する。一時ファイルに書いてから置き換える。戻り値: (元サイズ, 圧縮後サイズ)"""
+    dst = dst or src[:-len(".csv")] + ARCHIVE_SUFFIX
+    tmp_dst, tmp_idx = dst + ".tmp", dst + INDEX_SUFFIX + ".tmp"
+    workers = workers or os.cpu_count() or 1
+    index = []
+    with open(src, "rb") as f, open(tmp_dst, "wb") as out, ThreadPoolExecutor(workers) as pool:
+        header = f.readline()
+        data = gzip.compress(header, compresslevel=COMPRESS_LEVEL, mtime=0)
+        out.write(data)
+        index.append((0, len(data), 0, np.nan, np.nan))
+        offset = len(data)
+        # 投入した順に結果を取り出すので、並列に圧縮してもフレームはファイル順に並ぶ。
+        # pool.map は入力を先に全部投入してしまうため、未完了のブロック数を抑えながら投入する
+        pending = deque()
+        blocks = _iter_blocks(f, block_rows)
+        while True:
+            for block in islice(blocks, workers * IN_FLIGHT_PER_WORKER - len(pending)):
+                pending.append(pool.submit(_compress_block, header, *block))
+            if not pending:
+                break
+            data, rows, t_min, t_max = pending.popleft().result()
+            out.write(data)
+            index.append((offset, len(data), rows, t_min, t_max))
+            offset += len(data)
+    idx = pd.DataFrame(index, columns=["offset", "length", "rows", "time_min", "time_max"])
+    idx.insert(0, "frame", np.arange(len(idx)))
+    idx.to_csv(tmp_idx, index=False, float_format="%.6f")
+    os.replace(tmp_dst, dst)
+    os.replace(tmp_idx, dst + INDEX_SUFFIX)
+    return os.path.getsize(src), offset
+
+# ==== 読み込み ====
+
+def read_index(path):
+    return pd.read_csv(path + INDEX_SUFFIX)
+
+
+def _read_frames(f, frames):
+    """索引の行（offset, length）のフレームを 1 回のシーク・読み込みにまとめて読む"""
+    lo = int(frames["offset"].iloc[0])
+    hi = int(frames["offset"].iloc[-1] + frames["length"].iloc[-1])
+    f.seek(lo)
+    buf = f.read(hi - lo)
+    return [buf[o - lo:o - lo + n] for o, n in zip(frames["offset"], frames["length"])]
+
+
+def read_archive(path, start=None, end=None, usecols=None, workers=None) -> pd.DataFrame:
+    """
+    アーカイブを DataFrame（全列文字列）として読む。
+    start / end（秒）を指定すると frame.time がその範囲のフレームだけを読み、行も範囲内に絞る。
+    usecols は pandas.read_csv と同じ（列名のリストまたは関数）。
+    """
+    idx = read_index(path)
+    data_frames = idx.iloc[1:]
+    if start is not None or end is not None:
+        keep = np.ones(len(data_frames), dtype=bool)
+        # 時刻の無いフレーム（NaN）は範囲外と判定できないので読む
+        if start is not None:
+            keep &= ~(data_frames["time_max"] < start)
+        if end is not None:
+            keep &= ~(data_frames["time_min"] > end)
+        data_frames = data_frames[keep]
+
+    with open(path, "rb") as f:
+        header = gzip.decompress(_read_frames(f, idx.iloc[:1])[0])
+        # 連続するフレームは 1 回で読む（NAS への小さな読み込みを減らす）
+        runs = np.split(np.arange(len(data_frames)), np.nonzero(np.diff(data_frames["frame"].to_numpy()) != 1)[0] + 1)
+        blobs = []
+        for run in runs:
+            if len(run):
+                blobs.extend(_read_frames(f, data_frames.iloc[run]))
+
+    need_time = start is not None or end is not None
+    drop_time = False
+    if need_time and usecols is not None:
+        cols = usecols
+        drop_time = not (cols(TIME_COLUMN) if callable(cols) else TIME_COLUMN in cols)
+        usecols = (lambda c: c == TIME_COLUMN or cols(c)) if callable(cols) else list(cols) + [TIME_COLUMN]
+
+    def parse(blob):
+        return pd.read_csv(io.BytesIO(header + gzip.decompress(blob)), dtype=str, usecols=usecols)
+
+    with ThreadPoolExecutor(workers) as pool:
+        parts = list(pool.map(parse, blobs))
+    if not parts:
+        return pd.read_csv(io.BytesIO(header), dtype=str, usecols=usecols)
+    df = pd.concat(parts, ignore_index=True)
+
+    if need_time:
+        t = parse_frame_time(df[TIME_COLUMN])
+        mask = np.ones(len(df), dtype=bool)
+        if start is not None:
+            mask &= t >= start
+        if end is not None:
+            mask &= t <= end
+        df = df[mask].reset_index(drop=True)
+        if drop_time:
+            df = df.drop(columns=TIME_COLUMN)
+    return df
+
+
+def read_hourly(path, usecols=None, workers=None) -> pd.DataFrame:
+    """時間ごとのファイルを読む（.csv はそのまま、.csv.bgz はフレームを並列に展開）"""
+    if path.endswith(ARCHIVE_SUFFIX):
+        return read_archive(path, usecols=usecols, workers=workers)
+    return pd.read_csv(path, dtype=str, usecols=usecols)
+
+
+def to_seconds(value):
+    """'YYYY-MM-DD HH:MM:SS' を parse_frame_time と同じ基準の秒にする"""
+    return (pd.Timestamp(value) - pd.Timestamp(0)).total_seconds()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="時間ごとの CSV のブロック gzip アーカイブ（変換・部分読み出し）")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("compress", help="YYYY-MM-DD-HH.csv を .csv.bgz に変換する")
+    p.add_argument("--input-dir", required=True)
+    p.add_argument("--start-date", required=True)
+    p.add_argument("--end-date", required=True)
+    p.add_argument("--block-rows", type=int, default=BLOCK_ROWS, help=f"1 フレームの行数（デフォルト: {BLOCK_ROWS}）")
+    p.add_argument("--workers", type=int, default=None, help="圧縮の並列スレッド数")
+
+    p = sub.add_parser("cat", help="アーカイブの一部（時間範囲）を CSV で書き出す")
+    p.add_argument("path")
+    p.add_argument("--start", help="開始時刻（例: '2025-04-01 09:15:00'）")
+    p.add_argument("--end", help="終了時刻")
+    p.add_argument("--workers", type=int, default=None, help="展開の並列スレッド数")
+    p.add_argument("-o", "--output", help="出力 CSV（省略時は標準出力）")
+    args = parser.parse_args()
+
+    if args.command == "compress":
+        pat = re.compile(r"(\d{4}-\d{2}-\d{2})-\d{2}\.csv")
+        total_in = total_out = 0
+        for src in sorted(glob.glob(os.path.join(args.input_dir, "*.csv"))):
+            m = pat.fullmatch(os.path.basename(src))
+            if not m or not (args.start_date <= m.group(1) <= args.end_date):
+                continue
+            size_in, size_out = compress_csv(src, block_rows=args.block_rows, workers=args.workers)
+            total_in += size_in
+            total_out += size_out
+            print(f"{os.path.basename(src)}: {size_in:,} -> {size_out:,} bytes ({size_in / max(size_out, 1):.1f}x)")
+        print(f"[DONE] {total_in:,} -> {total_out:,} bytes ({total_in / max(total_out, 1):.1f}x)")
+        return 0
+
+    start = to_seconds(args.start) if args.start else None
+    end = to_seconds(args.end) if args.end else None
+    df = read_archive(args.path, start, end, workers=args.workers)
+    if args.output:
+        df.to_csv(args.output, index=False)
+        print(f"[DONE] {len(df):,}行 -> {args.output}")
+    else:
+        print(df.to_csv(index=False), end="")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
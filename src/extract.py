@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+dnscap のダンプから時間ごとの CSV を並列に抽出する（tshark-*.sh の Python 版）
+
+tshark-auth.sh / tshark-resolver-v2.sh / tshark-resovler-query-and-respons.sh と同じフィルタ・列・出力先で、
+  - JST の範囲 → 対象の dump-YYYYMMDDHHMM.gz、UTC → JST の出力名を zoneinfo で求める（ファイルごとの date の起動をしない）
+  - ダンプをコピー・解凍せず、gzip -dc の出力を tshark に直接流す
+  - 最大 --workers 個の tshark を同時に実行する。全体の読み込み速度（MB/s）を見ながら同時実行数を増減し、
+    増やしても速くならない（NAS の I/O が詰まっている）ときは減らす
+  - 出力は YYYY-MM-DD-HH.csv.tmp に書いてから os.replace で置き換える（途中で止めても壊れたファイルが残らない）
+  - 出力が既にあるダンプは飛ばす（--force で作り直す）
+  - ファイルごとの所要時間を {出力先}/extract-log.csv に追記する（dump,output,bytes,rows,seconds,mb_per_s,workers）
+  - all を指定すると、各ダンプを 1 回だけ tshark で解析し（3 つのフィルタの OR、全出力の列 + フラグ列）、
+    各プロファイルの条件で行を振り分けて 3 つの出力を書く（展開・解析のコストを 3 回から 1 回にする）
+
+実行例:
+    python3 extract.py resolver 202504010000 202504302359 --workers 8
+    python3 extract.py auth 202504010000 202504012359 --dump-dir /mnt/qnap2/dnscap/2023/
+    python3 extract.py all 202504010000 202504302359 --workers 8
+"""
+
+import os
+import re
+import csv
+import glob
+import time
+import argparse
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import pandas as pd
+
+DUMP_DIR = "/mnt/qnap2/dnscap/dnscap/"
+JST = ZoneInfo("Asia/Tokyo")
+
+RESOLVER_SRC = "(ip.src == 130.158.68.25 or ip.src == 130.158.68.26)"
+TSUKUBA = r'(dns.qry.name matches "\.tsukuba\.ac\.jp$")'
+
+# 各 tshark-*.sh のフィルタ・列・出力先
+PROFILES = {
+    "auth": {
+        "output_dir": "/mnt/qnap2/shimada/input/",
+        "filter": "(ip.src == 130.158.68.20 or ip.src == 130.158.68.21 or ip.src == 130.158.71.54) "
+                  "and (dns.flags.authoritative == 1) and (dns.flags.rcode == 0)",
+        "fields": ["frame.time", "ip.src", "ip.dst", "ipv6.dst", "dns.qry.name", "dns.qry.type"],
+        "row_pattern": None,
+    },
+    "resolver": {
+        "output_dir": "/mnt/qnap2/shimada/resolver/",
+        "filter": f"{RESOLVER_SRC} and {TSUKUBA} and (dns.flags.response == 1) "
+                  "and (dns.flags.authoritative == 0) and (dns.flags.rcode == 0)",
+        "fields": ["frame.time", "ip.src", "ip.dst", "ipv6.dst", "dns.qry.name", "dns.qry.type"],
+        # tshark-resolver-v2.sh の grep と同じく、dns.qry.name が .tsukuba.ac.jp で終わる行だけを残す
+        "row_pattern": rb',"[^"]*\.tsukuba\.ac\.jp",',
+    },
+    "query-response": {
+        "output_dir": "/mnt/qnap2/shimada/resolver-q-r/",
+        "filter": f"{TSUKUBA} and (dns.flags.authoritative == 0) and (ip.src == 130.158.68.25 or ip.src == 130.158.68.26 "
+                  "or ip.dst == 130.158.68.25 or ip.dst == 130.158.68.26)",
+        "fields": ["frame.time", "ip.src", "ip.dst", "dns.qry.name", "dns.qry.type",
+                   "dns.flags.response", "dns.flags.rcode", "vlan.id"],
+        "row_pattern": None,
+    },
+}
+
+LOG_NAME = "extract-log.csv"
+LOG_COLUMNS = ["dump", "output", "bytes", "rows", "seconds", "mb_per_s", "workers"]
+
+# ==== 時刻とファイル ====
+
+_DUMP_TIME = re.compile(r"dump-(\d{12})")
+
+
+def parse_jst(value):
+    """'YYYYMMDDHHMM'（JST）→ UTC の datetime"""
+    return datetime.strptime(value, "%Y%m%d%H%M").replace(tzinfo=JST).astimezone(timezone.utc)
+
+
+def dump_time(path):
+    """dump-YYYYMMDDHHMM.gz の時刻（UTC）"""
+    m = _DUMP_TIME.search(os.path.basename(path))
+    return datetime.strptime(m.group(1), "%Y%m%d%H%M").replace(tzinfo=timezone.utc) if m else None
+
+
+def output_name(utc):
+    """UTC の時刻 → JST の YYYY-MM-DD-HH.csv"""
+    return utc.astimezone(JST).strftime("%Y-%m-%d-%H") + ".csv"
+
+
+def list_dumps(dump_dir, start_utc, end_utc):
+    dumps = []
+    for path in sorted(glob.glob(os.path.join(dump_dir, "dump-*.gz"))):
+        t = dump_time(path)
+        if t is not None and start_utc <= t <= end_utc:
+            dumps.append((t, path))
+    return dumps
+
+# ==== 抽出 ====
+
+def tshark_command(tshark, profile, source="-"):
+    cmd = [tshark, "-r", source, "-Y", profile["filter"], "-T", "fields"]
+    for field in profile["fields"]:
+        cmd += ["-e", field]
+    return cmd + ["-E", "header=y", "-E", "separator=,", "-E", "quote=d"]
+
+
+def _stderr_tail(errf):
+    """一時ファイルに書かせた tshark の stderr の末尾（パイプにすると、stdout を読み終えるまで読まないため
+    警告が多いと tshark が stderr の書き込みで止まり、stdout も止まって互いに待ち続ける）"""
+    errf.seek(0)
+    return errf.read().decode(errors="replace").strip()[-500:]
+
+
+def extract_one(dump, output_path, profile, tshark="tshark"):
+    """1 つのダンプを展開しながら tshark に渡し、出力を一時ファイル経由で書く。戻り値: 行数（ヘッダーを除く）"""
+    tmp_path = output_path + ".tmp"
+    keep = re.compile(profile["row_pattern"]) if profile["row_pattern"] else None
+    rows = -1
+    unzip = subprocess.Popen(["gzip", "-dc", dump], stdout=subprocess.PIPE)
+    proc = None
+    errf = tempfile.TemporaryFile()
+    try:
+        proc = subprocess.Popen(tshark_command(tshark, profile), stdin=unzip.stdout,
+                                stdout=subprocess.PIPE, stderr=errf)
+        unzip.stdout.close()
+        with open(tmp_path, "wb") as out:
+            for line in proc.stdout:
+                # 1 行目はヘッダー
+                if rows >= 0 and keep is not None and not keep.search(line):
+                    continue
+                out.write(line)
+                rows += 1
+        if proc.wait() != 0 or unzip.wait() != 0:
+            raise RuntimeError(f"tshark の実行に失敗しました: {_stderr_tail(errf)}")
+    except BaseException:
+        for p in (unzip, proc):
+            if p is not None and p.poll() is None:
+                p.kill()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        errf.close()
+    os.replace(tmp_path, output_path)
+    return max(rows, 0)
+
+# ==== 1 回の解析で複数の出力に振り分ける ====
+
+RESOLVERS = ["130.158.68.25", "130.158.68.26"]
+AUTH_SERVERS = ["130.158.68.20", "130.158.68.21", "130.158.71.54"]
+COMBINED_FIELDS = ["frame.time", "ip.src", "ip.dst", "ipv6.dst", "dns.qry.name", "dns.qry.type",
+                   "dns.flags.response", "dns.flags.authoritative", "dns.flags.rcode", "vlan.id"]
+ROUTE_CHUNK_ROWS = 200000
+
+
+def _has_value(col, values):
+    """-T fields の値（複数あるときはカンマ区切り）のどれかが values に一致するか（tshark の == と同じ）"""
+    return col.str.contains(rf"(?:^|,)(?:{'|'.join(map(re.escape, values))})(?:,|$)", regex=True)
+
+
+def _flag(col, value):
+    # tshark のバージョンによって真偽値は 1/0 または True/False で出力される
+    values = {"1": ["1", "True"], "0": ["0", "False"]}.get(value, [value])
+    return _has_value(col, values)
+
+
+def route_masks(chunk):
+    """各プロファイルの表示フィルタを列の値で評価する（PROFILES の filter と同じ条件）"""
+    # 表示フィルタの matches は大文字小文字を区別しない（0x20 で大文字が混ざった qname も残る）。
+    # resolver の出力だけは、シェルの grep と同じく extract_routed で大文字小文字を区別して絞る
+    tsukuba = chunk["dns.qry.name"].str.contains(r"\.tsukuba\.ac\.jp(?:,|$)", case=False, regex=True)
+    non_auth = _flag(chunk["dns.flags.authoritative"], "0")
+    resolver_src = _has_value(chunk["ip.src"], RESOLVERS)
+    return {
+        "auth": _has_value(chunk["ip.src"], AUTH_SERVERS) & _flag(chunk["dns.flags.authoritative"], "1")
+                & _flag(chunk["dns.flags.rcode"], "0"),
+        "resolver": resolver_src & tsukuba & _flag(chunk["dns.flags.response"], "1") & non_auth
+                    & _flag(chunk["dns.flags.rcode"], "0"),
+        "query-response": tsukuba & non_auth & (resolver_src | _has_value(chunk["ip.dst"], RESOLVERS)),
+    }
+
+
+def combined_profile(names):
+    """names の表示フィルタの OR と、全出力の列を含む tshark の設定"""
+    return {
+        "filter": " or ".join(f"({PROFILES[n]['filter']})" for n in names),
+        "fields": COMBINED_FIELDS,
+    }
+
+
+def extract_routed(dump, outputs, tshark="tshark"):
+    """
+    1 つのダンプを 1 回だけ tshark で解析し、各プロファイルの条件で行を振り分けて outputs（{プロファイル: 出力パス}）に書く。
+    出力の列・引用符は単独で抽出した場合（tshark -E quote=d）と同じ。戻り値: {プロファイル: 行数}
+    """
+    tmp_paths = {n: path + ".tmp" for n, path in outputs.items()}
+    rows = dict.fromkeys(outputs, 0)
+    unzip = subprocess.Popen(["gzip", "-dc", dump], stdout=subprocess.PIPE)
+    proc = None
+    files = {}
+    errf = tempfile.TemporaryFile()
+    try:
+        proc = subprocess.Popen(tshark_command(tshark, combined_profile(list(outputs))), stdin=unzip.stdout,
+                                stdout=subprocess.PIPE, stderr=errf)
+        unzip.stdout.close()
+        for n, tmp_path in tmp_paths.items():
+            files[n] = open(tmp_path, "w", newline="")
+            files[n].write(",".join(PROFILES[n]["fields"]) + "\n")
+        reader = pd.read_csv(proc.stdout, dtype=str, keep_default_na=False, chunksize=ROUTE_CHUNK_ROWS)
+        for chunk in reader:
+            for n, mask in route_masks(chunk).items():
+                if n not in files:
+                    continue
+                part = chunk.loc[mask, PROFILES[n]["fields"]]
+                if PROFILES[n]["row_pattern"]:
+                    part = part[part["dns.qry.name"].str.endswith(".tsukuba.ac.jp")]
+                part.to_csv(files[n], header=False, index=False, quoting=csv.QUOTE_ALL)
+                rows[n] += len(part)
+        if proc.wait() != 0 or unzip.wait() != 0:
+            raise RuntimeError(f"tshark の実行に失敗しました: {_stderr_tail(errf)}")
+    except pd.errors.EmptyDataError:
+        # フィルタに合うパケットが無くヘッダーも出なかった場合
+        if proc.wait() != 0 or unzip.wait() != 0:
+            raise RuntimeError(f"tshark の実行に失敗しました: {_stderr_tail(errf)}")
+    except BaseException:
+        for p in (unzip, proc):
+            if p is not None and p.poll() is None:
+                p.kill()
+        for f in files.values():
+            f.close()
+        for tmp_path in tmp_paths.values():
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+    finally:
+        errf.close()
+    for f in files.values():
+        f.close()
+    for n, path in outputs.items():
+        os.replace(tmp_paths[n], path)
+    return rows
+
+# ==== 同時実行数の調整 ====
+
+class Throttle:
+    """
+    完了したファイルの合計バイト数 / 経過時間（MB/s）を window 件ごとに測り、同時実行数を山登りで決める。
+    前回より速くなれば同じ向きにもう 1 つ動かし、遅くなれば向きを変える（1〜max_workers）。
+    """
+
+    def __init__(self, max_workers, start=None, window=None, adaptive=True):
+        self.max_workers = max_workers
+        self.adaptive = adaptive
+        self.limit = min(start or max(max_workers // 2, 1), max_workers)
+        self.window = window or max_workers
+        self.direction = 1
+        self.last_rate = None
+        self._bytes = 0
+        self._done = 0
+        self._t0 = time.time()
+
+    def completed(self, nbytes):
+        if not self.adaptive:
+            return
+        self._bytes += nbytes
+        self._done += 1
+        if self._done < max(self.window, self.limit):
+            return
+        rate = self._bytes / max(time.time() - self._t0, 1e-6) / 1e6
+        if self.last_rate is not None and rate < self.last_rate * 0.95:
+            self.direction = -self.direction
+        new_limit = min(max(self.limit + self.direction, 1), self.max_workers)
+        if new_limit != self.limit:
+            print(f"同時実行数: {self.limit} -> {new_limit}（{rate:.1f} MB/s）")
+        self.limit = new_limit
+        self.last_rate = rate
+        self._bytes, self._done, self._t0 = 0, 0, time.time()
+
+
+def append_log(path, row):
+    new = not os.path.exists(path)
+    with open(path, "a", newline="") as f:
+        writer = csv.writer(f)
+        if new:
+            writer.writerow(LOG_COLUMNS)
+        writer.writerow(row)
+
+
+def run_extract(dump, outputs, tshark):
+    """outputs が 1 つならそのプロファイルのフィルタで、複数なら 1 回の解析で振り分けて抽出する"""
+    if len(outputs) == 1:
+        (name, path), = outputs.items()
+        return {name: extract_one(dump, path, PROFILES[name], tshark)}
+    return extract_routed(dump, outputs, tshark)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="dnscap のダンプから時間ごとの CSV を並列に抽出する")
+    parser.add_argument("profile", choices=sorted(PROFILES) + ["all"],
+                        help="auth / resolver / query-response（各 tshark-*.sh に対応）。all は 1 回の解析で 3 つとも出力する")
+    parser.add_argument("start_jst", help="開始時刻 YYYYMMDDHHMM（JST）")
+    parser.add_argument("end_jst", help="終了時刻 YYYYMMDDHHMM（JST）")
+    parser.add_argument("--dump-dir", default=DUMP_DIR, help=f"ダンプのディレクトリ（デフォルト: {DUMP_DIR}）")
+    parser.add_argument("--output-dir", help="出力先（省略時はプロファイルの出力先。all のときはその下にプロファイル名のディレクトリ）")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="同時に実行する tshark の最大数")
+    parser.add_argument("--fixed", action="store_true", help="I/O 速度による同時実行数の調整をせず、常に --workers で実行する")
+    parser.add_argument("--force", action="store_true", help="出力が既にあるダンプも作り直す")
+    parser.add_argument("--tshark", default="tshark", help="tshark のパス")
+    args = parser.parse_args()
+
+    names = sorted(PROFILES) if args.profile == "all" else [args.profile]
+    if args.output_dir is None:
+        output_dirs = {n: PROFILES[n]["output_dir"] for n in names}
+    elif len(names) == 1:
+        output_dirs = {names[0]: args.output_dir}
+    else:
+        output_dirs = {n: os.path.join(args.output_dir, n) for n in names}
+    for d in output_dirs.values():
+        os.makedirs(d, exist_ok=True)
+
+    dumps = list_dumps(args.dump_dir, parse_jst(args.start_jst), parse_jst(args.end_jst))
+    tasks = []
+    for t, dump in dumps:
+        outputs = {n: os.path.join(d, output_name(t)) for n, d in output_dirs.items()}
+        if all(os.path.exists(p) for p in outputs.values()) and not args.force:
+            continue
+        tasks.append((dump, outputs))
+    print(f"対象ダンプ: {len(dumps)}件（抽出 {len(tasks)}件、既存 {len(dumps) - len(tasks)}件）")
+    if not tasks:
+        return 0
+
+    throttle = Throttle(args.workers, start=args.workers if args.fixed else None, adaptive=not args.fixed)
+    failed = 0
+    t0 = time.time()
+    running = {}
+    pending = list(reversed(tasks))
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        while pending or running:
+            while pending and len(running) < throttle.limit:
+                dump, outputs = pending.pop()
+                running[pool.submit(run_extract, dump, outputs, args.tshark)] = \
+                    (dump, outputs, time.time(), len(running) + 1)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                dump, outputs, started, workers = running.pop(fut)
+                seconds = time.time() - started
+                size = os.path.getsize(dump)
+                try:
+                    rows = fut.result()
+                except Exception as e:
+                    failed += 1
+                    print(f"[WARN] 失敗: {os.path.basename(dump)}: {e}")
+                    continue
+                throttle.completed(size)
+                for n, output_path in outputs.items():
+                    append_log(os.path.join(output_dirs[n], LOG_NAME),
+                               [os.path.basename(dump), os.path.basename(output_path), size, rows[n],
+                                f"{seconds:.1f}", f"{size / max(seconds, 1e-6) / 1e6:.2f}", workers])
+                    print(f"{os.path.basename(dump)} -> {output_path} ({rows[n]:,}行, {seconds:.1f}秒)")
+
+    print(f"[DONE] {len(tasks) - failed}/{len(tasks)}件 ({time.time() - t0:.1f}秒), "
+          f"ログ: {', '.join(os.path.join(d, LOG_NAME) for d in output_dirs.values())}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -12,6 +12,11 @@ import ipaddress
 from collections import defaultdict
 from datetime import datetime, timedelta
 
+import numpy as np
+
+import warehouse
+from netclass import encode_clients, classify_keys, load_prefix_table, table_labels
+
 # ===== 共通設定 =====
 OUTPUT_BASE_DIR = "/home/shimada/output"
 
@@ -185,8 +190,12 @@ def calculate_dns_magnitude(df, date_str):
     # 降順ソート
     return dict(sorted(magnitude_dict.items(), key=lambda item: item[1], reverse=True))
 
-def write_magnitude_csv(magnitude_dict, date_str, output_csv_path):
-    """マグニチュード結果をCSVに書き込み"""
+def write_magnitude_csv(magnitude_dict, date_str, output_csv_path, where=-1):
+    """マグニチュード結果をウェアハウスに追記し、CSVに書き込み（DNSMAG_WRITE_CSV=0 なら CSV は省略）"""
+    warehouse.append('magnitude', magnitude_dict.items(), where=where, date=date_str)
+    if not warehouse.csv_enabled():
+        return
+    
     output_dir = os.path.dirname(output_csv_path)
     os.makedirs(output_dir, exist_ok=True)
     
@@ -273,26 +282,23 @@ def filter_query_response_data(df, analysis_type="query"):
         print("警告: dns.flags.response列が見つかりません")
         return df
     
-    # NaN値を処理
-    df_filtered = df.copy()
-    df_filtered['dns.flags.response'] = df_filtered['dns.flags.response'].fillna('0')
+    # 列全体をコピーせず、マスクで 1 回だけ抽出する（response 欠損は問い合わせ扱い）
+    response_flag = df['dns.flags.response'].fillna('0')
+    is_response = response_flag == '1'
     
     if analysis_type == "query":
         # クエリ（dns.flags.response = 0）
-        result_df = df_filtered[df_filtered['dns.flags.response'] == '0'].copy()
+        result_df = df[response_flag == '0']
         print(f"クエリデータ: {len(result_df)}件")
     elif analysis_type == "response":
         # レスポンス（dns.flags.response = 1）でrcode = 0のもの
-        response_df = df_filtered[df_filtered['dns.flags.response'] == '1'].copy()
-        
-        # rcodeが0のもののみ（NOERROR）
-        if 'dns.flags.rcode' in response_df.columns:
-            response_df['dns.flags.rcode'] = response_df['dns.flags.rcode'].fillna('1')  # NaNは1（エラー）として扱う
-            result_df = response_df[response_df['dns.flags.rcode'] == '0'].copy()
+        if 'dns.flags.rcode' in df.columns:
+            # rcodeが0のもののみ（NOERROR）。NaNは1（エラー）として扱う
+            result_df = df[is_response & (df['dns.flags.rcode'].fillna('1') == '0')]
             print(f"レスポンスデータ（rcode=0）: {len(result_df)}件")
         else:
             print("警告: dns.flags.rcode列が見つかりません")
-            result_df = response_df
+            result_df = df[is_response]
             print(f"レスポンスデータ（rcode未確認）: {len(result_df)}件")
     else:
         print(f"不正な分析タイプ: {analysis_type}")
@@ -300,72 +306,123 @@ def filter_query_response_data(df, analysis_type="query"):
     
     return result_df
 
-def classify_by_network_and_calculate_magnitude(df):
-    """ネットワーク分類してマグニチュードを計算（応答パケット用）"""
-    if df.empty:
-        return {}
-    
-    # 応答パケットなので送信先IPアドレス（ip.dst）を分析対象とする
-    target_ip_column = "ip.dst"
-    
-    if target_ip_column not in df.columns:
-        print(f"警告: {target_ip_column}列が見つかりません")
-        return {}
-    
-    # IPアドレス分類を追加
-    df['network_type'] = df[target_ip_column].apply(classify_ip_address)
-    
-    # サブドメイン抽出
-    df['subdomain'] = df['dns.qry.name'].apply(lambda x: extract_subdomain(x) if pd.notnull(x) else None)
-    
-    # 有効なサブドメインのみ
-    df_valid = df[df['subdomain'].notnull()].copy()
-    
-    if df_valid.empty:
-        print("有効なサブドメインデータが見つかりませんでした")
-        return {}
-    
-    # ネットワークタイプ別の結果
+def _encode_magnitude_frame(df, table, target_ip_column="ip.dst"):
+    """
+    マグニチュード集計用に各行をコード化する。
+    クライアント（ip.dst、空なら ipv6.dst。ip.src なら ipv6.src）は辞書コード化し、ユニークなアドレスだけを範囲テーブルで分類。
+    サブドメインはユニークなクエリ名に対してのみ抽出する。
+    戻り値: (sub_codes, client_codes, network_codes, sub_names, label_names, n_clients)  欠損は -1
+    """
+    label_names = table_labels(table)
+    v6_column = target_ip_column.replace("ip.", "ipv6.", 1)
+    client_codes, keys = encode_clients(df, target_ip_column, v6_column)
+    key_labels = pd.Categorical(classify_keys(keys, table), categories=label_names)
+    network_codes = np.append(np.asarray(key_labels.codes, dtype=np.int64), -1)[client_codes]
+    
+    qname_codes, qnames = pd.factorize(df['dns.qry.name'])
+    subdomains = pd.Series([extract_subdomain(q) for q in qnames], dtype=object)
+    sub_codes_u, sub_names = pd.factorize(subdomains)
+    sub_codes = np.append(sub_codes_u, -1)[qname_codes]
+    return sub_codes, client_codes, network_codes, sub_names, label_names, len(keys)
+
+def grouped_distinct_counts(group_codes, sub_codes, client_codes, n_groups, n_subs, n_clients):
+    """
+    (グループ, サブドメイン, クライアント) のコードから、重複を除いたクライアント数を一括で数える。
+    有効なサブドメインの行だけを対象にする（コード -1 は対象外）。
+    戻り値: (ip_counts[グループ, サブドメイン], query_counts[グループ, サブドメイン], A_tots[グループ])
+    """
+    rows = (group_codes >= 0) & (sub_codes >= 0)
+    cells = group_codes[rows] * np.int64(n_subs) + sub_codes[rows]
+    query_counts = np.bincount(cells, minlength=n_groups * n_subs).reshape(n_groups, n_subs)
+    
+    with_client = client_codes[rows] >= 0
+    clients = client_codes[rows][with_client]
+    n = max(n_clients, 1)
+    triples = np.unique(cells[with_client] * n + clients)
+    ip_counts = np.bincount(triples // n, minlength=n_groups * n_subs).reshape(n_groups, n_subs)
+    group_clients = np.unique(group_codes[rows][with_client] * np.int64(n) + clients)
+    A_tots = np.bincount(group_clients // n, minlength=n_groups)
+    return ip_counts, query_counts, A_tots
+
+def _magnitude_by_group(group_names, ip_counts, query_counts, A_tots, sub_names, kind):
+    """グループ別に {サブドメイン: マグニチュード}（降順）を作る"""
     results = {}
-    
-    for network_type in ['internal', 'external', 'other']:
-        network_df = df_valid[df_valid['network_type'] == network_type].copy()
-        
-        if network_df.empty:
-            print(f"{network_type}ネットワークのデータが見つかりませんでした")
-            results[network_type] = {}
-            continue
-        
-        print(f"{network_type}ネットワーク: {len(network_df)}件")
-        
-        # 全ユニークIPアドレス
-        unique_ips = set(network_df[target_ip_column].unique())
-        A_tot = len(unique_ips)
-        
+    for i, group in enumerate(group_names):
+        A_tot = int(A_tots[i])
         if A_tot == 0:
-            results[network_type] = {}
+            print(f"{group}{kind}のデータが見つかりませんでした")
+            results[group] = {}
             continue
         
-        # サブドメインごとのIPアドレス集計
-        domain_ip_dict = network_df.groupby('subdomain')[target_ip_column].apply(set).to_dict()
+        print(f"{group}{kind}: {query_counts[i].sum()}件")
         
-        # マグニチュード計算
+        # マグニチュード計算（A_tot=1 のときは log(A_tot)=0 なので計算できない）
         magnitude_dict = {}
-        for domain, ip_set in domain_ip_dict.items():
-            ip_count = len(ip_set)
-            if ip_count > 0 and A_tot > 0:
-                magnitude = 10 * math.log(ip_count) / math.log(A_tot)
-                magnitude_dict[domain] = magnitude
+        if A_tot > 1:
+            for j in np.flatnonzero(ip_counts[i]):
+                magnitude_dict[sub_names[j]] = 10 * math.log(ip_counts[i, j]) / math.log(A_tot)
         
         # 降順ソート
-        results[network_type] = dict(sorted(magnitude_dict.items(), key=lambda item: item[1], reverse=True))
+        results[group] = dict(sorted(magnitude_dict.items(), key=lambda item: item[1], reverse=True))
         
-        print(f"{network_type}ネットワーク - 総IP数: {A_tot}, ドメイン数: {len(magnitude_dict)}")
-    
+        print(f"{group}{kind} - 総IP数: {A_tot}, ドメイン数: {len(magnitude_dict)}")
+    return results
+
+def classify_by_network_and_calculate_magnitude(df, table=None):
+    """
+    ネットワーク分類してマグニチュードを計算（応答パケット用）
+
+    table は netclass.load_prefix_table() の戻り値（省略時は学内・学外の 2 分類）。
+    ip.dst が空の行は ipv6.dst を使う。全ラベルのマグニチュードを 1 回の集計で求める。
+    戻り値: {ラベル: {サブドメイン: マグニチュード}}（テーブルのラベル + other）
+    """
+    results, _, _ = classify_by_network_and_vlan(df, table, by_vlan=False)
     return results
+
+def classify_by_network_and_vlan(df, table=None, by_vlan=True, target_ip_column="ip.dst"):
+    """
+    ネットワーク別に加えて VLAN（vlan.id）別のマグニチュードとクエリ数を同じコード化の結果から計算する。
+    VLAN が無い行は 'untagged' とする。クライアントは target_ip_column（応答なら ip.dst、問い合わせなら ip.src）。
+    戻り値: (network_results, vlan_results, vlan_counts)
+        network_results / vlan_results: {グループ: {サブドメイン: マグニチュード}}
+        vlan_counts: {VLAN: {サブドメイン: クエリ数}}
+    """
+    if df.empty:
+        return {}, {}, {}
     
-def write_network_magnitude_csv(results, date_str):
-    """ネットワーク別マグニチュード結果をCSVに書き込み"""
+    if target_ip_column not in df.columns:
+        print(f"警告: {target_ip_column}列が見つかりません")
+        return {}, {}, {}
+    
+    table = load_prefix_table() if table is None else table
+    sub_codes, client_codes, network_codes, sub_names, label_names, n_clients = \
+        _encode_magnitude_frame(df, table, target_ip_column)
+    
+    if not ((sub_codes >= 0) & (client_codes >= 0)).any():
+        print("有効なサブドメインデータが見つかりませんでした")
+        return {}, {}, {}
+    
+    n_subs = len(sub_names)
+    ip_counts, query_counts, A_tots = grouped_distinct_counts(
+        network_codes, sub_codes, client_codes, len(label_names), n_subs, n_clients)
+    results = _magnitude_by_group(label_names, ip_counts, query_counts, A_tots, sub_names, "ネットワーク")
+    
+    vlan_results, vlan_counts = {}, {}
+    if by_vlan:
+        if 'vlan.id' not in df.columns:
+            print("警告: vlan.id列が見つかりません")
+            return results, {}, {}
+        vlan_codes, vlan_names = pd.factorize(df['vlan.id'].fillna('untagged').astype(str))
+        ip_counts, query_counts, A_tots = grouped_distinct_counts(
+            vlan_codes, sub_codes, client_codes, len(vlan_names), n_subs, n_clients)
+        vlan_results = _magnitude_by_group(vlan_names, ip_counts, query_counts, A_tots, sub_names, " VLAN")
+        for i, vlan in enumerate(vlan_names):
+            vlan_counts[vlan] = {sub_names[j]: int(query_counts[i, j]) for j in np.flatnonzero(query_counts[i])}
+    
+    return results, vlan_results, vlan_counts
+    
+def write_network_magnitude_csv(results, where, date_str, analysis_type=None):
+    """ネットワーク別マグニチュード結果をCSVに書き込み（analysis_type を渡すとファイル名に query/response を含める）"""
     import csv
     
     # 出力ディレクトリ作成
@@ -376,7 +433,15 @@ def write_network_magnitude_csv(results, date_str):
         if not magnitude_dict:
             continue
         
-        filename = f"magnitude-{network_type}-{date_str}.csv"
+        warehouse.append('magnitude', magnitude_dict.items(), where=where, date=date_str,
+                         network_type=network_type, packet_type=analysis_type or '')
+        if not warehouse.csv_enabled():
+            continue
+        
+        if analysis_type:
+            filename = f"magnitude-{network_type}-{analysis_type}-{date_str}.csv"
+        else:
+            filename = f"magnitude-{network_type}-{date_str}.csv"
         output_path = os.path.join(output_dir, filename)
         
         with open(output_path, 'w', newline='', encoding='utf-8') as f:
@@ -389,9 +454,44 @@ def write_network_magnitude_csv(results, date_str):
         print(f"結果を保存: {output_path} ({len(magnitude_dict)}件)")
 
 
-def process_network_analysis_files(year, month, day, analysis_type="query", 
-                                 input_dir="/mnt/qnap2/shimada/resolver/"):
-    """ネットワーク分析のメイン処理"""
+def write_vlan_magnitude_csv(vlan_results, vlan_counts, where, date_str, analysis_type):
+    """VLAN 別のクエリ数とマグニチュードをウェアハウスに追記し、1 つのCSVに書き込み"""
+    for vlan, counts in vlan_counts.items():
+        warehouse.append('vlan_count', counts.items(), where=where, date=date_str,
+                         network_type=f"vlan-{vlan}", packet_type=analysis_type)
+        warehouse.append('vlan_magnitude', vlan_results.get(vlan, {}).items(), where=where, date=date_str,
+                         network_type=f"vlan-{vlan}", packet_type=analysis_type)
+    if not warehouse.csv_enabled():
+        return
+    
+    output_dir = "output/network_analysis"
+    os.makedirs(output_dir, exist_ok=True)
+    
+    output_path = os.path.join(output_dir, f"vlan-{analysis_type}-{date_str}.csv")
+    rows = 0
+    with open(output_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['vlan', 'date', 'subdomain', 'query_count', 'magnitude'])
+        
+        for vlan, counts in vlan_counts.items():
+            magnitude_dict = vlan_results.get(vlan, {})
+            for subdomain, count in sorted(counts.items(), key=lambda item: item[1], reverse=True):
+                magnitude = magnitude_dict.get(subdomain)
+                writer.writerow([vlan, date_str, subdomain, count,
+                                 f"{magnitude:.6f}" if magnitude is not None else ""])
+                rows += 1
+    
+    print(f"VLAN別の結果を保存: {output_path} ({rows}件)")
+
+def process_query_response_network_files(year, month, day, analysis_type="query",
+                                         input_dir="/mnt/qnap2/shimada/resolver-q-r/", prefix_table=None, where=1):
+    """
+    クエリ・レスポンス CSV（tshark-resovler-query-and-respons.sh の出力）のネットワーク分析。
+    ネットワーク別のマグニチュードと、VLAN 別のマグニチュード・クエリ数を同じ集計で出力する。
+    where: 入力のサーバー種別（0=権威、1=リゾルバ。resolver-q-r はリゾルバ）
+    """
+    table = load_prefix_table(prefix_table)
+    
     # パターンに一致するファイルを検索
     pattern = re.compile(rf"{year}-{month}-{day}-\d{{2}}\.csv")
     files = sorted(glob.glob(os.path.join(input_dir, "*.csv")))
@@ -435,11 +535,16 @@ def process_network_analysis_files(year, month, day, analysis_type="query",
             print(f"フィルタリング後のデータが見つかりませんでした: {date_str}")
             continue
         
-        # ネットワーク分類とマグニチュード計算
-        results = classify_by_network_and_calculate_magnitude(filtered_df, analysis_type)
+        # ネットワーク分類・VLAN別のマグニチュード計算
+        # 問い合わせは送信元、応答は送信先がクライアント
+        target_ip_column = "ip.src" if analysis_type == "query" else "ip.dst"
+        results, vlan_results, vlan_counts = classify_by_network_and_vlan(
+            filtered_df, table, target_ip_column=target_ip_column)
         
         # 結果をCSVに出力
-        write_network_magnitude_csv(results, date_str, analysis_type)
+        write_network_magnitude_csv(results, where, date_str, analysis_type)
+        if vlan_counts:
+            write_vlan_magnitude_csv(vlan_results, vlan_counts, where, date_str, analysis_type)
 
 # ===== ネットワーク分析統計関連 =====
 
@@ -542,8 +647,13 @@ def write_magnitude_statistics_csv(stats_results, network_type, start_date, end_
     
     print(f"統計結果を保存: {output_path}")
 
-def process_network_analysis_files(year, month, day, input_dir="/mnt/qnap2/shimada/resolver/"):
-    """ネットワーク分析のメイン処理"""
+def process_network_analysis_files(year, month, day, input_dir="/mnt/qnap2/shimada/resolver/", prefix_table=None, where=1):
+    """
+    ネットワーク分析のメイン処理（prefix_table: プレフィックス表ファイル。省略時は学内・学外の 2 分類）
+    where: 入力のサーバー種別（0=権威、1=リゾルバ。resolver/ はリゾルバ）
+    """
+    table = load_prefix_table(prefix_table)
+    
     # パターンに一致するファイルを検索
     pattern = re.compile(rf"{year}-{month}-{day}-\d{{2}}\.csv")
     files = sorted(glob.glob(os.path.join(input_dir, "*.csv")))
@@ -585,10 +695,10 @@ def process_network_analysis_files(year, month, day, input_dir="/mnt/qnap2/shima
             continue
         
         # ネットワーク分類とマグニチュード計算
-        results = classify_by_network_and_calculate_magnitude(combined_df)
+        results = classify_by_network_and_calculate_magnitude(combined_df, table)
         
         # 結果をCSVに出力
-        write_network_magnitude_csv(results, date_str)
+        write_network_magnitude_csv(results, where, date_str)
 
 def load_response_csv(file_path):
     """応答パケット用CSVファイルを安全に読み込み"""
@@ -22,6 +22,8 @@ DNS Magnitude統計分析ツール（権威/リゾルバ対応版）
     -w: サーバータイプ (0=権威サーバー, 1=リゾルバ)
     --input-dir: 入力ディレクトリ (デフォルト: /home/shimada/analysis/output/)
     --output-dir: 出力ディレクトリ (デフォルト: /home/shimada/code/refactored/output/magnitude_statistics/)
+    --state-dir: 集計状態の保存先。指定すると平均・分散の集計状態 (n, mean, m2) と日ごとの値を保存し、
+                 次回は未集計の日のファイルだけを読み込む（runstats.py。集計済みの日のファイルが変われば作り直す）
 
 例:
     # 2025年4月の権威サーバー統計を計算
@@ -35,12 +37,15 @@ import pandas as pd
 import glob
 import os
 import csv
-from collections import defaultdict
-import statistics
 from datetime import datetime, timedelta
 import argparse
 import re
 
+import warehouse
+from runstats import magnitude_statistics
+
+STAT_KEYS = ['mean', 'variance', 'std_dev', 'median', 'min', 'max', 'q25', 'q75', 'count']
+
 def parse_magnitude_filename(filename, where):
     """
     Magnitudeファイル名から日付を抽出
@@ -55,11 +60,18 @@ def parse_magnitude_filename(filename, where):
         return f"{year}-{month}-{day}"
     return None
 
+def append_statistics(subdomain_statistics, where, date, period):
+    """統計量をウェアハウスに追記する（key に統計量の名前、time_range に期間）"""
+    warehouse.append('magnitude_stats',
+                     [(subdomain, key, stats[key]) for subdomain, stats in subdomain_statistics.items()
+                      for key in STAT_KEYS],
+                     where=where, date=date, time_range=period)
+
 def get_server_type_label(where):
     """サーバータイプのラベルを取得"""
     return "権威サーバー" if where == 0 else "リゾルバ"
 
-def calculate_magnitude_statistics_range(start_date, end_date, where, input_dir, output_dir):
+def calculate_magnitude_statistics_range(start_date, end_date, where, input_dir, output_dir, state_dir=None):
     """
     指定した日付範囲のMagnitudeファイルから統計情報を計算
     
@@ -69,16 +81,14 @@ def calculate_magnitude_statistics_range(start_date, end_date, where, input_dir,
         where: 0=権威サーバー, 1=リゾルバ
         input_dir: Magnitudeファイルが格納されているディレクトリ
         output_dir: 結果を出力するディレクトリ
+        state_dir: 集計状態の保存先（指定時は未集計の日だけを読み込む）
     """
     
     # 日付文字列をdatetimeオブジェクトに変換
     start_dt = datetime.strptime(start_date, "%Y-%m-%d")
     end_dt = datetime.strptime(end_date, "%Y-%m-%d")
     
-    # サブドメインごとのMagnitude値を格納
-    subdomain_magnitudes = defaultdict(list)
-    
-    processed_files = []
+    entries = []
     missing_files = []
     
     server_type = get_server_type_label(where)
@@ -88,115 +98,62 @@ def calculate_magnitude_statistics_range(start_date, end_date, where, input_dir,
     print(f"入力ディレクトリ: {input_dir}")
     print(f"サーバータイプ: {server_type} (where={where})")
     
-    # 日付範囲内の各日を処理
+    # 日付範囲内の各日のファイル (形式: {where}-YYYY-MM-DD.csv)
     current_dt = start_dt
     while current_dt <= end_dt:
         date_str = current_dt.strftime("%Y-%m-%d")
-        
-        # ファイルパスを構築 (形式: {where}-YYYY-MM-DD.csv)
         csv_file_path = os.path.join(input_dir, f"{where}-{date_str}.csv")
-        
-        if not os.path.exists(csv_file_path):
+        if os.path.exists(csv_file_path):
+            entries.append((date_str, csv_file_path))
+        else:
             missing_files.append(csv_file_path)
-            current_dt += timedelta(days=1)
-            continue
-        
-        try:
-            # CSVファイルを読み込み
-            df = pd.read_csv(csv_file_path)
-            processed_files.append(csv_file_path)
-            
-            print(f"処理中: {os.path.basename(csv_file_path)} (レコード数: {len(df)})")
-            
-            # 各行を処理してサブドメインごとのMagnitude値を記録
-            for _, row in df.iterrows():
-                # カラム名の確認と取得
-                if 'subdomain' in df.columns:
-                    subdomain = str(row['subdomain']).strip()
-                elif 'domain' in df.columns:
-                    subdomain = str(row['domain']).strip()
-                else:
-                    print(f"警告: サブドメイン列が見つかりません")
-                    continue
-                
-                # magnitudeカラムの確認
-                if 'magnitude' in df.columns:
-                    magnitude = float(row['magnitude'])
-                elif 'dnsmagnitude' in df.columns:
-                    magnitude = float(row['dnsmagnitude'])
-                else:
-                    print(f"警告: magnitude列が見つかりません")
-                    continue
-                
-                subdomain_magnitudes[subdomain].append(magnitude)
-        
-        except Exception as e:
-            print(f"エラー: {csv_file_path} の処理中 - {str(e)}")
-        
         current_dt += timedelta(days=1)
     
-    print(f"\n処理完了: {len(processed_files)}ファイル")
+    period_str = f"{start_date}_to_{end_date}"
+    subdomain_statistics, processed_days = magnitude_statistics(
+        entries, state_dir, f"magnitude-statistics-{where}-{period_str}")
+    
+    print(f"\n処理完了: {processed_days}ファイル")
     if missing_files:
         print(f"欠落ファイル: {len(missing_files)}個")
         if len(missing_files) <= 5:
             for f in missing_files:
                 print(f"  - {os.path.basename(f)}")
     
-    if not subdomain_magnitudes:
+    if not subdomain_statistics:
         print("処理するデータが見つかりませんでした")
         return
     
-    # 統計情報を計算
-    subdomain_statistics = {}
-    
-    for subdomain, magnitudes in subdomain_magnitudes.items():
-        if len(magnitudes) == 0:
-            continue
-        
-        # 統計値を計算
-        stats = {
-            'mean': statistics.mean(magnitudes),
-            'variance': statistics.variance(magnitudes) if len(magnitudes) > 1 else 0.0,
-            'std_dev': statistics.stdev(magnitudes) if len(magnitudes) > 1 else 0.0,
-            'median': statistics.median(magnitudes),
-            'min': min(magnitudes),
-            'max': max(magnitudes),
-            'count': len(magnitudes),
-            'q25': pd.Series(magnitudes).quantile(0.25),
-            'q75': pd.Series(magnitudes).quantile(0.75)
-        }
-        
-        subdomain_statistics[subdomain] = stats
-    
     # 結果を出力ディレクトリに保存
     os.makedirs(output_dir, exist_ok=True)
-    period_str = f"{start_date}_to_{end_date}"
     output_csv_path = os.path.join(output_dir, f"magnitude-statistics-{where}-{period_str}.csv")
     
-    with open(output_csv_path, "w", newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow([
-            'server_type', 'period', 'subdomain', 'mean', 'variance', 'std_dev', 
-            'median', 'min', 'max', 'q25', 'q75', 'data_points'
-        ])
-        
-        # 平均値の降順でソート
-        for subdomain, stats in sorted(subdomain_statistics.items(), 
-                                      key=lambda x: x[1]['mean'], reverse=True):
+    append_statistics(subdomain_statistics, where, start_date, period_str)
+    if warehouse.csv_enabled():
+        with open(output_csv_path, "w", newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
             writer.writerow([
-                where,
-                period_str,
-                subdomain,
-                f"{stats['mean']:.6f}",
-                f"{stats['variance']:.6f}",
-                f"{stats['std_dev']:.6f}",
-                f"{stats['median']:.6f}",
-                f"{stats['min']:.6f}",
-                f"{stats['max']:.6f}",
-                f"{stats['q25']:.6f}",
-                f"{stats['q75']:.6f}",
-                stats['count']
+                'server_type', 'period', 'subdomain', 'mean', 'variance', 'std_dev', 
+                'median', 'min', 'max', 'q25', 'q75', 'data_points'
             ])
+        
+            # 平均値の降順でソート
+            for subdomain, stats in sorted(subdomain_statistics.items(), 
+                                          key=lambda x: x[1]['mean'], reverse=True):
+                writer.writerow([
+                    where,
+                    period_str,
+                    subdomain,
+                    f"{stats['mean']:.6f}",
+                    f"{stats['variance']:.6f}",
+                    f"{stats['std_dev']:.6f}",
+                    f"{stats['median']:.6f}",
+                    f"{stats['min']:.6f}",
+                    f"{stats['max']:.6f}",
+                    f"{stats['q25']:.6f}",
+                    f"{stats['q75']:.6f}",
+                    stats['count']
+                ])
     
     print(f"\n=== 統計結果サマリー ===")
     print(f"サーバータイプ: {server_type}")
@@ -224,7 +181,7 @@ def calculate_magnitude_statistics_range(start_date, end_date, where, input_dir,
               f"{stats['std_dev']:<10.4f} {stats['mean']:<10.4f}")
 
 def calculate_magnitude_statistics_pattern(year_pattern, month_pattern, day_pattern, 
-                                         where, input_dir, output_dir):
+                                         where, input_dir, output_dir, state_dir=None):
     """
     パターンマッチングによってファイルを選択し、統計情報を計算
     
@@ -235,6 +192,7 @@ def calculate_magnitude_statistics_pattern(year_pattern, month_pattern, day_patt
         where: 0=権威サーバー, 1=リゾルバ
         input_dir: Magnitudeファイルが格納されているディレクトリ
         output_dir: 結果を出力するディレクトリ
+        state_dir: 集計状態の保存先（指定時は未集計の日だけを読み込む）
     """
     
     # ファイルパターンを構築
@@ -254,98 +212,47 @@ def calculate_magnitude_statistics_pattern(year_pattern, month_pattern, day_patt
     print(f"パターン: {where}-{year_pattern}-{month_pattern}-{day_pattern}")
     print(f"一致ファイル数: {len(matching_files)}")
     
-    # サブドメインごとのMagnitude値を格納
-    subdomain_magnitudes = defaultdict(list)
-    processed_files = []
-    
-    for csv_file_path in matching_files:
-        try:
-            # CSVファイルを読み込み
-            df = pd.read_csv(csv_file_path)
-            processed_files.append(csv_file_path)
-            
-            # ファイル名から日付を取得
-            date_str = parse_magnitude_filename(csv_file_path, where)
-            print(f"処理中: {os.path.basename(csv_file_path)} (レコード数: {len(df)})")
-            
-            # 各行を処理
-            for _, row in df.iterrows():
-                # カラム名の確認と取得
-                if 'subdomain' in df.columns:
-                    subdomain = str(row['subdomain']).strip()
-                elif 'domain' in df.columns:
-                    subdomain = str(row['domain']).strip()
-                else:
-                    continue
-                
-                # magnitudeカラムの確認
-                if 'magnitude' in df.columns:
-                    magnitude = float(row['magnitude'])
-                elif 'dnsmagnitude' in df.columns:
-                    magnitude = float(row['dnsmagnitude'])
-                else:
-                    continue
-                
-                subdomain_magnitudes[subdomain].append(magnitude)
-        
-        except Exception as e:
-            print(f"エラー: {csv_file_path} の処理中 - {str(e)}")
+    entries = [(parse_magnitude_filename(path, where) or os.path.basename(path), path)
+               for path in matching_files]
+    pattern_str = f"{year_pattern}-{month_pattern}-{day_pattern}"
+    subdomain_statistics, processed_days = magnitude_statistics(
+        entries, state_dir, f"magnitude-statistics-{where}-{pattern_str}")
     
-    print(f"\n処理完了: {len(processed_files)}ファイル")
+    print(f"\n処理完了: {processed_days}ファイル")
     
-    if not subdomain_magnitudes:
+    if not subdomain_statistics:
         print("処理するデータが見つかりませんでした")
         return
     
-    # 統計情報を計算
-    subdomain_statistics = {}
-    
-    for subdomain, magnitudes in subdomain_magnitudes.items():
-        if len(magnitudes) == 0:
-            continue
-        
-        stats = {
-            'mean': statistics.mean(magnitudes),
-            'variance': statistics.variance(magnitudes) if len(magnitudes) > 1 else 0.0,
-            'std_dev': statistics.stdev(magnitudes) if len(magnitudes) > 1 else 0.0,
-            'median': statistics.median(magnitudes),
-            'min': min(magnitudes),
-            'max': max(magnitudes),
-            'count': len(magnitudes),
-            'q25': pd.Series(magnitudes).quantile(0.25),
-            'q75': pd.Series(magnitudes).quantile(0.75)
-        }
-        
-        subdomain_statistics[subdomain] = stats
-    
     # 結果を保存
     os.makedirs(output_dir, exist_ok=True)
-    pattern_str = f"{year_pattern}-{month_pattern}-{day_pattern}"
     output_csv_path = os.path.join(output_dir, f"magnitude-statistics-{where}-{pattern_str}.csv")
     
-    with open(output_csv_path, "w", newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow([
-            'server_type', 'pattern', 'subdomain', 'mean', 'variance', 'std_dev', 
-            'median', 'min', 'max', 'q25', 'q75', 'data_points'
-        ])
-        
-        for subdomain, stats in sorted(subdomain_statistics.items(), 
-                                      key=lambda x: x[1]['mean'], reverse=True):
+    append_statistics(subdomain_statistics, where, pattern_str, pattern_str)
+    if warehouse.csv_enabled():
+        with open(output_csv_path, "w", newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
             writer.writerow([
-                where,
-                pattern_str,
-                subdomain,
-                f"{stats['mean']:.6f}",
-                f"{stats['variance']:.6f}",
-                f"{stats['std_dev']:.6f}",
-                f"{stats['median']:.6f}",
-                f"{stats['min']:.6f}",
-                f"{stats['max']:.6f}",
-                f"{stats['q25']:.6f}",
-                f"{stats['q75']:.6f}",
-                stats['count']
+                'server_type', 'pattern', 'subdomain', 'mean', 'variance', 'std_dev', 
+                'median', 'min', 'max', 'q25', 'q75', 'data_points'
             ])
+        
+            for subdomain, stats in sorted(subdomain_statistics.items(), 
+                                          key=lambda x: x[1]['mean'], reverse=True):
+                writer.writerow([
+                    where,
+                    pattern_str,
+                    subdomain,
+                    f"{stats['mean']:.6f}",
+                    f"{stats['variance']:.6f}",
+                    f"{stats['std_dev']:.6f}",
+                    f"{stats['median']:.6f}",
+                    f"{stats['min']:.6f}",
+                    f"{stats['max']:.6f}",
+                    f"{stats['q25']:.6f}",
+                    f"{stats['q75']:.6f}",
+                    stats['count']
+                ])
     
     print(f"\n統計結果を保存: {output_csv_path}")
     print(f"サーバータイプ: {server_type}")
@@ -388,6 +295,8 @@ def main():
     parser.add_argument('--output-dir', 
                        default='/home/shimada/output/magnitude_statistics/',
                        help='統計結果を出力するディレクトリ')
+    parser.add_argument('--state-dir',
+                       help='集計状態の保存先（指定時は未集計の日だけを読み込む）')
     
     args = parser.parse_args()
     
@@ -399,7 +308,7 @@ def main():
         
         calculate_magnitude_statistics_range(
             args.start_date, args.end_date, args.w,
-            args.input_dir, args.output_dir
+            args.input_dir, args.output_dir, args.state_dir
         )
     
     elif args.mode == 'pattern':
@@ -410,7 +319,7 @@ def main():
         
         calculate_magnitude_statistics_pattern(
             args.y, args.m, args.d, args.w,
-            args.input_dir, args.output_dir
+            args.input_dir, args.output_dir, args.state_dir
         )
     
     return 0
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+整数コード化した配列で DNS Magnitude を計算するエンジン（ブートストラップ信頼区間付き）
+
+new-tshark-mag.py と同じ定義
+    magnitude = 10 * log(|そのサブドメインを問い合わせたクライアント|) / log(A_tot)
+を、サブドメイン・クライアントを pandas.factorize で整数コードに変換してから
+np.unique / np.bincount で計算する。set の辞書を作らないため 1 日分でも高速。
+
+--bootstrap N を指定すると、クライアント（行ではない）を復元抽出した N 回の複製から
+サブドメインごとの信頼区間を求める。複製はプロセスプールで並列に計算し、
+--seed が同じなら並列数に関わらず同じ結果になる。
+
+--client-prefix 24/64 のように指定すると、アドレスを IPv4 /24・IPv6 /64 のプレフィックスに
+まとめてから数えた Magnitude も出力する（DHCP や IPv6 一時アドレスによる水増しの比較用）。
+複数指定でき、読み込み・コード化は 1 回だけで、ユニークなアドレスのマスクだけを変えて集計する。
+
+入力: /mnt/qnap2/shimada/input/ (where=0) または /mnt/qnap2/shimada/resolver/ (where=1) の
+      YYYY-MM-DD-HH.csv（列: ip.dst, ipv6.dst, dns.qry.name を使用）
+
+クライアントは ip.dst、それが空なら ipv6.dst のアドレスとし（netclass.encode_clients）、
+IPv4 / IPv6 をまとめて 1 つの整数コードにする。
+出力:
+  - {output_dir}/{where}-YYYY-MM-DD.csv     （列: day,domain,dnsmagnitude  ※new-tshark-mag.py と同形式）
+  - {output_dir}/ci-{where}-YYYY-MM-DD.csv  （--bootstrap 指定時。列: day,domain,dnsmagnitude,
+                                              boot_mean,boot_std,ci_low,ci_high,replicates）
+  - {output_dir}/prefix-{where}-YYYY-MM-DD.csv（--client-prefix 指定時。列: day,prefix,domain,
+                                              clients,A_tot,dnsmagnitude）
+ウェアハウスには magnitude / magnitude_ci（key に CI_KEYS の統計量名）/ magnitude_prefix（key にプレフィックス）で追記し、
+DNSMAG_WRITE_CSV=0 のときは CSV を書かない。
+
+実行例:
+    python3 magnitude_engine.py -y 2025 -m 04 -d 01 -w 1
+    python3 magnitude_engine.py -y 2025 -m 04 -d 01 -w 1 --bootstrap 1000 --seed 42 --workers 8
+    python3 magnitude_engine.py -y 2025 -m 04 -d 01 -w 1 --client-prefix 24/64 24/56 24/48
+"""
+
+import os
+import re
+import csv
+import glob
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import netclass
+import csvarchive
+import memo
+import warehouse
+from netclass import encode_clients, prefix_codes
+from csvarchive import ARCHIVE_SUFFIX, read_hourly
+
+INPUT_DIRS = {
+    0: "/mnt/qnap2/shimada/input/",     # 権威
+    1: "/mnt/qnap2/shimada/resolver/",  # リゾルバ
+}
+OUTPUT_DIR = "/home/shimada/analysis/output"
+
+# ブートストラップ複製をワーカーに配る単位（並列数に依存せず乱数列を固定するため一定値にする）
+BOOTSTRAP_CHUNK = 50
+# 信頼区間の CSV の列のうちウェアハウスに key として入れるもの
+CI_KEYS = ["boot_mean", "boot_std", "ci_low", "ci_high", "replicates"]
+
+# ==== 入力 ====
+
+def hourly_files(year, month, day, where, input_dir=None):
+    """指定日の YYYY-MM-DD-HH.csv（アーカイブ済みなら .csv.bgz）を時刻順に返す"""
+    input_dir = input_dir or INPUT_DIRS[int(where)]
+    pat = re.compile(rf"({year}-{month}-{day}-\d{{2}})\.csv(\.bgz)?")
+    files = {}
+    for f in sorted(glob.glob(os.path.join(input_dir, "*.csv*"))):
+        m = pat.fullmatch(os.path.basename(f))
+        # 同じ時間に両方ある場合（変換途中）はアーカイブを使う
+        if m and (m.group(1) not in files or f.endswith(ARCHIVE_SUFFIX)):
+            files[m.group(1)] = f
+    return [files[k] for k in sorted(files)]
+
+
+def load_columns(files, columns=("ip.dst", "ipv6.dst", "dns.qry.name")):
+    """必要な列だけを文字列として読み込み、縦結合する（ファイルに無い列は読まない）"""
+    frames = []
+    for path in files:
+        try:
+            frames.append(read_hourly(path, usecols=lambda c: c in columns))
+        except Exception as e:
+            print(f"[WARN] 読み込み失敗: {path}: {e}")
+    if not frames:
+        return pd.DataFrame(columns=list(columns))
+    return pd.concat(frames, ignore_index=True)
+
+
+def extract_subdomain(qname):
+    """new-tshark-mag.py と同じ規則で最上位サブドメインを抽出"""
+    suffix = '.tsukuba.ac.jp'
+    if isinstance(qname, str):
+        qname_lower = qname.lower()
+        if qname_lower.count(suffix) != 1:
+            return None
+        if qname_lower.endswith(suffix):
+            qname_no_suffix = qname_lower[:-len(suffix)]
+            if qname_no_suffix.endswith('.'):
+                qname_no_suffix = qname_no_suffix[:-1]
+            if qname_no_suffix:
+                return qname_no_suffix.split('.')[-1]
+    return None
+
+# ==== 整数コード化 ====
+
+def subdomain_codes(qnames: pd.Series):
+    """
+    qname 列をサブドメインの整数コードに変換する。
+    extract_subdomain はユニークな qname にだけ適用する（行数ではなく種類数に比例）。
+    戻り値: (codes, subdomains)  codes は対象外の行が -1
+    """
+    qname_codes, qname_uniques = pd.factorize(qnames)
+    subs = pd.Series(qname_uniques, dtype=object).map(extract_subdomain)
+    sub_of_qname, subdomains = pd.factorize(subs)
+    # factorize の欠損(-1) を末尾に置き、qname 欠損(-1) と同じく -1 を引けるようにする
+    lookup = np.append(sub_of_qname, -1)
+    return lookup[qname_codes], np.asarray(subdomains, dtype=object)
+
+
+def encode_frame(df: pd.DataFrame, qname_col="dns.qry.name"):
+    """
+    DataFrame を (sub_codes, client_codes, subdomains, client_keys) に変換する（A_tot = len(client_keys)）。
+    A_tot は new-tshark-mag.py と同様に、サブドメイン抽出前の全行のクライアント数とする。
+    ip.dst / ipv6.dst が両方とも欠損・不正な行はクライアントとして数えず除外する。
+    """
+    client_codes, client_keys = encode_clients(df)
+    sub_codes, subdomains = subdomain_codes(df[qname_col])
+    return sub_codes, client_codes, subdomains, client_keys
+
+
+def distinct_pairs(sub_codes, client_codes, n_clients):
+    """(サブドメイン, クライアント) の重複を除いた組を返す: (pair_sub, pair_client)"""
+    valid = (sub_codes >= 0) & (client_codes >= 0)
+    keys = sub_codes[valid].astype(np.int64) * max(n_clients, 1) + client_codes[valid]
+    keys = np.unique(keys)
+    return keys // max(n_clients, 1), keys % max(n_clients, 1)
+
+# ==== Magnitude ====
+
+def magnitude_from_counts(counts, A_tot):
+    """クライアント数の配列から magnitude を計算（クライアント 0 のサブドメインは NaN）"""
+    counts = np.asarray(counts, dtype=np.float64)
+    if A_tot <= 1:
+        return np.where(counts > 0, 0.0, np.nan)
+    with np.errstate(divide="ignore"):
+        return np.where(counts > 0, 10.0 * np.log(counts) / np.log(A_tot), np.nan)
+
+
+def compute_magnitude(pair_sub, n_sub, A_tot):
+    """サブドメインごとのユニーククライアント数と magnitude を返す"""
+    counts = np.bincount(pair_sub, minlength=n_sub)
+    return counts, magnitude_from_counts(counts, A_tot)
+
+# ==== プレフィックス集約 ====
+
+def parse_prefix_spec(spec):
+    """'24/64' → (24, 64)  （IPv4 のプレフィックス長 / IPv6 のプレフィックス長）"""
+    try:
+        v4_len, v6_len = (int(x) for x in spec.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'V4/V6' の形式で指定してください: {spec}")
+    if not (0 <= v4_len <= 32 and 0 <= v6_len <= 128):
+        raise argparse.ArgumentTypeError(f"プレフィックス長が範囲外です: {spec}")
+    return v4_len, v6_len
+
+
+def prefix_magnitude(sub_codes, client_codes, client_keys, n_sub, specs):
+    """
+    クライアントをプレフィックスにまとめた Magnitude を specs [(v4_len, v6_len), ...] ごとに計算する。
+    マスクはユニークなアドレスキーにだけかけ、行のコードは添字で付け替える。
+    戻り値: DataFrame(columns=[prefix, sub, clients, A_tot, dnsmagnitude])
+    """
+    frames = []
+    for v4_len, v6_len in specs:
+        codes_of_client, n_prefixes = prefix_codes(client_keys, v4_len, v6_len)
+        codes = np.append(codes_of_client, -1)[client_codes]
+        pair_sub, _ = distinct_pairs(sub_codes, codes, n_prefixes)
+        counts, magnitudes = compute_magnitude(pair_sub, n_sub, n_prefixes)
+        frames.append(pd.DataFrame({
+            "prefix": f"{v4_len}/{v6_len}",
+            "sub": np.arange(n_sub),
+            "clients": counts,
+            "A_tot": n_prefixes,
+            "dnsmagnitude": magnitudes,
+        }))
+        print(f"/{v4_len}, /{v6_len}: A_tot {n_prefixes:,}")
+    return pd.concat(frames, ignore_index=True)
+
+# ==== ブートストラップ ====
+
+_boot_arrays = {}
+
+def _init_bootstrap_worker(pair_sub, pair_client, n_sub, n_clients):
+    _boot_arrays.update(pair_sub=pair_sub, pair_client=pair_client, n_sub=n_sub, n_clients=n_clients)
+
+
+def _bootstrap_chunk(seed_seq, replicates):
+    """
+    クライアントを復元抽出した複製を replicates 回分計算する。
+    抽出されたクライアントは重複も別クライアントとして扱うため、
+    各サブドメインのクライアント数は「抽出回数の重み付き和」、A_tot は元と同じ値になる。
+    """
+    pair_sub = _boot_arrays["pair_sub"]
+    pair_client = _boot_arrays["pair_client"]
+    n_sub = _boot_arrays["n_sub"]
+    n_clients = _boot_arrays["n_clients"]
+
+    rng = np.random.default_rng(seed_seq)
+    out = np.empty((replicates, n_sub), dtype=np.float32)
+    uniform = np.full(n_clients, 1.0 / n_clients)
+    for i in range(replicates):
+        weights = rng.multinomial(n_clients, uniform)
+        counts = np.bincount(pair_sub, weights=weights[pair_client], minlength=n_sub)
+        # 1 度も抽出されなかったサブドメインは最小値 0 として扱う
+        out[i] = np.nan_to_num(magnitude_from_counts(counts, n_clients), nan=0.0)
+    return out
+
+
+def bootstrap_magnitude(pair_sub, pair_client, n_sub, n_clients,
+                        replicates=1000, seed=None, workers=None, ci=0.95):
+    """
+    クライアント単位のブートストラップでサブドメインごとの信頼区間を計算する。
+    戻り値: DataFrame(columns=[boot_mean, boot_std, ci_low, ci_high])  index=サブドメインコード
+    """
+    if n_clients == 0 or n_sub == 0:
+        return pd.DataFrame(columns=["boot_mean", "boot_std", "ci_low", "ci_high"], index=range(n_sub))
+
+    chunks = [BOOTSTRAP_CHUNK] * (replicates // BOOTSTRAP_CHUNK)
+    if replicates % BOOTSTRAP_CHUNK:
+        chunks.append(replicates % BOOTSTRAP_CHUNK)
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+
+    init_args = (pair_sub.astype(np.int32), pair_client.astype(np.int64), n_sub, n_clients)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_bootstrap_worker,
+                             initargs=init_args) as pool:
+        samples = np.vstack(list(pool.map(_bootstrap_chunk, seeds, chunks)))
+
+    alpha = (1.0 - ci) / 2.0
+    low, high = np.quantile(samples, [alpha, 1.0 - alpha], axis=0)
+    return pd.DataFrame({
+        "boot_mean": samples.mean(axis=0),
+        "boot_std": samples.std(axis=0, ddof=1),
+        "ci_low": low,
+        "ci_high": high,
+    })
+
+# ==== 出力 ====
+
+def write_daily_magnitude(subdomains, magnitudes, day, output_path, where=-1, date_str=""):
+    """new-tshark-mag.py と同じ形式（day,domain,dnsmagnitude）で降順に書き出す（ウェアハウスにも追記）"""
+    valid = ~np.isnan(magnitudes)
+    warehouse.append('magnitude', zip(subdomains[valid], magnitudes[valid]), where=where, date=date_str)
+    if not warehouse.csv_enabled():
+        return
+    order = np.argsort(-np.nan_to_num(magnitudes, nan=-np.inf), kind="stable")
+    with open(output_path, "w", newline='') as f:
+        writer = csv.writer(f, delimiter=',')
+        writer.writerow(['day', 'domain', 'dnsmagnitude'])
+        for i in order:
+            if not np.isnan(magnitudes[i]):
+                writer.writerow([f"{day}", subdomains[i], str(magnitudes[i])])
+
+
+def run_day(args, files, date_str, day):
+    """1 日分の Magnitude（と指定があればプレフィックス集約・信頼区間）を計算して書き出す"""
+    df = load_columns(files)
+    sub_codes, client_codes, subdomains, client_keys = encode_frame(df)
+    n_clients = len(client_keys)
+    pair_sub, pair_client = distinct_pairs(sub_codes, client_codes, n_clients)
+    counts, magnitudes = compute_magnitude(pair_sub, len(subdomains), n_clients)
+    print(f"行数: {len(df):,}, A_tot: {n_clients:,}, サブドメイン数: {len(subdomains):,}")
+
+    output_path = os.path.join(args.output_dir, f"{args.w}-{date_str}.csv")
+    write_daily_magnitude(subdomains, magnitudes, day, output_path, args.w, date_str)
+    print(f"結果を保存しました: {output_path}")
+
+    if args.client_prefix:
+        pm = prefix_magnitude(sub_codes, client_codes, client_keys, len(subdomains), args.client_prefix)
+        pm = pm.dropna(subset=["dnsmagnitude"])
+        pm.insert(2, "domain", subdomains[pm["sub"].to_numpy()])
+        pm.insert(0, "day", day)
+        pm = pm.drop(columns="sub").sort_values(["prefix", "dnsmagnitude"], ascending=[True, False])
+        warehouse.append('magnitude_prefix', pm[["domain", "prefix", "dnsmagnitude"]].itertuples(index=False, name=None),
+                         where=args.w, date=date_str)
+        if warehouse.csv_enabled():
+            prefix_path = os.path.join(args.output_dir, f"prefix-{args.w}-{date_str}.csv")
+            pm.to_csv(prefix_path, index=False)
+            print(f"プレフィックス集約の結果を保存しました: {prefix_path}")
+
+    if args.bootstrap > 0:
+        print(f"ブートストラップ: {args.bootstrap}回 (seed={args.seed})")
+        ci = bootstrap_magnitude(pair_sub, pair_client, len(subdomains), n_clients,
+                                 args.bootstrap, args.seed, args.workers, args.ci)
+        ci.insert(0, "dnsmagnitude", magnitudes)
+        ci.insert(0, "domain", subdomains)
+        ci.insert(0, "day", day)
+        ci["replicates"] = args.bootstrap
+        ci = ci.dropna(subset=["dnsmagnitude"]).sort_values("dnsmagnitude", ascending=False)
+        # ウェアハウスには key に統計量の名前（boot_mean / boot_std / ci_low / ci_high / replicates）で追記する
+        warehouse.append('magnitude_ci',
+                         [(domain, key, value) for key in CI_KEYS for domain, value in zip(ci["domain"], ci[key])],
+                         where=args.w, date=date_str)
+        if warehouse.csv_enabled():
+            ci_path = os.path.join(args.output_dir, f"ci-{args.w}-{date_str}.csv")
+            ci.to_csv(ci_path, index=False, float_format="%.6f")
+            print(f"信頼区間を保存しました: {ci_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='整数コード化によるDNS Magnitude計算（ブートストラップCI対応）')
+    parser.add_argument('-y', help='year', required=True)
+    parser.add_argument('-m', help='month', required=True)
+    parser.add_argument('-d', help='day', required=True)
+    parser.add_argument('-w', type=int, choices=[0, 1], required=True, help='0は権威1はリゾルバ')
+    parser.add_argument('--input-dir', help='入力ディレクトリ（省略時は where から決定）')
+    parser.add_argument('--output-dir', default=OUTPUT_DIR, help=f'出力ディレクトリ（デフォルト: {OUTPUT_DIR}）')
+    parser.add_argument('--bootstrap', type=int, default=0, help='ブートストラップ複製数（0で無効）')
+    parser.add_argument('--seed', type=int, default=None, help='乱数シード（再現用）')
+    parser.add_argument('--workers', type=int, default=None, help='ブートストラップの並列プロセス数')
+    parser.add_argument('--ci', type=float, default=0.95, help='信頼区間の水準（デフォルト: 0.95）')
+    parser.add_argument('--client-prefix', nargs='+', type=parse_prefix_spec, default=[], metavar='V4/V6',
+                        help='クライアントをプレフィックスにまとめて数える（例: 24/64 24/48。複数指定可）')
+    args = parser.parse_args()
+
+    year, month, day = args.y, args.m.zfill(2), args.d.zfill(2)
+    date_str = f"{year}-{month}-{day}"
+
+    files = hourly_files(year, month, day, args.w, args.input_dir)
+    if not files:
+        print(f"対象ファイルが見つかりませんでした: {date_str}")
+        return 1
+    print(f"処理対象ファイル数: {len(files)}")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    outputs = [os.path.join(args.output_dir, f"{args.w}-{date_str}.csv")]
+    if args.client_prefix:
+        outputs.append(os.path.join(args.output_dir, f"prefix-{args.w}-{date_str}.csv"))
+    if args.bootstrap > 0:
+        outputs.append(os.path.join(args.output_dir, f"ci-{args.w}-{date_str}.csv"))
+    # 入力・パラメータ・コードが前回と同じなら計算せずにキャッシュから出力を戻す
+    params = {"w": args.w, "client_prefix": args.client_prefix, "bootstrap": args.bootstrap,
+              "seed": args.seed, "ci": args.ci}
+    memo.run_cached("magnitude_engine", date_str, files, params,
+                    [__file__, netclass.__file__, csvarchive.__file__], outputs,
+                    lambda: run_day(args, files, date_str, day))
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -5,7 +5,8 @@ import argparse
 import glob
 from pathlib import Path
 import pandas as pd
-import matplotlib.pyplot as plt
+
+from render import figure_job, new_figure, render_all
 
 def load_month_df(base_dir: Path, typ: int, year: int, month: int) -> pd.DataFrame:
     """Load daily CSVs for a given month and concatenate them"""
@@ -45,14 +46,17 @@ def compute_domain_stats(df: pd.DataFrame) -> pd.DataFrame:
     return out
 
 def plot_two_boxplots_side_by_side(
-    data_left, data_right, labels=("Authoritative", "Resolver"),
-    title="", ylabel="", ylimit=None, outfile="plot.png"
+    stats_left, stats_right, column, labels=("Authoritative", "Resolver"),
+    title="", ylabel="", ylimit=None
 ):
-    """Draw two side-by-side boxplots"""
-    fig, ax = plt.subplots(figsize=(8, 5))
+    """Draw two side-by-side boxplots of `column` from the two domain stats tables"""
+    data_left = stats_left[column].dropna().values
+    data_right = stats_right[column].dropna().values
+    fig = new_figure((8, 5))
+    ax = fig.subplots()
     
     # 箱ひげ図の幅を広げて間隔を詰める
-    bp = ax.boxplot([data_left, data_right], labels=labels, showfliers=True, widths=0.6)
+    bp = ax.boxplot([data_left, data_right], tick_labels=labels, showfliers=True, widths=0.6)
 
     # Bold font for title, ylabel, and x-axis labels
     ax.set_title(title, fontweight="bold", fontsize=14)
@@ -71,9 +75,7 @@ def plot_two_boxplots_side_by_side(
 
     ax.grid(axis="y", linestyle=":", alpha=0.6)
     fig.tight_layout()
-    fig.savefig(outfile, dpi=200)
-    plt.close(fig)
-    print(f"[INFO] saved: {outfile}")
+    return fig
 
 def main():
     parser = argparse.ArgumentParser(
@@ -83,6 +85,8 @@ def main():
     parser.add_argument("--year", type=int, default=2025, help="Year (YYYY)")
     parser.add_argument("--month", type=int, default=4, help="Month (MM)")
     parser.add_argument("--out-dir", default=".", help="Output directory")
+    parser.add_argument("--workers", type=int, default=None, help="Processes used to draw the figures (default: CPU count)")
+    parser.add_argument("--force", action="store_true", help="Redraw figures even if their input CSVs are unchanged")
     args = parser.parse_args()
 
     base_dir = Path(args.base_dir)
@@ -122,31 +126,32 @@ def main():
     stats_reso_std.to_csv(csv_reso_std, index=False)
     print(f"[INFO] saved: {csv_reso_std}")
 
-    # ---- Mean boxplot ----
-    means_auth = stats_auth["mean"].dropna().values
-    means_reso = stats_reso["mean"].dropna().values
-    plot_two_boxplots_side_by_side(
-        data_left=means_auth,
-        data_right=means_reso,
+    # ---- Boxplots (drawn in parallel from the CSVs above; unchanged ones are skipped) ----
+    jobs = []
+    jobs.append(figure_job(
+        plot_two_boxplots_side_by_side,
+        output=str(out_dir / "mag_month_boxplot_mean.pdf"),
+        tables=[csv_auth_mean, csv_reso_mean],
+        dpi=200,
+        column="mean",
         labels=("Authoritative", "Resolver"),
         # title=f"Domain-wise Monthly Mean of DNS Magnitude ({args.year}-{args.month:02d})",
         ylabel="Mean",
         ylimit=(0, 10),
-        outfile=str(out_dir / "mag_month_boxplot_mean.pdf"),
-    )
-
-    # ---- Std dev boxplot ----
-    stds_auth = stats_auth["std"].dropna().values
-    stds_reso = stats_reso["std"].dropna().values
-    plot_two_boxplots_side_by_side(
-        data_left=stds_auth,
-        data_right=stds_reso,
+    ))
+
+    jobs.append(figure_job(
+        plot_two_boxplots_side_by_side,
+        output=str(out_dir / "mag_month_boxplot_std.pdf"),
+        tables=[csv_auth_std, csv_reso_std],
+        dpi=200,
+        column="std",
         labels=("Authoritative", "Resolver"),
         # title=f"Domain-wise Monthly Std Dev of DNS Magnitude ({args.year}-{args.month:02d})",
         ylabel="Std Dev",
         ylimit=None,
-        outfile=str(out_dir / "mag_month_boxplot_std.pdf"),
-    )
+    ))
+    render_all(jobs, workers=args.workers, force=args.force)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+メモリ上限（--memory-budget）に合わせた読み込み量・並列数の決定
+
+1 日分を pd.concat してから集計すると、クエリの多い日（試験期間・障害時）にメモリが足りず OOM で落ちる。
+ここでは
+  - 実際の読み込み形式（必要な列だけの文字列 DataFrame）での 1 行あたりのバイト数を先頭の行から見積もり
+  - 上限 ÷ 並列数 に収まる 1 回の読み込み行数（チャンク）を決め、収まらなければ並列数を減らす
+  - 時間ごとのファイルをチャンクごとに読んで集計する
+multi_analysis.py / backfill.py の --memory-budget から使う。中間の集計（rollup の集計）が大きくなったときの
+ディスクへの退避は multi_analysis.run_day で行う。
+
+実行の終わりに resource.getrusage で最大 RSS を表示する。
+"""
+
+import os
+import resource
+
+import numpy as np
+import pandas as pd
+
+from csvarchive import ARCHIVE_SUFFIX, INDEX_SUFFIX, read_index
+
+SAMPLE_ROWS = 20000
+MIN_CHUNK_ROWS = 50000
+# 集計中はコード化・ユニーク化の中間配列が読み込んだ DataFrame の数倍になるため、その分を見込む
+WORK_FACTOR = 4
+# 上限のうち読み込み・集計に使う割合（残りはインタプリタ本体と、保持している時間ごとの集計）
+READ_FRACTION = 0.5
+
+_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(value):
+    """'8G', '512M', '1073741824' などをバイト数にする（argparse の type に使う）"""
+    s = str(value).strip().upper().rstrip("B")
+    unit = s[-1] if s and s[-1] in _UNITS else ""
+    try:
+        return int(float(s[:len(s) - len(unit)]) * _UNITS[unit])
+    except ValueError:
+        raise ValueError(f"サイズの形式が不正です: {value}")
+
+# ==== 見積もり ====
+
+def _read_sample(path, columns, nrows):
+    compression = "gzip" if path.endswith(ARCHIVE_SUFFIX) else None
+    return pd.read_csv(path, dtype=str, usecols=lambda c: c in columns, nrows=nrows, compression=compression)
+
+
+def estimate_row_bytes(path, columns, sample_rows=SAMPLE_ROWS):
+    """先頭 sample_rows 行を読み、必要な列だけの DataFrame での 1 行あたりのバイト数を返す"""
+    sample = _read_sample(path, columns, sample_rows)
+    if sample.empty:
+        return 0
+    return int(np.ceil(sample.memory_usage(index=False, deep=True).sum() / len(sample)))
+
+
+def estimate_rows(path, sample_rows=SAMPLE_ROWS):
+    """ファイルの行数（アーカイブは索引の合計、CSV はファイルサイズと先頭の行の長さからの見積もり）"""
+    if path.endswith(ARCHIVE_SUFFIX) and os.path.exists(path + INDEX_SUFFIX):
+        return int(read_index(path)["rows"].sum())
+    with open(path, "rb") as f:
+        f.readline()
+        lines = [line for _, line in zip(range(sample_rows), f)]
+    if not lines:
+        return 0
+    return int(os.path.getsize(path) / (sum(map(len, lines)) / len(lines)))
+
+
+def plan(budget, row_bytes, jobs=1):
+    """
+    上限 budget（バイト）と 1 行のバイト数から (1 回に読む行数, 並列数) を決める。
+    並列数を減らしても MIN_CHUNK_ROWS に届かない場合は、並列数 1 でその上限内の行数にする。
+    """
+    per_row = max(row_bytes, 1) * WORK_FACTOR
+    jobs = max(int(jobs), 1)
+    while jobs > 1 and budget * READ_FRACTION / jobs / per_row < MIN_CHUNK_ROWS:
+        jobs -= 1
+    chunk_rows = max(int(budget * READ_FRACTION / jobs / per_row), 1000)
+    return chunk_rows, jobs
+
+# ==== 読み込み ====
+
+def iter_hour_chunks(path, columns, chunk_rows):
+    """
+    時間ごとのファイル（.csv / .csv.bgz）を chunk_rows 行ずつ、必要な列だけ文字列として読む。
+    途中で読めなくなった場合は例外をそのまま上げる（呼び出し側でその時間を丸ごと捨てる）。
+    """
+    compression = "gzip" if path.endswith(ARCHIVE_SUFFIX) else None
+    reader = pd.read_csv(path, dtype=str, usecols=lambda c: c in columns,
+                         chunksize=chunk_rows, compression=compression)
+    for chunk in reader:
+        yield chunk
+
+# ==== 結果の表示 ====
+
+def aggregate_bytes(agg):
+    return sum(v.nbytes for v in agg.values())
+
+
+def peak_rss():
+    """このプロセスと（終了済みの）子プロセスのうち最大の RSS（バイト、Linux の ru_maxrss は KB）"""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * 1024
+
+
+def format_size(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024:
+            return f"{n:.1f}{unit}"
+        n /= 1024
+    return f"{n:.1f}TB"
+
+
+def report_peak_rss(budget=None):
+    peak = peak_rss()
+    line = f"最大 RSS: {format_size(peak)}"
+    if budget:
+        line += f"（上限 {format_size(budget)}）"
+        if peak > budget:
+            line = "[WARN] " + line + " 上限を超えました"
+    print(line)
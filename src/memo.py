@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+分析ステップの結果キャッシュ（入力・パラメータ・コードの内容で引くメモ化）
+
+各ステップ（1 日分の count.py、magnitude_engine.py、qtype 比率など）の出力ファイルを、
+    ステップ名 + 入力ファイルの指紋（パス, サイズ, 更新時刻）+ パラメータ + コードのハッシュ
+の SHA-256 をキーにして保存しておき、同じキーで再実行したときは計算せずに出力ファイルを戻す。
+入力データを直した日・コードを変えたステップだけが計算し直される。
+
+  {cache_dir}/objects/ab/abcdef.../0-出力ファイル名   出力ファイルのコピー
+  {cache_dir}/index.sqlite                          キー・ステップ・ラベル（日付など）・サイズ・最終使用時刻
+
+キャッシュ全体が上限（DNSMAG_CACHE_MAX_BYTES、デフォルト 20GB）を超えたら最終使用時刻の古いものから消す（LRU）。
+
+保存するのは compute が実際に書いた出力だけ（データがなく書かれないファイルや DNSMAG_WRITE_CSV=0 の CSV は含めない）。
+キーには CSV を書くかどうかと追記先のウェアハウスも含めるので、CSV を書かない実行でも 2 回目からは計算を飛ばせる。
+キャッシュから戻した場合、ウェアハウスへの追記は最初に計算したときのものがそのまま使われる
+（追記に失敗した計算はキャッシュに保存しない）。
+
+環境変数:
+    DNSMAG_CACHE_DIR        … キャッシュのディレクトリ（デフォルト: /home/shimada/analysis/cache、空文字で無効）
+    DNSMAG_CACHE_MAX_BYTES  … キャッシュの上限バイト数
+
+実行例:
+    python3 memo.py list --step count
+    python3 memo.py invalidate --step magnitude_engine --label 2025-04-15
+    python3 memo.py invalidate --all
+"""
+
+import os
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import filecmp
+import argparse
+from contextlib import closing
+
+import warehouse
+
+DEFAULT_DIR = "/home/shimada/analysis/cache"
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key       TEXT PRIMARY KEY,
+    step      TEXT NOT NULL,
+    label     TEXT NOT NULL DEFAULT '',
+    files     TEXT NOT NULL,
+    size      INTEGER NOT NULL,
+    created   REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_entries_step ON entries (step, label);
+CREATE INDEX IF NOT EXISTS idx_entries_used ON entries (last_used);
+"""
+
+def cache_dir():
+    """キャッシュのディレクトリ（DNSMAG_CACHE_DIR が空文字なら None = 使わない）"""
+    path = os.environ.get("DNSMAG_CACHE_DIR", DEFAULT_DIR)
+    return path or None
+
+
+def max_bytes():
+    return int(os.environ.get("DNSMAG_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+
+
+def connect(root):
+    os.makedirs(root, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(root, "index.sqlite"), timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(_SCHEMA)
+    return conn
+
+# ==== キー ====
+
+def fingerprint(path):
+    """入力ファイルの指紋。NAS 上のファイルを読み直さないよう、中身ではなくパス・サイズ・更新時刻を使う"""
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+
+
+def code_version(*paths):
+    """ステップのコード（スクリプトや func.py など）の内容のハッシュ"""
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def step_key(step, inputs, params, code_files):
+    payload = {
+        "step": step,
+        "inputs": [fingerprint(p) for p in sorted(inputs)],
+        "params": params,
+        # キャッシュの保存形式が変わったら以前のエントリは使わない
+        "code": code_version(*code_files, os.path.abspath(__file__)),
+        # CSV を書く・書かない実行や追記先のウェアハウスが違う実行は別の結果として扱う
+        "csv": warehouse.csv_enabled(),
+        "warehouse": warehouse.warehouse_path(),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _object_dir(root, key):
+    return os.path.join(root, "objects", key[:2], key)
+
+# ==== 保存・復元 ====
+
+def _restore(root, key, outputs, stored):
+    """
+    キャッシュの出力ファイルを元の場所に戻す（同じ内容ならそのまま）。
+    stored: 保存した出力の outputs での添字のリスト
+    """
+    obj = _object_dir(root, key)
+    if any(i >= len(outputs) for i in stored):
+        return False
+    for i in stored:
+        src = os.path.join(obj, f"{i}-{os.path.basename(outputs[i])}")
+        if not os.path.exists(src):
+            return False
+    for i in stored:
+        out = outputs[i]
+        src = os.path.join(obj, f"{i}-{os.path.basename(out)}")
+        if os.path.exists(out) and filecmp.cmp(src, out, shallow=False):
+            continue
+        os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+        tmp_path = out + ".tmp"
+        shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, out)
+    return True
+
+
+def _store(root, key, outputs, produced):
+    """outputs のうち添字が produced のものを保存する"""
+    obj = _object_dir(root, key)
+    tmp_obj = obj + ".tmp"
+    shutil.rmtree(tmp_obj, ignore_errors=True)
+    os.makedirs(tmp_obj)
+    size = 0
+    for i in produced:
+        out = outputs[i]
+        dst = os.path.join(tmp_obj, f"{i}-{os.path.basename(out)}")
+        shutil.copyfile(out, dst)
+        size += os.path.getsize(dst)
+    shutil.rmtree(obj, ignore_errors=True)
+    os.replace(tmp_obj, obj)
+    return size
+
+
+def evict(conn, root, limit=None):
+    """合計サイズが limit 以下になるまで最終使用時刻の古いものから消す"""
+    limit = max_bytes() if limit is None else limit
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+    removed = 0
+    for key, size in conn.execute("SELECT key, size FROM entries ORDER BY last_used").fetchall():
+        if total <= limit:
+            break
+        shutil.rmtree(_object_dir(root, key), ignore_errors=True)
+        conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        total -= size
+        removed += 1
+    return removed
+
+
+def run_cached(step, label, inputs, params, code_files, outputs, compute):
+    """
+    step のキーがキャッシュにあれば、保存してある出力を戻して True を返す。
+    無ければ compute() を実行し（compute が outputs を書く）、書かれた出力をキャッシュに保存して False を返す。
+    label は invalidate で指定するための目印（日付など）。キャッシュが無効なら常に compute() する。
+    """
+    root = cache_dir()
+    if root is None:
+        compute()
+        return False
+    outputs = list(outputs)
+    key = step_key(step, inputs, params, code_files)
+    try:
+        with closing(connect(root)) as conn, conn:
+            hit = conn.execute("SELECT files FROM entries WHERE key = ?", (key,)).fetchone()
+            if hit and _restore(root, key, outputs, [i for i, _ in json.loads(hit[0])]):
+                conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+                print(f"[CACHE] {step} {label}: 変更なしのためキャッシュを使用しました")
+                return True
+    except (sqlite3.Error, OSError) as e:
+        print(f"[WARN] キャッシュを参照できません: {e}")
+        compute()
+        return False
+
+    before = [os.stat(out).st_mtime_ns if os.path.exists(out) else None for out in outputs]
+    failures = warehouse.failure_count()
+    compute()
+    # ウェアハウスへの追記に失敗した計算は保存しない（キャッシュから戻すと追記されないまま残るため）
+    if warehouse.failure_count() != failures:
+        return False
+    # 今回書かれた出力だけを保存する（書かれなかったファイルの前回の古い内容は保存しない）
+    produced = [i for i, (out, b) in enumerate(zip(outputs, before))
+                if os.path.exists(out) and os.stat(out).st_mtime_ns != b]
+    try:
+        size = _store(root, key, outputs, produced)
+        now = time.time()
+        with closing(connect(root)) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO entries (key, step, label, files, size, created, last_used) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (key, step, label, json.dumps([[i, outputs[i]] for i in produced]), size, now, now))
+            evict(conn, root)
+    except (sqlite3.Error, OSError) as e:
+        print(f"[WARN] キャッシュへの保存に失敗しました: {e}")
+    return False
+
+
+def invalidate(step=None, label=None, root=None):
+    """条件に合うエントリを消す（両方 None なら全部）。戻り値: 消した数"""
+    root = root or cache_dir()
+    conds, params = [], []
+    for col, val in (("step", step), ("label", label)):
+        if val is not None:
+            conds.append(f"{col} = ?")
+            params.append(val)
+    where = f" WHERE {' AND '.join(conds)}" if conds else ""
+    with closing(connect(root)) as conn, conn:
+        keys = [k for (k,) in conn.execute(f"SELECT key FROM entries{where}", params)]
+        for key in keys:
+            shutil.rmtree(_object_dir(root, key), ignore_errors=True)
+        conn.execute(f"DELETE FROM entries{where}", params)
+    return len(keys)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="分析ステップの結果キャッシュの一覧・削除")
+    parser.add_argument("--cache-dir", default=None, help=f"キャッシュのディレクトリ（デフォルト: $DNSMAG_CACHE_DIR または {DEFAULT_DIR}）")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("list", help="キャッシュの内容を表示する")
+    p.add_argument("--step")
+
+    p = sub.add_parser("invalidate", help="キャッシュを消す（次回は計算し直す）")
+    p.add_argument("--step", help="ステップ名（count, magnitude_engine, qtype_ratio など）")
+    p.add_argument("--label", help="ラベル（日付など）")
+    p.add_argument("--all", action="store_true", help="すべて消す")
+
+    p = sub.add_parser("evict", help="上限を超えた分を古いものから消す")
+    p.add_argument("--max-bytes", type=int, default=None)
+    args = parser.parse_args()
+
+    root = args.cache_dir or cache_dir()
+    if root is None:
+        print("キャッシュは無効です（DNSMAG_CACHE_DIR が空）")
+        return 1
+
+    if args.command == "list":
+        sql, params = "SELECT step, label, size, last_used, key FROM entries", []
+        if args.step:
+            sql, params = sql + " WHERE step = ?", [args.step]
+        with closing(connect(root)) as conn:
+            rows = conn.execute(sql + " ORDER BY step, label", params).fetchall()
+        for step, label, size, last_used, key in rows:
+            print(f"{step}\t{label}\t{size:,}\t{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_used))}\t{key[:12]}")
+        print(f"{len(rows)}件, 合計 {sum(r[2] for r in rows):,} bytes")
+    elif args.command == "invalidate":
+        if not (args.step or args.label or args.all):
+            parser.error("--step / --label / --all のいずれかを指定してください")
+        n = invalidate(args.step, args.label, root)
+        print(f"[DONE] {n}件を削除しました")
+    else:
+        with closing(connect(root)) as conn, conn:
+            n = evict(conn, root, args.max_bytes)
+        print(f"[DONE] {n}件を削除しました")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
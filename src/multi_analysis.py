@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+複数の分析を 1 回の読み込みでまとめて実行する入口
+
+new-tshark-mag.py / magnitude_engine.py（magnitude）、run_analysis_v2.py count（count）、
+qtype_ratio（qtype）、network_analysis.py（network）、dnsmagnitude-time.py / query-count.py（time）は
+それぞれ同じ時間ごとの CSV を読み直していた。ここでは期間内の各時間のファイルを 1 回だけ読み、
+指定した全分析の集計器に渡す。
+
+  - magnitude / count / qtype / time: 時間ごとに rollup.aggregate_frame の集計（クエリ数、qtype 件数、
+    クライアント集合）を 1 つ作り、日・時間帯ごとにマージして使う（同じ集計を分析間で共有）
+  - network: 日の集計のクライアントをプレフィックス表で分類して求める（1 日分の行を持たない）
+  - --memory-budget: 上限に合わせて時間ごとのファイルをチャンクで読み、保持する集計が大きくなればディスクに退避する
+
+出力（既存スクリプトと同じ形式）:
+  magnitude … /home/shimada/analysis/output/{where}-YYYY-MM-DD.csv（day,domain,dnsmagnitude）
+  count     … /home/shimada/analysis/output-2025/count-{packet_type}-{where}-YYYY-MM-DD.csv（day,packet_type,domain,count）
+  qtype     … /home/shimada/analysis/output-2025/qtype/qtype-{packet_type}-{where}-YYYY-MM-DD.csv（date,subdomain,qtype,count,ratio）
+  network   … output/network_analysis/magnitude-{network}-YYYY-MM-DD.csv
+  time      … /home/shimada/analysis/output-time/{where}-YYYY-MM-DD-HH-HH.csv（day,time_range,domain,dnsmagnitude）と
+              count-{where}-YYYY-MM-DD-HH-HH.csv（day,time_range,subdomain,query_count,percentage）
+いずれもウェアハウスにも追記する。
+
+実行例:
+    python3 multi_analysis.py -w 1 --start-date 2025-04-01 --end-date 2025-04-30 \\
+        --analyses magnitude count qtype network time --time-windows 0-8 9-17 18-23
+    python3 multi_analysis.py -w 1 --start-date 2025-04-01 --end-date 2025-04-01 --memory-budget 4G
+"""
+
+import os
+import csv
+import math
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import func
+import warehouse
+from magnitude_engine import hourly_files, load_columns, write_daily_magnitude
+from membudget import (READ_FRACTION, parse_size, estimate_row_bytes, estimate_rows, plan,
+                       iter_hour_chunks, aggregate_bytes, format_size, report_peak_rss)
+from netclass import load_prefix_table, table_labels, classify_keys
+from rollup import aggregate_frame, merge_aggregates, magnitude_frame, qtype_frame, save_aggregate, load_aggregate
+
+ANALYSES = ["magnitude", "count", "qtype", "network", "time"]
+COLUMNS = ("ip.dst", "ipv6.dst", "dns.qry.name", "dns.qry.type")
+
+MAGNITUDE_DIR = "/home/shimada/analysis/output"
+COUNT_DIR = "/home/shimada/analysis/output-2025"
+QTYPE_DIR = "/home/shimada/analysis/output-2025/qtype"
+TIME_DIR = "/home/shimada/analysis/output-time"
+
+# ==== 出力 ====
+
+def write_magnitude(agg, where, date_str):
+    mag = magnitude_frame(agg).dropna(subset=["dnsmagnitude"])
+    path = os.path.join(MAGNITUDE_DIR, f"{where}-{date_str}.csv")
+    if warehouse.csv_enabled():
+        os.makedirs(MAGNITUDE_DIR, exist_ok=True)
+    write_daily_magnitude(mag["subdomain"].to_numpy(dtype=object), mag["dnsmagnitude"].to_numpy(),
+                          date_str[8:10], path, where, date_str)
+    if warehouse.csv_enabled():
+        print(f"magnitude: {path}")
+
+
+def write_count(agg, where, date_str, packet_type):
+    counts = sorted(((s, int(c)) for s, c in zip(agg["subdomains"], agg["counts"]) if c > 0),
+                    key=lambda x: x[1], reverse=True)
+    warehouse.append('count', counts, where=where, date=date_str, packet_type=packet_type)
+    if not warehouse.csv_enabled():
+        return
+    os.makedirs(COUNT_DIR, exist_ok=True)
+    path = os.path.join(COUNT_DIR, f"count-{packet_type}-{where}-{date_str}.csv")
+    with open(path, "w", newline='') as f:
+        writer = csv.writer(f, delimiter=',')
+        writer.writerow(['day', 'packet_type', 'domain', 'count'])
+        for subdom, c in counts:
+            writer.writerow([date_str[8:10], packet_type, subdom, c])
+    print(f"count: {path}")
+
+
+def write_qtype(agg, where, date_str, packet_type):
+    qt = qtype_frame(agg)
+    warehouse.append('qtype', qt[["subdomain", "qtype", "count"]].itertuples(index=False, name=None),
+                     where=where, date=date_str, packet_type=packet_type)
+    if not warehouse.csv_enabled():
+        return
+    qt["ratio"] = qt["count"] / qt.groupby("subdomain")["count"].transform("sum")
+    os.makedirs(QTYPE_DIR, exist_ok=True)
+    path = os.path.join(QTYPE_DIR, f"qtype-{packet_type}-{where}-{date_str}.csv")
+    with open(path, "w", newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['date', 'subdomain', 'qtype', 'count', 'ratio'])
+        for subdom, qtype, count, ratio in qt.sort_values(["subdomain", "qtype"]).itertuples(index=False):
+            writer.writerow([date_str, subdom, qtype, count, f"{ratio:.4f}"])
+    print(f"qtype: {path}")
+
+
+def write_time_window(agg, where, date_str, start_hour, end_hour):
+    time_range_str = f"{start_hour:02d}-{end_hour:02d}"
+    day = date_str[8:10]
+    mag = magnitude_frame(agg).dropna(subset=["dnsmagnitude"])
+    warehouse.append('magnitude', mag[["subdomain", "dnsmagnitude"]].itertuples(index=False, name=None),
+                     where=where, date=date_str, time_range=time_range_str)
+    counts = pd.DataFrame({"subdomain": agg["subdomains"], "count": agg["counts"]})
+    counts = counts[counts["count"] > 0].sort_values("count", ascending=False)
+    warehouse.append('count', counts.itertuples(index=False, name=None),
+                     where=where, date=date_str, time_range=time_range_str)
+    if not warehouse.csv_enabled():
+        return
+    os.makedirs(TIME_DIR, exist_ok=True)
+    path = os.path.join(TIME_DIR, f"{where}-{date_str}-{time_range_str}.csv")
+    with open(path, "w", newline='') as f:
+        writer = csv.writer(f, delimiter=',')
+        writer.writerow(['day', 'time_range', 'domain', 'dnsmagnitude'])
+        for subdom, m in mag[["subdomain", "dnsmagnitude"]].itertuples(index=False):
+            writer.writerow([day, time_range_str, subdom, str(m)])
+    total = counts["count"].sum()
+    count_path = os.path.join(TIME_DIR, f"count-{where}-{date_str}-{time_range_str}.csv")
+    with open(count_path, "w", newline='') as f:
+        writer = csv.writer(f, delimiter=',')
+        writer.writerow(['day', 'time_range', 'subdomain', 'query_count', 'percentage'])
+        for subdom, c in counts.itertuples(index=False):
+            percentage = (c / total * 100) if total > 0 else 0
+            writer.writerow([day, time_range_str, subdom, c, f"{percentage:.2f}"])
+    print(f"time: {path}, {count_path}")
+
+# ==== 1 日分の実行 ====
+
+def parse_window(spec):
+    """'9-17' → (9, 17)"""
+    try:
+        start_hour, end_hour = (int(x) for x in spec.split("-"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'開始-終了' の形式で指定してください: {spec}")
+    if not (0 <= start_hour <= end_hour <= 23):
+        raise argparse.ArgumentTypeError(f"時刻の範囲が不正です: {spec}")
+    return start_hour, end_hour
+
+
+def network_results(agg, table):
+    """
+    集計からネットワーク別のマグニチュード（func.classify_by_network_and_calculate_magnitude と同じ形）を求める。
+    クライアントをプレフィックス表で分類し、分類ごとに (サブドメイン, クライアント) を数える。
+    """
+    label_names = table_labels(table)
+    client_labels = pd.Categorical(classify_keys(agg["clients"], table), categories=label_names).codes
+    pair_labels = client_labels[agg["pair_client"]]
+    results = {}
+    for i, label in enumerate(label_names):
+        mask = pair_labels == i
+        A_tot = len(np.unique(agg["pair_client"][mask]))
+        if A_tot == 0:
+            print(f"{label}ネットワークのデータが見つかりませんでした")
+            results[label] = {}
+            continue
+        magnitudes = {}
+        if A_tot > 1:
+            ip_counts = np.bincount(agg["pair_sub"][mask], minlength=len(agg["subdomains"]))
+            for j in np.flatnonzero(ip_counts):
+                magnitudes[str(agg["subdomains"][j])] = 10 * math.log(ip_counts[j]) / math.log(A_tot)
+        results[label] = dict(sorted(magnitudes.items(), key=lambda item: item[1], reverse=True))
+        print(f"{label}ネットワーク - 総IP数: {A_tot}, ドメイン数: {len(magnitudes)}")
+    return results
+
+
+def read_hour(path, budget=None):
+    """
+    1 時間分の集計を作る。budget（バイト）を指定した場合は、見積もった行数が上限に収まらなければ
+    チャンクごとに読んで集計し、マージしていく（1 時間分の DataFrame を丸ごと持たない）。
+    """
+    if budget is None:
+        df = load_columns([path], COLUMNS)
+        print(f"読み込み: {os.path.basename(path)} ({len(df):,}行)")
+        return aggregate_frame(df)
+    chunk_rows, _ = plan(budget, estimate_row_bytes(path, COLUMNS))
+    rows = estimate_rows(path)
+    if rows <= chunk_rows:
+        return read_hour(path)
+    agg, n = None, 0
+    try:
+        for chunk in iter_hour_chunks(path, COLUMNS, chunk_rows):
+            n += len(chunk)
+            part = aggregate_frame(chunk)
+            agg = part if agg is None else merge_aggregates([agg, part])
+            del chunk, part
+    except Exception as e:
+        # 途中までの集計は使わず、チャンクに分けない場合（load_columns）と同じくファイルごと飛ばす
+        print(f"[WARN] 読み込み失敗: {path}: {e}")
+        return aggregate_frame(pd.DataFrame())
+    print(f"読み込み: {os.path.basename(path)} ({n:,}行, {chunk_rows:,}行ずつ)")
+    return agg if agg is not None else aggregate_frame(pd.DataFrame())
+
+
+def fold_aggregates(items):
+    """集計（またはディスクに退避した集計のパス）を 1 つずつ読みながらマージする"""
+    acc = None
+    for item in items:
+        agg = load_aggregate(item) if isinstance(item, str) else item
+        acc = agg if acc is None else merge_aggregates([acc, agg])
+    return acc
+
+
+def run_day(files, where, date_str, analyses, windows, table, packet_type, budget=None):
+    """
+    1 日分の時間ごとのファイルを 1 回ずつ読み、指定した全分析の結果を書き出す。
+    budget を指定した場合、保持している時間ごとの集計が上限の半分を超えたらディスクに退避し、
+    日・時間帯ごとのマージでは 1 時間分ずつ読み戻す。
+    """
+    hour_aggs = {}
+    held = 0
+    with tempfile.TemporaryDirectory(prefix="dnsmag-spill-") as spill_dir:
+        for path in files:
+            hour = int(os.path.basename(path)[11:13])
+            agg = read_hour(path, budget)
+            if not len(agg["subdomains"]):
+                continue
+            size = aggregate_bytes(agg)
+            if budget is not None and held + size > budget * (1 - READ_FRACTION):
+                spill_path = os.path.join(spill_dir, f"{hour:02d}.npz")
+                save_aggregate(agg, [], spill_path)
+                print(f"集計をディスクに退避: {hour:02d}時 ({format_size(size)})")
+                hour_aggs[hour] = spill_path
+            else:
+                hour_aggs[hour] = agg
+                held += size
+            del agg
+
+        if not hour_aggs:
+            print(f"有効なデータが見つかりませんでした: {date_str}")
+            return
+
+        if {"magnitude", "count", "qtype", "network"} & set(analyses):
+            day_agg = fold_aggregates(hour_aggs.values())
+            if "magnitude" in analyses:
+                write_magnitude(day_agg, where, date_str)
+            if "count" in analyses:
+                write_count(day_agg, where, date_str, packet_type)
+            if "qtype" in analyses:
+                write_qtype(day_agg, where, date_str, packet_type)
+            if "network" in analyses:
+                func.write_network_magnitude_csv(network_results(day_agg, table), where, date_str)
+            del day_agg
+
+        if "time" in analyses:
+            for start_hour, end_hour in windows:
+                aggs = [a for h, a in hour_aggs.items() if start_hour <= h <= end_hour]
+                if aggs:
+                    write_time_window(fold_aggregates(aggs), where, date_str, start_hour, end_hour)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='複数の分析を 1 回の読み込みでまとめて実行')
+    parser.add_argument('-w', type=int, choices=[0, 1], required=True, help='0は権威1はリゾルバ')
+    parser.add_argument('--start-date', required=True, help='開始日 YYYY-MM-DD')
+    parser.add_argument('--end-date', required=True, help='終了日 YYYY-MM-DD')
+    parser.add_argument('--analyses', nargs='+', choices=ANALYSES, default=ANALYSES, help='実行する分析（複数指定可）')
+    parser.add_argument('--time-windows', nargs='+', type=parse_window, default=[(0, 23)],
+                        help='time 分析の時間帯（例: 0-8 9-17 18-23）')
+    parser.add_argument('--input-dir', help='入力ディレクトリ（省略時は where から決定）')
+    parser.add_argument('--prefix-table', help='network 分析のプレフィックス表（省略時は学内・学外の 2 分類）')
+    parser.add_argument('--packet-type', default='response', help='count / qtype の出力に付ける種別（デフォルト: response）')
+    parser.add_argument('--memory-budget', type=parse_size, help='使うメモリの上限（例: 8G）。上限に合わせてチャンク読み込み・退避する')
+    args = parser.parse_args()
+
+    table = load_prefix_table(args.prefix_table) if "network" in args.analyses else None
+    print(f"分析: {', '.join(args.analyses)}")
+    for date in pd.date_range(args.start_date, args.end_date):
+        date_str = date.strftime("%Y-%m-%d")
+        files = hourly_files(*date_str.split("-"), args.w, args.input_dir)
+        if not files:
+            print(f"対象ファイルが見つかりませんでした: {date_str}")
+            continue
+        print(f"\n=== {date_str}: {len(files)}ファイル ===")
+        run_day(files, args.w, date_str, args.analyses, args.time_windows, table, args.packet_type,
+                args.memory_budget)
+    report_peak_rss(args.memory_budget)
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,292 @@
+"""
+ネットワーク分類（学内・学外・部局・VPN など）のベクトル化版
+
+func.classify_ip_address は 1 行ごとに ip_network を 2 つ作り、IP を文字列から解析している。
+ここではネットワーク定義を一度だけソート済みの範囲テーブル [start, end] にコンパイルし、
+アドレス列に np.searchsorted をかけてまとめてラベル付けする。
+文字列の解析はユニークなアドレスに対してだけ行う。
+
+アドレスは IPv4 / IPv6 を共通の 17 バイトのキー（先頭 1 バイトがファミリ 4/6、残りがアドレス）
+で表す。バイト列の大小がアドレスの大小と一致するので、両ファミリを 1 つのテーブルで扱える。
+
+プレフィックス表ファイル（--prefix-table）の形式:
+    # コメント
+    <prefix> <label>
+    133.51.112.0/20      internal
+    133.51.112.0/24      internal-cs
+    2001:db8:10::/48     vpn
+  プレフィックスは入れ子にでき、最長一致（longest prefix match）したラベルになる。
+  入れ子はコンパイル時に重ならない区間に平坦化するので、検索は 1 回の二分探索で済む。
+
+出力ラベルは、デフォルト（CAMPUS_NETWORKS）では classify_ip_address と同じ:
+  internal / external / other / invalid
+"""
+
+import ipaddress
+import re
+
+import numpy as np
+import pandas as pd
+
+# 学内者用ネットワーク: 133.51.112.0/20, 学外者用ネットワーク: 133.51.192.0/21
+CAMPUS_NETWORKS = [
+    ("internal", "133.51.112.0/20"),
+    ("external", "133.51.192.0/21"),
+]
+
+# どのプレフィックスにも一致しないアドレス / 解析できないアドレスのラベル
+DEFAULT_LABEL = "other"
+INVALID_LABEL = "invalid"
+
+KEY_DTYPE = "S17"
+
+# 整数化できなかったアドレスの値
+INVALID = -1
+# 有効だが IPv4 ではない（IPv6）アドレスの値
+NON_IPV4 = -2
+
+_IPV4_RE = r'^(?:0|[1-9]\d{0,2})\.(?:0|[1-9]\d{0,2})\.(?:0|[1-9]\d{0,2})\.(?:0|[1-9]\d{0,2})$'
+# 出力ファイル名にも使うので、ラベルは英数字と - _ . に限る
+_LABEL_RE = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+# ===== アドレスの整数化・キー化 =====
+
+def ipv4_strings_to_int(values: pd.Series) -> np.ndarray:
+    """
+    文字列の Series を IPv4 の整数 (int64) に変換する。
+    IPv6 の候補（':' を含む）は NON_IPV4、それ以外（欠損・不正）は INVALID。
+    ipaddress.ip_address と同じ判定になるよう、先頭 0 付きオクテットは不正扱い。
+    """
+    s = values.astype(object)
+    out = np.full(len(s), INVALID, dtype=np.int64)
+
+    is_str = s.map(lambda v: isinstance(v, str)).to_numpy(dtype=bool)
+    if not is_str.any():
+        return out
+    strs = s[is_str].astype(str)
+    idx = np.flatnonzero(is_str)
+
+    v4 = strs.str.match(_IPV4_RE).to_numpy(dtype=bool)
+    if v4.any():
+        octets = strs[v4].str.split('.', expand=True).astype(np.int64).to_numpy()
+        ok = (octets <= 255).all(axis=1)
+        ints = (octets[:, 0] << 24) | (octets[:, 1] << 16) | (octets[:, 2] << 8) | octets[:, 3]
+        out[idx[v4]] = np.where(ok, ints, INVALID)
+
+    maybe_v6 = ~v4 & strs.str.contains(':', regex=False).to_numpy(dtype=bool)
+    out[idx[maybe_v6]] = NON_IPV4
+    return out
+
+
+def _int_key(family: int, value: int) -> bytes:
+    return bytes([family]) + value.to_bytes(16, 'big')
+
+
+def address_keys(values: pd.Series) -> np.ndarray:
+    """
+    アドレス文字列を 17 バイトのキー (S17) に変換する。不正なアドレスは b''（全ゼロ）。
+    IPv4 はベクトル化、IPv6 は件数が少ないので ipaddress で 1 件ずつ解析する。
+    """
+    values = pd.Series(values, dtype=object).reset_index(drop=True)
+    ints = ipv4_strings_to_int(values)
+    buf = np.zeros((len(values), 17), dtype=np.uint8)
+
+    v4 = ints >= 0
+    if v4.any():
+        buf[v4, 0] = 4
+        buf[v4, 13:] = ints[v4].astype('>u4').view(np.uint8).reshape(-1, 4)
+
+    for i in np.flatnonzero(ints == NON_IPV4):
+        try:
+            packed = ipaddress.IPv6Address(values[i]).packed
+        except ValueError:
+            continue
+        buf[i, 0] = 6
+        buf[i, 1:] = np.frombuffer(packed, dtype=np.uint8)
+
+    return buf.view(KEY_DTYPE).ravel()
+
+
+def encode_addresses(values: pd.Series):
+    """
+    アドレス列を辞書コード化する。解析はユニーク値に対してのみ行い、
+    表記ゆれ（IPv6 の省略形など）は同じコードにまとめる。
+    戻り値: (codes, keys)  codes は keys への添字で、欠損・不正は -1
+    """
+    codes, uniques = pd.factorize(values)
+    keys = address_keys(pd.Series(uniques, dtype=object))
+    valid = keys != b''
+    key_codes, canonical = pd.factorize(keys[valid])
+
+    lookup = np.full(len(uniques) + 1, -1, dtype=np.int64)
+    lookup[np.flatnonzero(valid)] = key_codes
+    return lookup[codes], np.asarray(canonical, dtype=KEY_DTYPE)
+
+# ===== クライアントキー =====
+
+def client_addresses(df: pd.DataFrame, v4_col="ip.dst", v6_col="ipv6.dst") -> pd.Series:
+    """ip.dst が空の行は ipv6.dst を使い、クライアントアドレスを 1 列にまとめる"""
+    if v4_col in df.columns:
+        addresses = df[v4_col]
+    else:
+        addresses = pd.Series(None, index=df.index, dtype=object)
+    if v6_col in df.columns:
+        addresses = addresses.fillna(df[v6_col])
+    return addresses
+
+
+def encode_clients(df: pd.DataFrame, v4_col="ip.dst", v6_col="ipv6.dst"):
+    """
+    IPv4 / IPv6 を区別せずにクライアントを辞書コード化する。
+    戻り値: (codes, keys)  codes は行ごとのクライアント番号（両方欠損・不正は -1）
+    """
+    return encode_addresses(client_addresses(df, v4_col, v6_col))
+
+
+def client_keys(df: pd.DataFrame, v4_col="ip.dst", v6_col="ipv6.dst") -> np.ndarray:
+    """行ごとのクライアントキー (S17)。時間ごとに set へ積み上げる旧来のスクリプト用（欠損・不正は b''）"""
+    codes, keys = encode_clients(df, v4_col, v6_col)
+    return np.append(keys, np.zeros(1, dtype=KEY_DTYPE))[codes]
+
+# ===== プレフィックス単位への集約 =====
+
+def _family_mask(v4_len: int, v6_len: int) -> np.ndarray:
+    """ファミリごとのマスク (2, 17)。行 0 が IPv4、行 1 が IPv6（先頭のファミリバイトは残す）"""
+    if not (0 <= v4_len <= 32 and 0 <= v6_len <= 128):
+        raise ValueError(f"プレフィックス長が範囲外です: /{v4_len}, /{v6_len}")
+    v4 = ((1 << v4_len) - 1) << (32 - v4_len)
+    v6 = ((1 << v6_len) - 1) << (128 - v6_len)
+    return np.frombuffer(_int_key(0xff, v4) + _int_key(0xff, v6), dtype=np.uint8).reshape(2, 17)
+
+
+def mask_keys(keys: np.ndarray, v4_len=32, v6_len=128) -> np.ndarray:
+    """アドレスキーのホスト部を 0 にして /v4_len, /v6_len のプレフィックスのキーにする"""
+    buf = np.ascontiguousarray(keys, dtype=KEY_DTYPE).view(np.uint8).reshape(-1, 17)
+    masks = _family_mask(v4_len, v6_len)
+    return (buf & masks[(buf[:, 0] != 4).astype(np.int64)]).view(KEY_DTYPE).ravel()
+
+
+def prefix_codes(keys: np.ndarray, v4_len=32, v6_len=128):
+    """
+    ユニークなアドレスキーを、プレフィックスの辞書コードに対応付ける。
+    戻り値: (codes, n_prefixes)  codes[i] は keys[i] が属するプレフィックスの番号
+    """
+    codes, prefixes = pd.factorize(mask_keys(keys, v4_len, v6_len))
+    return codes, len(prefixes)
+
+# ===== プレフィックス表（最長一致） =====
+
+def read_prefix_table(path):
+    """プレフィックス表ファイルを読み込み [(label, cidr), ...] を返す"""
+    networks = []
+    with open(path, encoding='utf-8') as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            fields = line.split()
+            if len(fields) != 2:
+                raise ValueError(f"{path}:{lineno}: '<prefix> <label>' の形式ではありません")
+            cidr, label = fields
+            if not _LABEL_RE.match(label):
+                raise ValueError(f"{path}:{lineno}: ラベルに使えない文字があります: {label}")
+            networks.append((label, cidr))
+    return networks
+
+
+def _flatten(prefixes):
+    """
+    入れ子のプレフィックス [(start, end, label), ...] を、最長一致のラベルを持つ
+    重ならない区間のリストに平坦化する（CIDR は入れ子か素のどちらかなのでスタックで処理できる）
+    """
+    prefixes = sorted(prefixes, key=lambda p: (p[0], p[0] - p[1]))
+    out = []
+
+    def emit(start, end, label):
+        if start > end:
+            return
+        if out and out[-1][2] == label and out[-1][1] + 1 == start:
+            out[-1] = (out[-1][0], end, label)
+        else:
+            out.append((start, end, label))
+
+    stack = []
+    pos = 0
+    for start, end, label in prefixes:
+        while stack and stack[-1][1] < start:
+            top = stack.pop()
+            emit(pos, top[1], top[2])
+            pos = top[1] + 1
+        if stack:
+            if stack[-1][:2] == (start, end):
+                raise ValueError(f"同じプレフィックスが重複しています: {stack[-1][2]} と {label}")
+            emit(pos, start - 1, stack[-1][2])
+        stack.append((start, end, label))
+        pos = start
+    while stack:
+        top = stack.pop()
+        emit(pos, top[1], top[2])
+        pos = top[1] + 1
+    return out
+
+
+def compile_networks(networks=CAMPUS_NETWORKS):
+    """
+    [(label, cidr), ...] を最長一致用の平坦な範囲テーブルにコンパイルする。
+    戻り値: (starts, ends, labels)  starts/ends は S17 キーでソート済み
+    """
+    rows = []
+    for family, version in ((4, 4), (6, 6)):
+        prefixes = []
+        for label, cidr in networks:
+            net = ipaddress.ip_network(cidr)
+            if net.version == version:
+                prefixes.append((int(net.network_address), int(net.broadcast_address), label))
+        rows.extend((_int_key(family, s), _int_key(family, e), l) for s, e, l in _flatten(prefixes))
+
+    starts = np.array([r[0] for r in rows], dtype=KEY_DTYPE)
+    ends = np.array([r[1] for r in rows], dtype=KEY_DTYPE)
+    labels = np.array([r[2] for r in rows], dtype=object)
+    return starts, ends, labels
+
+
+def load_prefix_table(path=None):
+    """プレフィックス表ファイルをコンパイルする。path が None なら CAMPUS_NETWORKS"""
+    if path is None:
+        return _CAMPUS_TABLE
+    return compile_networks(read_prefix_table(path))
+
+
+def table_labels(table):
+    """テーブルに含まれるラベル（出現順、重複なし）+ DEFAULT_LABEL"""
+    return list(dict.fromkeys(list(table[2]) + [DEFAULT_LABEL]))
+
+
+def classify_keys(keys: np.ndarray, table, default=DEFAULT_LABEL) -> np.ndarray:
+    """アドレスキーを searchsorted で範囲テーブルに当ててラベルを返す"""
+    starts, ends, labels = table
+    if len(starts) == 0:
+        safe = np.zeros(len(keys), dtype=np.int64)
+        hit = np.zeros(len(keys), dtype=bool)
+    else:
+        pos = np.searchsorted(starts, keys, side='right') - 1
+        safe = np.clip(pos, 0, None)
+        hit = (pos >= 0) & (keys <= ends[safe])
+
+    all_labels = np.append(labels, [default, INVALID_LABEL]).astype(object)
+    label_idx = np.where(hit, safe, len(labels))
+    label_idx = np.where(keys == b'', len(labels) + 1, label_idx)
+    return all_labels[label_idx]
+
+
+_CAMPUS_TABLE = compile_networks(CAMPUS_NETWORKS)
+
+def classify_ip_series(values: pd.Series, table=None) -> np.ndarray:
+    """
+    アドレス列全体をラベル付けする（ユニークなアドレスだけを分類して各行に展開）。
+    table を省略すると func.classify_ip_address を列全体に適用したのと同じ結果になる。
+    """
+    table = table if table is not None else _CAMPUS_TABLE
+    codes, keys = encode_addresses(values)
+    labels = np.append(classify_keys(keys, table), INVALID_LABEL).astype(object)
+    return labels[codes]
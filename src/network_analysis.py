@@ -20,15 +20,19 @@ def main():
         
         # 入力ディレクトリ（デフォルト値）
         input_dir = sys.argv[4] if len(sys.argv) > 4 else "/mnt/qnap2/shimada/resolver/"
+        # プレフィックス表ファイル（省略時は学内・学外の 2 分類）
+        prefix_table = sys.argv[5] if len(sys.argv) > 5 else None
         
         print(f"=== ネットワーク分類DNS Magnitude分析 ===")
         print(f"対象日付: {year}-{month}-{day}")
         print(f"入力ディレクトリ: {input_dir}")
+        if prefix_table:
+            print(f"プレフィックス表: {prefix_table}")
         print(f"※すべてのパケットは応答パケット（rcode=0）として処理されます")
         print(f"")
         
         # 分析実行
-        process_network_analysis_files(year, month, day, input_dir)
+        process_network_analysis_files(year, month, day, input_dir, prefix_table)
         
         print(f"\n=== 分析完了 ===")
         print(f"結果は output/network_analysis/ ディレクトリに保存されました")
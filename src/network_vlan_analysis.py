@@ -0,0 +1,47 @@
+"""
+クエリ・レスポンス CSV のネットワーク別・VLAN 別 DNS Magnitude 分析
+
+tshark-resovler-query-and-respons.sh の出力（vlan.id 列を含む）を 1 日分読み込み、
+ネットワーク分類（学内・学外、または --prefix-table のラベル）と VLAN の両方について
+サブドメインごとのマグニチュードを 1 回のコード化から計算する。
+VLAN 別にはクエリ数も出力する。
+
+出力（output/network_analysis/ 配下）:
+  - magnitude-<network>-<query|response>-YYYY-MM-DD.csv
+  - vlan-<query|response>-YYYY-MM-DD.csv（列: vlan,date,subdomain,query_count,magnitude）
+
+使用例:
+    python3 network_vlan_analysis.py -y 2025 -m 04 -d 01 --analysis-type query
+    python3 network_vlan_analysis.py -y 2025 -m 04 -d 01 --analysis-type response --prefix-table network_prefixes.txt
+"""
+
+import argparse
+
+from func import process_query_response_network_files
+
+def main():
+    parser = argparse.ArgumentParser(description='ネットワーク別・VLAN別DNS Magnitude分析（クエリ・レスポンスCSV）')
+    parser.add_argument('-y', help='year', required=True)
+    parser.add_argument('-m', help='month', required=True)
+    parser.add_argument('-d', help='day', required=True)
+    parser.add_argument('--analysis-type', choices=['query', 'response'], default='query',
+                        help='query: 問い合わせ / response: 応答（rcode=0）')
+    parser.add_argument('--input-dir', default='/mnt/qnap2/shimada/resolver-q-r/', help='入力ディレクトリ')
+    parser.add_argument('--prefix-table', help='プレフィックス表ファイル（省略時は学内・学外の 2 分類）')
+    args = parser.parse_args()
+
+    month = args.m.zfill(2)
+    day = args.d.zfill(2)
+
+    print(f"=== ネットワーク別・VLAN別 DNS Magnitude分析 ===")
+    print(f"対象日付: {args.y}-{month}-{day} ({args.analysis_type})")
+    print(f"入力ディレクトリ: {args.input_dir}")
+
+    process_query_response_network_files(args.y, month, day, args.analysis_type,
+                                         args.input_dir, args.prefix_table)
+
+    print(f"\n=== 分析完了 ===")
+    print(f"結果は output/network_analysis/ ディレクトリに保存されました")
+
+if __name__ == "__main__":
+    main()
@@ -30,12 +30,15 @@
 
 出力（--outdir 配下）:
   - stats_where0.csv / stats_where1.csv（集計テーブル）
+  - daily_where0.csv / daily_where1.csv（ヒートマップ用の日次テーブル）
   - diff_mean_auth_vs_resolver.csv（共通サブドメインの平均差）
   - bar_topN_mean_where{0,1}.png       （平均のTopN）
   - bar_topN_std_where{0,1}.png        （標準偏差のTopN＝変動大）
   - boxplot_std_auth_vs_resolver.png   （std分布の箱ひげ：権威vsリゾルバ）
   - scatter_mean_auth_vs_resolver.png  （共通サブドメインの平均 Magnitude 散布図）
   - heatmap_daily_topN_where{0,1}.png  （日次ヒートマップ：平均上位Nドメイン）
+
+図は render.py で表から並列に描き、表が前回と変わっていない図は描き直さない（--force で全部描く）。
 """
 
 import argparse
@@ -45,7 +48,8 @@ import re
 import math
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
+
+from render import figure_job, new_figure, render_all
 
 # ==== ユーティリティ ====
 
@@ -176,8 +180,9 @@ def ensure_outdir(d):
     os.makedirs(d, exist_ok=True)
 
 # ==== プロット ====
+# 描画関数は render.py のワーカーで、書き出した表（stats_where{0,1}.csv, daily_where{0,1}.csv）から描く
 
-def plot_bar_topN(stats, where, metric, topn, outdir, title_prefix):
+def plot_bar_topN(stats, where, metric, topn, title_prefix):
     """
     metric: 'mean' or 'std'
     """
@@ -187,18 +192,16 @@ def plot_bar_topN(stats, where, metric, topn, outdir, title_prefix):
     sub = sub.sort_values(metric, ascending=False).head(topn)
     sub = sub.iloc[::-1]  # 横棒を下から上へ
 
-    plt.figure(figsize=(8, max(4, 0.35*len(sub))))
-    plt.barh(sub['subdomain'], sub[metric])
-    plt.xlabel(metric)
-    plt.ylabel('subdomain')
-    plt.title(f"{title_prefix} where={where} Top{topn} by {metric}")
-    fname = os.path.join(outdir, f"bar_top{topn}_{metric}_where{where}.png")
-    plt.tight_layout()
-    plt.savefig(fname, dpi=150)
-    plt.close()
-    return fname
-
-def plot_box_std(stats0, stats1, outdir):
+    fig = new_figure((8, max(4, 0.35*len(sub))))
+    ax = fig.subplots()
+    ax.barh(sub['subdomain'], sub[metric])
+    ax.set_xlabel(metric)
+    ax.set_ylabel('subdomain')
+    ax.set_title(f"{title_prefix} where={where} Top{topn} by {metric}")
+    fig.tight_layout()
+    return fig
+
+def plot_box_std(stats0, stats1):
     """
     権威(0)とリゾルバ(1)の std 分布を箱ひげで比較
     """
@@ -207,22 +210,20 @@ def plot_box_std(stats0, stats1, outdir):
     data = [stats0['std'].dropna().values, stats1['std'].dropna().values]
     labels = ['authoritative(0)', 'resolver(1)']
 
-    plt.figure(figsize=(6,5))
-    plt.boxplot(data, labels=labels, showfliers=True)
-    plt.ylabel('std of magnitude')
-    plt.title('Std distribution: authoritative vs resolver')
-    fname = os.path.join(outdir, "boxplot_std_auth_vs_resolver.png")
-    plt.tight_layout()
-    plt.savefig(fname, dpi=150)
-    plt.close()
-    return fname
-
-def plot_scatter_mean(stats, outdir, annotate_topk=0):
+    fig = new_figure((6,5))
+    ax = fig.subplots()
+    ax.boxplot(data, tick_labels=labels, showfliers=True)
+    ax.set_ylabel('std of magnitude')
+    ax.set_title('Std distribution: authoritative vs resolver')
+    fig.tight_layout()
+    return fig
+
+def plot_scatter_mean(stats0, stats1, annotate_topk=0):
     """
     共通サブドメインの mean(権威) vs mean(リゾルバ) 散布図
     """
-    s0 = stats[stats['where']==0][['subdomain','mean']].rename(columns={'mean':'mean_auth'})
-    s1 = stats[stats['where']==1][['subdomain','mean']].rename(columns={'mean':'mean_resolv'})
+    s0 = stats0[['subdomain','mean']].rename(columns={'mean':'mean_auth'})
+    s1 = stats1[['subdomain','mean']].rename(columns={'mean':'mean_resolv'})
     merged = pd.merge(s0, s1, on='subdomain', how='inner')
     if merged.empty:
         return None
@@ -230,30 +231,28 @@ def plot_scatter_mean(stats, outdir, annotate_topk=0):
     x = merged['mean_auth'].values
     y = merged['mean_resolv'].values
 
-    plt.figure(figsize=(6,6))
-    plt.scatter(x, y, s=20)
+    fig = new_figure((6,6))
+    ax = fig.subplots()
+    ax.scatter(x, y, s=20)
     # y=x の基準線
     lim_min = min(np.nanmin(x), np.nanmin(y))
     lim_max = max(np.nanmax(x), np.nanmax(y))
-    plt.plot([lim_min, lim_max], [lim_min, lim_max], linestyle='--')
-    plt.xlabel('Mean Magnitude (Authoritative)')
-    plt.ylabel('Mean Magnitude (Resolver)')
-    plt.title('Mean Magnitude: Authoritative vs Resolver')
+    ax.plot([lim_min, lim_max], [lim_min, lim_max], linestyle='--')
+    ax.set_xlabel('Mean Magnitude (Authoritative)')
+    ax.set_ylabel('Mean Magnitude (Resolver)')
+    ax.set_title('Mean Magnitude: Authoritative vs Resolver')
 
     # 差の大きい上位を注釈（任意）
     if annotate_topk and annotate_topk > 0:
         merged['diff'] = (merged['mean_resolv'] - merged['mean_auth']).abs()
         lab = merged.sort_values('diff', ascending=False).head(annotate_topk)
         for _, r in lab.iterrows():
-            plt.annotate(r['subdomain'], (r['mean_auth'], r['mean_resolv']), xytext=(3,3), textcoords='offset points', fontsize=8)
+            ax.annotate(r['subdomain'], (r['mean_auth'], r['mean_resolv']), xytext=(3,3), textcoords='offset points', fontsize=8)
 
-    fname = os.path.join(outdir, "scatter_mean_auth_vs_resolver.png")
-    plt.tight_layout()
-    plt.savefig(fname, dpi=150)
-    plt.close()
-    return fname
+    fig.tight_layout()
+    return fig
 
-def plot_heatmap_daily(df, where, topn, outdir, title_prefix):
+def plot_heatmap_daily(df, where, topn, title_prefix):
     """
     whereごとに、平均値TopNのサブドメインについて、日次(列)×サブドメイン(行)のヒートマップ
     """
@@ -278,22 +277,20 @@ def plot_heatmap_daily(df, where, topn, outdir, title_prefix):
     except Exception:
         mat = mat.reindex(sorted(mat.columns), axis=1)
 
-    plt.figure(figsize=(max(6, 0.45*mat.shape[1]), max(4, 0.35*mat.shape[0])))
-    plt.imshow(mat.values, aspect='auto', interpolation='nearest')
-    plt.colorbar(label='magnitude')
-    plt.yticks(ticks=np.arange(mat.shape[0]), labels=mat.index)
+    fig = new_figure((max(6, 0.45*mat.shape[1]), max(4, 0.35*mat.shape[0])))
+    ax = fig.subplots()
+    im = ax.imshow(mat.values, aspect='auto', interpolation='nearest')
+    fig.colorbar(im, ax=ax, label='magnitude')
+    ax.set_yticks(np.arange(mat.shape[0]), labels=mat.index)
     # 横軸は間引いて表示
     xticks = np.arange(mat.shape[1])
     step = max(1, mat.shape[1] // 12)
-    plt.xticks(ticks=xticks[::step], labels=mat.columns[::step], rotation=45, ha='right')
-    plt.xlabel('date')
-    plt.ylabel('subdomain')
-    plt.title(f"{title_prefix} where={where} Top{topn} (daily magnitude)")
-    fname = os.path.join(outdir, f"heatmap_daily_top{topn}_where{where}.png")
-    plt.tight_layout()
-    plt.savefig(fname, dpi=150)
-    plt.close()
-    return fname
+    ax.set_xticks(xticks[::step], labels=mat.columns[::step], rotation=45, ha='right')
+    ax.set_xlabel('date')
+    ax.set_ylabel('subdomain')
+    ax.set_title(f"{title_prefix} where={where} Top{topn} (daily magnitude)")
+    fig.tight_layout()
+    return fig
 
 # ==== メイン ====
 
@@ -305,6 +302,8 @@ def main():
     ap.add_argument('--topn', type=int, default=20, help='TopN（棒グラフ・ヒートマップ）')
     ap.add_argument('--min-days', type=int, default=5, help='統計計算に使う最小日数（countの閾値）')
     ap.add_argument('--annotate-topk', type=int, default=0, help='散布図で注釈する「差の大きい上位K」件（0で注釈なし）')
+    ap.add_argument('--workers', type=int, default=None, help='図を描く並列数（デフォルト: CPU 数）')
+    ap.add_argument('--force', action='store_true', help='入力の表が変わっていない図も描き直す')
     args = ap.parse_args()
 
     ensure_outdir(args.outdir)
@@ -324,29 +323,34 @@ def main():
         print("[ERROR] 統計テーブルが空です（min-days が大きすぎる/データが無い可能性）。")
         return 1
 
-    # 出力: 集計CSV
+    # 出力: 集計CSV（図はこれらの表から描く）
     stats0 = stats[stats['where']==0].copy()
     stats1 = stats[stats['where']==1].copy()
-    if not stats0.empty:
-        stats0.to_csv(os.path.join(args.outdir, "stats_where0.csv"), index=False)
-    if not stats1.empty:
-        stats1.to_csv(os.path.join(args.outdir, "stats_where1.csv"), index=False)
-
+    tables, daily = {}, {}
+    for where, s, d in ((0, stats0, df0), (1, stats1, df1)):
+        if not s.empty:
+            tables[where] = os.path.join(args.outdir, f"stats_where{where}.csv")
+            s.to_csv(tables[where], index=False)
+        # ヒートマップは min-days に関係なく日次の値から描く
+        if not d.empty:
+            daily[where] = os.path.join(args.outdir, f"daily_where{where}.csv")
+            d.to_csv(daily[where], index=False)
+
+    def out(name):
+        return os.path.join(args.outdir, name)
+
+    jobs = []
     # 図: 権威/リゾルバ それぞれ TopN（mean / std）
-    if not stats0.empty:
-        plot_bar_topN(stats, where=0, metric='mean', topn=args.topn, outdir=args.outdir, title_prefix='Top by mean')
-        plot_bar_topN(stats, where=0, metric='std',  topn=args.topn, outdir=args.outdir, title_prefix='Top by std (variability)')
-    if not stats1.empty:
-        plot_bar_topN(stats, where=1, metric='mean', topn=args.topn, outdir=args.outdir, title_prefix='Top by mean')
-        plot_bar_topN(stats, where=1, metric='std',  topn=args.topn, outdir=args.outdir, title_prefix='Top by std (variability)')
-
-    # 図: 箱ひげ（std分布の比較）
-    if not stats0.empty and not stats1.empty:
-        plot_box_std(stats0, stats1, args.outdir)
+    for where in tables:
+        for metric, title_prefix in (('mean', 'Top by mean'), ('std', 'Top by std (variability)')):
+            jobs.append(figure_job(plot_bar_topN, out(f"bar_top{args.topn}_{metric}_where{where}.png"), [tables[where]],
+                                   where=where, metric=metric, topn=args.topn, title_prefix=title_prefix))
 
-    # 図: 散布図（共通サブドメインの mean 比較）
-    if not stats0.empty and not stats1.empty:
-        plot_scatter_mean(stats, args.outdir, annotate_topk=args.annotate_topk)
+    # 図: 箱ひげ（std分布の比較）・散布図（共通サブドメインの mean 比較）
+    if len(tables) == 2:
+        jobs.append(figure_job(plot_box_std, out("boxplot_std_auth_vs_resolver.png"), [tables[0], tables[1]]))
+        jobs.append(figure_job(plot_scatter_mean, out("scatter_mean_auth_vs_resolver.png"), [tables[0], tables[1]],
+                               annotate_topk=args.annotate_topk))
 
         # 差分表も出力
         m0 = stats0[['subdomain','mean']].rename(columns={'mean':'mean_auth'})
@@ -360,13 +364,15 @@ def main():
             diff.to_csv(os.path.join(args.outdir, "diff_mean_auth_vs_resolver.csv"), index=False)
 
     # 図: 日次ヒートマップ（平均上位Nドメイン）
-    if not df0.empty:
-        plot_heatmap_daily(df0, where=0, topn=args.topn, outdir=args.outdir, title_prefix='Daily heatmap (authoritative)')
-    if not df1.empty:
-        plot_heatmap_daily(df1, where=1, topn=args.topn, outdir=args.outdir, title_prefix='Daily heatmap (resolver)')
+    for where, title_prefix in ((0, 'Daily heatmap (authoritative)'), (1, 'Daily heatmap (resolver)')):
+        if where in daily:
+            jobs.append(figure_job(plot_heatmap_daily, out(f"heatmap_daily_top{args.topn}_where{where}.png"),
+                                   [daily[where]], where=where, topn=args.topn, title_prefix=title_prefix))
+
+    failed = render_all(jobs, workers=args.workers, force=args.force)
 
     print(f"[DONE] 出力先: {args.outdir}")
-    return 0
+    return 1 if failed else 0
 
 if __name__ == "__main__":
     raise SystemExit(main())
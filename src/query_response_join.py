@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+クエリと応答の突き合わせ（ストリーミング・ハッシュ結合）
+
+tshark-resovler-query-and-respons.sh の出力（frame.time, ip.src, ip.dst, dns.qry.name,
+dns.qry.type, dns.flags.response, dns.flags.rcode）を時刻順に読み、
+各クエリを (クライアント, リゾルバ, qname, qtype) が一致する応答と --window 秒以内で対応付ける。
+  クエリ: クライアント = ip.src, リゾルバ = ip.dst
+  応答  : クライアント = ip.dst, リゾルバ = ip.src
+
+未応答のクエリはキーごとの FIFO（ハッシュ表）と時刻順のキューに保持し、
+ウィンドウを過ぎたものから順に「未応答」として追い出す。
+保持するのはウィンドウ内のクエリだけなので、メモリはファイルの大きさではなくウィンドウ幅で決まる。
+ファイルはチャンク単位で読み、時間をまたいだ応答も次のファイルで対応付ける。
+
+出力（--output-dir 配下）:
+  - qr_join_YYYY-MM-DD.csv          サブドメインごとの応答率・未応答数・遅延の統計
+      列: subdomain,queries,answered,answered_noerror,answered_error,unanswered,
+          orphan_responses,answer_rate,latency_mean_ms,latency_p50_ms,latency_p90_ms,latency_p99_ms
+  - qr_latency_hist_YYYY-MM-DD.csv  サブドメインごとの応答遅延ヒストグラム（対数ビン）
+      列: subdomain,bin_low_ms,bin_high_ms,count
+
+実行例:
+    python3 query_response_join.py -y 2025 -m 04 -d 01 --window 5
+"""
+
+import os
+import re
+import glob
+import argparse
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from magnitude_engine import subdomain_codes
+
+INPUT_DIR = "/mnt/qnap2/shimada/resolver-q-r/"
+OUTPUT_DIR = "/home/shimada/analysis/output-2025/qr-join"
+
+COLUMNS = ["frame.time", "ip.src", "ip.dst", "dns.qry.name", "dns.qry.type",
+           "dns.flags.response", "dns.flags.rcode"]
+
+# 遅延ヒストグラムのビン境界（秒）: 10us〜100s を 1 桁あたり 10 分割
+LATENCY_EDGES = np.logspace(-5, 2, 71)
+
+# ==== 入力 ====
+
+def parse_frame_time(values: pd.Series) -> np.ndarray:
+    """
+    tshark の frame.time（例: 'Apr  1, 2025 09:00:00.123456789 JST'）を秒（float）に変換する。
+    末尾のタイムゾーン名は無視する（同じ抽出結果の中では共通のため）。Windows 版の 'Japan Standard Time' のように
+    空白を含む名前もあるので、時刻より後ろをすべて落とす。解析できない行は NaN。
+    """
+    s = values.astype(str).str.replace(r"\s+", " ", regex=True) \
+        .str.replace(r"(\d{1,2}:\d{2}:\d{2}(?:\.\d+)?) .*$", r"\1", regex=True)
+    t = pd.to_datetime(s, format="%b %d, %Y %H:%M:%S.%f", errors="coerce")
+    if t.isna().all():
+        # 新しい tshark の ISO 形式など
+        t = pd.to_datetime(values, errors="coerce", utc=True).dt.tz_localize(None)
+    return (t - pd.Timestamp(0)).dt.total_seconds().to_numpy()
+
+
+def iter_chunks(files, chunksize):
+    """必要な列だけを文字列としてチャンク単位で読み込む"""
+    for path in files:
+        print(f"読み込み中: {os.path.basename(path)}")
+        try:
+            reader = pd.read_csv(path, dtype=str, usecols=lambda c: c in COLUMNS, chunksize=chunksize)
+            for chunk in reader:
+                yield chunk
+        except Exception as e:
+            print(f"[WARN] 読み込み失敗: {path}: {e}")
+
+# ==== 結合 ====
+
+class QueryResponseJoiner:
+    """
+    ウィンドウ付きのストリーミング結合。
+    pending: キー -> 未応答クエリ時刻の deque（古い順）
+    order  : (クエリ時刻, キー) の deque（到着順）。ウィンドウを過ぎた先頭から追い出す
+    """
+
+    def __init__(self, window=5.0):
+        self.window = window
+        self.pending = {}
+        self.order = deque()
+        self.sub_index = {}      # サブドメイン -> 行番号
+        # 行番号ごとの [queries, answered, answered_noerror, unanswered, orphan_responses]
+        self.counts = np.zeros((0, 5), dtype=np.int64)
+        self.latency_sum = np.zeros(0)
+        self.hist = np.zeros((0, len(LATENCY_EDGES) + 1), dtype=np.int64)
+
+    def _sub_rows(self, qnames: pd.Series) -> np.ndarray:
+        """
+        チャンクの qname 列を集計の行番号に変換する（対象外は -1）。
+        サブドメインの抽出はチャンク内のユニークな qname にだけ行い（magnitude_engine.subdomain_codes）、
+        qname のキャッシュは持たない。新しいサブドメインの行はチャンクごとにまとめて追加する。
+        """
+        codes, subdomains = subdomain_codes(qnames)
+        rows = np.empty(len(subdomains) + 1, dtype=np.int64)
+        rows[-1] = -1
+        for i, sub in enumerate(subdomains):
+            idx = self.sub_index.get(sub)
+            if idx is None:
+                idx = self.sub_index[sub] = len(self.sub_index)
+            rows[i] = idx
+        grow = len(self.sub_index) - len(self.counts)
+        if grow:
+            self.counts = np.vstack([self.counts, np.zeros((grow, 5), dtype=np.int64)])
+            self.latency_sum = np.append(self.latency_sum, np.zeros(grow))
+            self.hist = np.vstack([self.hist, np.zeros((grow, self.hist.shape[1]), dtype=np.int64)])
+        return rows[codes]
+
+    def _evict(self, limit):
+        """limit より前のクエリで、まだ応答が無いものを未応答として追い出す"""
+        order, pending, counts = self.order, self.pending, self.counts
+        while order and order[0][0] < limit:
+            tq, key, idx = order.popleft()
+            times = pending.get(key)
+            # 先頭が同じ時刻なら未応答のまま（既に対応付いたクエリは deque から消えている）
+            if times and times[0] == tq:
+                times.popleft()
+                if not times:
+                    del pending[key]
+                counts[idx, 3] += 1
+
+    def process(self, df: pd.DataFrame):
+        """
+        1 チャンク分を時刻順に処理する。
+        サブドメイン・突き合わせのキー・件数の集計は列単位で行い、行ごとのループは対応付けと追い出しだけにする。
+        """
+        times = parse_frame_time(df["frame.time"])
+        idx = self._sub_rows(df["dns.qry.name"])
+        keep = (idx >= 0) & ~np.isnan(times)
+        if not keep.any():
+            return
+        df = df[keep]
+        times, idx = times[keep], idx[keep]
+        is_resp = df["dns.flags.response"].isin(["1", "True", "true"]).to_numpy()
+        noerror = (df["dns.flags.rcode"].fillna("0") == "0").to_numpy() if "dns.flags.rcode" in df.columns \
+            else np.ones(len(df), dtype=bool)
+        # キーは (クライアント, リゾルバ, qname, qtype)。応答はクライアントとリゾルバが逆
+        src = df["ip.src"].fillna("")
+        dst = df["ip.dst"].fillna("")
+        rest = "\t" + df["dns.qry.name"].fillna("") + "\t" + df["dns.qry.type"].fillna("")
+        keys = np.where(is_resp, dst + "\t" + src + rest, src + "\t" + dst + rest)
+
+        n_sub = len(self.counts)
+        self.counts[:, 0] += np.bincount(idx[~is_resp], minlength=n_sub)
+
+        matched, lat_val = [], []
+        pending, order, window = self.pending, self.order, self.window
+        for i, (t, resp, key) in enumerate(zip(times.tolist(), is_resp.tolist(), keys.tolist())):
+            if order and order[0][0] < t - window:
+                self._evict(t - window)
+            if not resp:
+                q = pending.get(key)
+                if q is None:
+                    q = pending[key] = deque()
+                q.append(t)
+                order.append((t, key, idx[i]))
+            else:
+                q = pending.get(key)
+                if q:
+                    tq = q.popleft()
+                    if not q:
+                        del pending[key]
+                    matched.append(i)
+                    lat_val.append(t - tq)
+
+        matched = np.asarray(matched, dtype=np.int64)
+        answered = np.zeros(len(idx), dtype=bool)
+        answered[matched] = True
+        self.counts[:, 1] += np.bincount(idx[answered], minlength=n_sub)
+        self.counts[:, 2] += np.bincount(idx[answered & noerror], minlength=n_sub)
+        self.counts[:, 4] += np.bincount(idx[is_resp & ~answered], minlength=n_sub)
+        if len(matched):
+            lat_idx = idx[matched]
+            lat_val = np.asarray(lat_val)
+            np.add.at(self.hist, (lat_idx, np.searchsorted(LATENCY_EDGES, lat_val, side="right")), 1)
+            self.latency_sum += np.bincount(lat_idx, weights=lat_val, minlength=n_sub)
+
+    def finish(self):
+        """残っているクエリをすべて未応答として追い出す"""
+        self._evict(np.inf)
+
+    # ==== 集計結果 ====
+
+    def summary(self) -> pd.DataFrame:
+        subs = list(self.sub_index)
+        c = self.counts
+        answered = c[:, 1]
+        out = pd.DataFrame({
+            "subdomain": subs,
+            "queries": c[:, 0],
+            "answered": answered,
+            "answered_noerror": c[:, 2],
+            "answered_error": answered - c[:, 2],
+            "unanswered": c[:, 3],
+            "orphan_responses": c[:, 4],
+        })
+        with np.errstate(divide="ignore", invalid="ignore"):
+            out["answer_rate"] = np.where(c[:, 0] > 0, answered / c[:, 0], np.nan)
+            out["latency_mean_ms"] = np.where(answered > 0, self.latency_sum / answered * 1000.0, np.nan)
+        for q in (50, 90, 99):
+            out[f"latency_p{q}_ms"] = histogram_quantile(self.hist, q / 100.0) * 1000.0
+        return out.sort_values("queries", ascending=False)
+
+    def histogram(self) -> pd.DataFrame:
+        edges = np.concatenate(([0.0], LATENCY_EDGES, [np.inf])) * 1000.0
+        rows, bins = np.nonzero(self.hist)
+        subs = np.array(list(self.sub_index), dtype=object)
+        return pd.DataFrame({
+            "subdomain": subs[rows] if len(rows) else [],
+            "bin_low_ms": edges[bins],
+            "bin_high_ms": edges[bins + 1],
+            "count": self.hist[rows, bins],
+        })
+
+
+def histogram_quantile(hist: np.ndarray, q: float) -> np.ndarray:
+    """各行のヒストグラムから分位点（そのビンの上端、秒）を求める。件数 0 の行は NaN"""
+    upper = np.append(LATENCY_EDGES, np.inf)
+    total = hist.sum(axis=1)
+    cum = np.cumsum(hist, axis=1)
+    pos = (cum < (q * total)[:, None]).sum(axis=1)
+    return np.where(total > 0, upper[np.minimum(pos, len(upper) - 1)], np.nan)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='クエリと応答のストリーミング結合（応答率・未応答・遅延）')
+    parser.add_argument('-y', help='year', required=True)
+    parser.add_argument('-m', help='month', required=True)
+    parser.add_argument('-d', help='day', required=True)
+    parser.add_argument('--input-dir', default=INPUT_DIR, help=f'入力ディレクトリ（デフォルト: {INPUT_DIR}）')
+    parser.add_argument('--output-dir', default=OUTPUT_DIR, help=f'出力ディレクトリ（デフォルト: {OUTPUT_DIR}）')
+    parser.add_argument('--window', type=float, default=5.0, help='対応付けの時間窓（秒、デフォルト: 5）')
+    parser.add_argument('--chunksize', type=int, default=200000, help='1 回に読み込む行数')
+    args = parser.parse_args()
+
+    year, month, day = args.y, args.m.zfill(2), args.d.zfill(2)
+    date_str = f"{year}-{month}-{day}"
+    pat = re.compile(rf"{year}-{month}-{day}-\d{{2}}\.csv")
+    files = [f for f in sorted(glob.glob(os.path.join(args.input_dir, "*.csv"))) if pat.match(os.path.basename(f))]
+    if not files:
+        print(f"対象ファイルが見つかりませんでした: {date_str}")
+        return 1
+    print(f"処理対象ファイル数: {len(files)}")
+
+    joiner = QueryResponseJoiner(args.window)
+    for chunk in iter_chunks(files, args.chunksize):
+        joiner.process(chunk)
+    joiner.finish()
+
+    summary = joiner.summary()
+    os.makedirs(args.output_dir, exist_ok=True)
+    summary_path = os.path.join(args.output_dir, f"qr_join_{date_str}.csv")
+    hist_path = os.path.join(args.output_dir, f"qr_latency_hist_{date_str}.csv")
+    summary.to_csv(summary_path, index=False, float_format="%.6f")
+    joiner.histogram().to_csv(hist_path, index=False, float_format="%.6f")
+
+    total_q = summary["queries"].sum()
+    total_a = summary["answered"].sum()
+    print(f"クエリ数: {total_q:,}, 応答あり: {total_a:,}, 未応答: {summary['unanswered'].sum():,}, "
+          f"対応なし応答: {summary['orphan_responses'].sum():,}")
+    print(f"[DONE] {summary_path}, {hist_path}")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+生データ（時間ごとの tshark 出力 CSV）のパーティション分割・列指向データセット（Parquet）
+
+/mnt/qnap2/shimada/{input,resolver}/YYYY-MM-DD-HH.csv を
+    {dataset_dir}/where=1/date=2025-04-01/hour=09/part-0.parquet
+の形に変換し、期間・時間帯・応答フラグ・qtype・サブドメインで絞り込む問い合わせでは
+条件に合わないパーティション（ディレクトリ）と行グループを読まずに飛ばす。
+
+  - dns.flags.response は int8（0/1）、dns.qry.type は int32、dns.flags.rcode は int16 に変換。
+    input/ と resolver/ の CSV には dns.flags.response 列が無い（抽出のフィルタで応答だけを選んでいる）ので 1 にする
+  - sub_code: サブドメイン（magnitude_engine.extract_subdomain）の整数コード（対象外は -1）。
+    コード表は {dataset_dir}/_subdomains.csv（列: sub_code,subdomain）に追記していき、
+    一度振ったコードは変えない（変換は 1 プロセスずつ実行すること）
+  - 各時間のファイル内は (dns.flags.response, dns.qry.type, sub_code) の順に並べ替えてから
+    行グループ（--row-group-size 行）に分けて書くので、行グループの min/max 統計が狭くなり
+    「AAAA の応答だけ」「サブドメイン X だけ」のような条件で大半の行グループを飛ばせる。
+    時刻順が必要な場合は読み出し後に frame.time で並べ替える
+  - 列は必要なものだけを読む（列の射影）
+
+実行例:
+    # 変換（既に変換済みの時間は --overwrite を付けない限り飛ばす）
+    python3 rawstore.py convert -w 1 --start-date 2025-04-01 --end-date 2025-04-30
+    # 4 月の業務時間の AAAA 応答のうち、サブドメイン www のクライアントだけを読む
+    python3 rawstore.py scan -w 1 --start-date 2025-04-01 --end-date 2025-04-30 --hours 9-17 \\
+        --response 1 --qtype 28 --subdomain www --columns frame.time ip.dst -o aaaa-www.csv
+"""
+
+import os
+import re
+import glob
+import argparse
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from magnitude_engine import INPUT_DIRS, extract_subdomain
+
+DATASET_DIR = "/mnt/qnap2/shimada/dataset/"
+DICTIONARY_FILE = "_subdomains.csv"   # 先頭が '_' のファイルはデータセットの走査対象にならない
+ROW_GROUP_SIZE = 65536
+
+# tshark スクリプトが出力する列（無い列は null）
+SCHEMA = pa.schema([
+    ("frame.time", pa.string()),
+    ("ip.src", pa.string()),
+    ("ip.dst", pa.string()),
+    ("ipv6.dst", pa.string()),
+    ("vlan.id", pa.string()),
+    ("dns.qry.name", pa.string()),
+    ("dns.qry.type", pa.int32()),
+    ("dns.flags.response", pa.int8()),
+    ("dns.flags.rcode", pa.int16()),
+    ("sub_code", pa.int32()),
+])
+SORT_KEYS = ["dns.flags.response", "dns.qry.type", "sub_code"]
+
+PARTITIONING = ds.partitioning(
+    pa.schema([("where", pa.int8()), ("date", pa.string()), ("hour", pa.int8())]), flavor="hive")
+
+# ==== サブドメインのコード表 ====
+
+def load_dictionary(dataset_dir=DATASET_DIR):
+    """コード表を {subdomain: sub_code} で返す（無ければ空）"""
+    path = os.path.join(dataset_dir, DICTIONARY_FILE)
+    if not os.path.exists(path):
+        return {}
+    df = pd.read_csv(path, dtype={"subdomain": str}, keep_default_na=False)
+    return dict(zip(df["subdomain"], df["sub_code"].astype(int)))
+
+
+def save_dictionary(dictionary, dataset_dir=DATASET_DIR):
+    os.makedirs(dataset_dir, exist_ok=True)
+    path = os.path.join(dataset_dir, DICTIONARY_FILE)
+    df = pd.DataFrame({"sub_code": list(dictionary.values()), "subdomain": list(dictionary.keys())})
+    tmp_path = path + ".tmp"
+    df.sort_values("sub_code").to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def sub_codes(qnames: pd.Series, dictionary):
+    """
+    qname 列をコード表のサブドメインコードに変換する（新しいサブドメインは dictionary に追加）。
+    extract_subdomain はユニークな qname にだけ適用する。
+    """
+    qname_codes, qname_uniques = pd.factorize(qnames)
+    lookup = np.full(len(qname_uniques) + 1, -1, dtype=np.int32)
+    for i, sub in enumerate(map(extract_subdomain, qname_uniques)):
+        if sub is not None:
+            lookup[i] = dictionary.setdefault(sub, len(dictionary))
+    return lookup[qname_codes]
+
+# ==== 変換 ====
+
+def hourly_inputs(where, start_date, end_date, input_dir=None):
+    """期間内の YYYY-MM-DD-HH.csv を [(date, hour, path), ...] で返す"""
+    input_dir = input_dir or INPUT_DIRS[int(where)]
+    pat = re.compile(r"(\d{4}-\d{2}-\d{2})-(\d{2})\.csv")
+    found = []
+    for path in sorted(glob.glob(os.path.join(input_dir, "*.csv"))):
+        m = pat.fullmatch(os.path.basename(path))
+        if m and start_date <= m.group(1) <= end_date:
+            found.append((m.group(1), int(m.group(2)), path))
+    return found
+
+
+def partition_path(dataset_dir, where, date, hour):
+    return os.path.join(dataset_dir, f"where={where}", f"date={date}", f"hour={hour:02d}", "part-0.parquet")
+
+
+def to_table(df: pd.DataFrame, dictionary) -> pa.Table:
+    """tshark の CSV（全列文字列）を SCHEMA の Table に変換し、SORT_KEYS で並べ替える"""
+    n = len(df)
+    cols = {}
+    for field in SCHEMA:
+        name = field.name
+        if name == "sub_code":
+            values = sub_codes(df["dns.qry.name"] if "dns.qry.name" in df.columns else pd.Series([None] * n), dictionary)
+        elif name == "dns.flags.response" and name not in df.columns:
+            # input/ と resolver/ の CSV（tshark-auth.sh / tshark-resolver-v2.sh）は応答だけを抽出していて、この列が無い
+            values = np.ones(n, dtype=np.int8)
+        elif name not in df.columns:
+            values = pa.nulls(n, field.type)
+        elif name == "dns.flags.response":
+            values = df[name].isin(["1", "True", "true"]).to_numpy(dtype=np.int8)
+        elif pa.types.is_integer(field.type):
+            # 複数の質問を持つ行（'1,28'）は最初の値を使う
+            values = pd.to_numeric(df[name].str.split(",").str[0], errors="coerce")
+            values = pa.array(values, from_pandas=True).cast(field.type)
+        else:
+            values = df[name]
+        cols[name] = pa.array(values, type=field.type, from_pandas=True) if not isinstance(values, pa.Array) else values
+    table = pa.table(cols, schema=SCHEMA)
+    return table.sort_by([(k, "ascending") for k in SORT_KEYS])
+
+
+def write_partition(table: pa.Table, path, row_group_size=ROW_GROUP_SIZE):
+    """一時ファイルに書いてから置き換える（途中で止まっても壊れたファイルを残さない）"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    pq.write_table(table, tmp_path, row_group_size=row_group_size, compression="zstd", write_statistics=True)
+    os.replace(tmp_path, path)
+
+
+def convert(where, start_date, end_date, input_dir=None, dataset_dir=DATASET_DIR,
+            row_group_size=ROW_GROUP_SIZE, overwrite=False):
+    inputs = hourly_inputs(where, start_date, end_date, input_dir)
+    print(f"対象ファイル数: {len(inputs)}")
+    dictionary = load_dictionary(dataset_dir)
+    n_dict = len(dictionary)
+    converted = 0
+    for date, hour, path in inputs:
+        out_path = partition_path(dataset_dir, where, date, hour)
+        if os.path.exists(out_path) and not overwrite:
+            continue
+        try:
+            df = pd.read_csv(path, dtype=str)
+        except Exception as e:
+            print(f"[WARN] 読み込み失敗: {path}: {e}")
+            continue
+        table = to_table(df, dictionary)
+        # コード表を先に保存してから、そのコードを使ったファイルを置く
+        if len(dictionary) != n_dict:
+            save_dictionary(dictionary, dataset_dir)
+            n_dict = len(dictionary)
+        write_partition(table, out_path, row_group_size)
+        converted += 1
+        print(f"変換: {os.path.basename(path)} -> {out_path} ({table.num_rows:,}行)")
+    print(f"[DONE] {converted}ファイルを変換しました（サブドメイン数: {len(dictionary):,}）")
+
+# ==== 問い合わせ ====
+
+def _and(conds):
+    expr = None
+    for c in conds:
+        expr = c if expr is None else expr & c
+    return expr
+
+
+def build_filter(where=None, start_date=None, end_date=None, hours=None,
+                 response=None, qtypes=None, sub_code_values=None):
+    """
+    条件を pyarrow の式にまとめる（None の条件は指定なし）。
+    戻り値: (パーティション列の条件, ファイル内の列の条件)
+    """
+    part, row = [], []
+    if where is not None:
+        part.append(ds.field("where") == int(where))
+    if start_date:
+        part.append(ds.field("date") >= start_date)
+    if end_date:
+        part.append(ds.field("date") <= end_date)
+    if hours is not None:
+        part.append(ds.field("hour").isin(list(hours)))
+    if response is not None:
+        cond = ds.field("dns.flags.response") == int(response)
+        if int(response) == 1:
+            # 応答フラグを null で保存していた以前の変換結果（input/ と resolver/ は応答だけ）も応答として扱う
+            cond = cond | ds.field("dns.flags.response").is_null()
+        row.append(cond)
+    if qtypes:
+        row.append(ds.field("dns.qry.type").isin([int(q) for q in qtypes]))
+    if sub_code_values is not None:
+        row.append(ds.field("sub_code").isin(list(sub_code_values)))
+    return _and(part), _and(row)
+
+
+def scan(where=None, start_date=None, end_date=None, hours=None, response=None, qtypes=None,
+         subdomains=None, columns=None, dataset_dir=DATASET_DIR, verbose=True) -> pd.DataFrame:
+    """
+    条件に合う行を DataFrame で返す。
+    パーティション（where / date / hour）はディレクトリ名で、行グループは min/max 統計で飛ばし、
+    columns に指定した列（と 'subdomain' 指定時の sub_code）だけを読む。
+    """
+    dataset = ds.dataset(dataset_dir, format="parquet", partitioning=PARTITIONING)
+    dictionary = load_dictionary(dataset_dir)
+    codes = None
+    if subdomains:
+        codes = [dictionary[s] for s in subdomains if s in dictionary]
+    part_expr, row_expr = build_filter(where, start_date, end_date, hours, response, qtypes, codes)
+
+    read_cols = None
+    if columns:
+        read_cols = [c for c in columns if c != "subdomain"]
+        if "subdomain" in columns and "sub_code" not in read_cols:
+            read_cols.append("sub_code")
+
+    n_files = len(dataset.files)
+    # パーティションはディレクトリ名で、行グループはフッターの min/max 統計で絞り込む
+    fragments = list(dataset.get_fragments(filter=part_expr)) if part_expr is not None else list(dataset.get_fragments())
+    row_groups = [rg for frag in fragments for rg in frag.split_by_row_group(filter=row_expr)]
+    if verbose:
+        total_rg = sum(frag.num_row_groups for frag in fragments)
+        print(f"パーティション: {len(fragments)}/{n_files} 行グループ: {len(row_groups)}/{total_rg}（読み込み対象/条件に合うパーティション内の総数）")
+
+    schema = dataset.schema
+    if read_cols is None:
+        read_cols = schema.names
+    tables = [rg.to_table(schema=schema, columns=read_cols, filter=row_expr) for rg in row_groups]
+    if not tables:
+        out = pd.DataFrame(columns=read_cols)
+    else:
+        out = pa.concat_tables(tables).to_pandas()
+
+    if columns is None or "subdomain" in columns:
+        names = np.array([None] * (len(dictionary) + 1), dtype=object)
+        for sub, code in dictionary.items():
+            names[code] = sub
+        out["subdomain"] = names[out["sub_code"].to_numpy(dtype=np.int64)] if len(out) else []
+        if columns is not None and "sub_code" not in columns:
+            out = out.drop(columns="sub_code")
+    return out
+
+
+def parse_hours(spec):
+    """'9-17' や '0,6,12' を時刻のリストにする"""
+    hours = []
+    for part in spec.split(","):
+        if "-" in part:
+            lo, hi = part.split("-")
+            hours.extend(range(int(lo), int(hi) + 1))
+        else:
+            hours.append(int(part))
+    return hours
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生データのパーティション分割 Parquet データセット（変換・絞り込み読み出し）")
+    parser.add_argument("--dataset-dir", default=DATASET_DIR, help=f"データセットのディレクトリ（デフォルト: {DATASET_DIR}）")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("convert", help="時間ごとの CSV をデータセットに変換する")
+    p.add_argument("-w", type=int, choices=[0, 1], required=True, help="0は権威1はリゾルバ")
+    p.add_argument("--start-date", required=True)
+    p.add_argument("--end-date", required=True)
+    p.add_argument("--input-dir", help="入力ディレクトリ（省略時は where から決定）")
+    p.add_argument("--row-group-size", type=int, default=ROW_GROUP_SIZE, help="行グループの行数")
+    p.add_argument("--overwrite", action="store_true", help="変換済みの時間も作り直す")
+
+    p = sub.add_parser("scan", help="条件に合う行だけを読み出す")
+    p.add_argument("-w", type=int, choices=[0, 1])
+    p.add_argument("--start-date")
+    p.add_argument("--end-date")
+    p.add_argument("--hours", type=parse_hours, help="時間帯（例: 9-17 / 0,6,12）")
+    p.add_argument("--response", type=int, choices=[0, 1], help="0=クエリ 1=応答")
+    p.add_argument("--qtype", nargs="+", type=int, help="qtype（数値、例: 28）")
+    p.add_argument("--subdomain", nargs="+", help="サブドメイン")
+    p.add_argument("--columns", nargs="+", help="読み出す列（subdomain を指定するとコードを名前に戻す）")
+    p.add_argument("-o", "--output", help="出力 CSV（省略時は件数だけ表示）")
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        convert(args.w, args.start_date, args.end_date, args.input_dir, args.dataset_dir,
+                args.row_group_size, args.overwrite)
+        return 0
+
+    df = scan(args.w, args.start_date, args.end_date, args.hours, args.response, args.qtype,
+              args.subdomain, args.columns, args.dataset_dir)
+    print(f"該当行数: {len(df):,}")
+    if args.output:
+        df.to_csv(args.output, index=False)
+        print(f"[DONE] {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
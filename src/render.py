@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+図の並列描画（集計済みの表から、変わった図だけを描き直す）
+
+plot_stability.py / visual.py / make_boxplots.py / make_boxplots_count.py は、まず集計の表（CSV）を書き出し、
+図ごとに「描画関数・入力の表・パラメータ・出力先」のジョブを作ってここに渡す。
+  - 各ジョブはプロセスプールのワーカーで、表を読み直して描く（Agg バックエンド）
+  - 描画関数は matplotlib.figure.Figure を直接作って返す（pyplot のグローバルな状態を使わないので、
+    同じプロセスで続けて描いても前の図の設定が残らない）
+  - 出力は一時ファイル + os.replace で書く
+  - 入力の表の内容・パラメータ・描画関数のコードのハッシュを {出力先}/.render-manifest.json に記録し、
+    同じハッシュで出力が残っている図は描かない（--force で描き直す）
+
+表は毎回書き直されて更新時刻が変わるため、memo.py の指紋（パス・サイズ・更新時刻）ではなく中身のハッシュを使う。
+
+描画関数は、入力の表の DataFrame をジョブの tables の順に位置引数で、パラメータをキーワード引数で受け取り、
+Figure（描くものがなければ None）を返す。モジュールの最上位に定義する（ワーカーで import し直すため）。
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import inspect
+import importlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import pandas as pd
+
+from memo import code_version
+
+MANIFEST_NAME = ".render-manifest.json"
+# サブドメイン名が数字だけでも文字列として読む
+TEXT_COLUMNS = {"subdomain": str, "domain": str, "date": str}
+
+# ==== ジョブ ====
+
+def _module_name(func):
+    """ワーカーで import するモジュール名（スクリプトとして実行中なら __main__ ではなくファイル名）"""
+    if func.__module__ == "__main__":
+        return os.path.splitext(os.path.basename(inspect.getsourcefile(func)))[0]
+    return func.__module__
+
+
+def figure_job(draw, output, tables=(), dpi=150, **params):
+    """描画関数 draw で tables（CSV のパス）から output を描くジョブ"""
+    return {
+        "module": _module_name(draw),
+        "draw": draw.__name__,
+        "code": os.path.abspath(inspect.getsourcefile(draw)),
+        "output": str(output),
+        "tables": [str(t) for t in tables],
+        "dpi": dpi,
+        "params": params,
+    }
+
+
+def new_figure(figsize):
+    """pyplot を通さずに Agg のキャンバス付きの Figure を作る"""
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def read_table(path):
+    return pd.read_csv(path, dtype=TEXT_COLUMNS)
+
+# ==== 変更の検出 ====
+
+def _file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def job_key(job):
+    payload = {
+        "draw": f"{job['module']}.{job['draw']}",
+        "tables": [_file_hash(p) for p in job["tables"]],
+        "dpi": job["dpi"],
+        "params": job["params"],
+        "code": code_version(job["code"], os.path.abspath(__file__)),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _manifest_path(output):
+    return os.path.join(os.path.dirname(os.path.abspath(output)), MANIFEST_NAME)
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(path, manifest):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+# ==== 描画 ====
+
+def render_one(job):
+    """1 枚描いて出力パスを返す（描くものがなければ None）。ワーカープロセスで実行される"""
+    draw = getattr(importlib.import_module(job["module"]), job["draw"])
+    fig = draw(*[read_table(p) for p in job["tables"]], **job["params"])
+    if fig is None:
+        return None
+    output = job["output"]
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    tmp_path = output + ".tmp"
+    fig.savefig(tmp_path, format=os.path.splitext(output)[1][1:] or "png", dpi=job["dpi"])
+    os.replace(tmp_path, output)
+    return output
+
+
+def _init_worker(path):
+    # スクリプトのディレクトリを import できるようにする（spawn / forkserver でも描画関数のモジュールを読めるように）
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+def render_all(jobs, workers=None, force=False):
+    """
+    ジョブを並列に描く。入力の表・パラメータ・コードが前回と同じで出力が残っている図は飛ばす。
+    戻り値: 失敗した図の数
+    """
+    manifests = {}
+    todo = []
+    for job in jobs:
+        mpath = _manifest_path(job["output"])
+        if mpath not in manifests:
+            manifests[mpath] = load_manifest(mpath)
+        key = job_key(job)
+        name = os.path.basename(job["output"])
+        if not force and manifests[mpath].get(name) == key and os.path.exists(job["output"]):
+            continue
+        todo.append((job, mpath, name, key))
+    skipped = len(jobs) - len(todo)
+    if not todo:
+        print(f"[DONE] 図はすべて最新です（{skipped}枚）")
+        return 0
+
+    t0 = time.time()
+    drawn, failed = 0, 0
+    workers = max(1, min(workers or os.cpu_count(), len(todo)))
+    script_dir = os.path.dirname(os.path.abspath(todo[0][0]["code"]))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(script_dir,)) as pool:
+        futures = {pool.submit(render_one, job): (mpath, name, key) for job, mpath, name, key in todo}
+        for fut in as_completed(futures):
+            mpath, name, key = futures[fut]
+            try:
+                output = fut.result()
+            except Exception as e:
+                failed += 1
+                print(f"[WARN] 描画失敗: {name}: {e}")
+                continue
+            if output is None:
+                manifests[mpath].pop(name, None)
+                continue
+            manifests[mpath][name] = key
+            drawn += 1
+            print(f"[INFO] saved: {output}")
+
+    for mpath, manifest in manifests.items():
+        save_manifest(mpath, manifest)
+    print(f"[DONE] 図 {drawn}枚を描画（変更なし {skipped}枚, {workers}並列, {time.time() - t0:.1f}秒）")
+    return failed
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+時間 → 日 → 週 → 月の階層的な事前集計（ロールアップ）
+
+生データの YYYY-MM-DD-HH.csv / .csv.bgz（/mnt/qnap2/shimada/input/ や resolver/、tshark_dump.sh で作った
+2023 年のアーカイブも同じ形式）から、粒度ごとに次の集計を {rollup_dir}/where={w}/{grain}/ に保存する。
+  - サブドメインごとのクエリ数
+  - (サブドメイン, qtype) ごとの件数
+  - クライアント集合（アドレスキーのソート済み配列）と (サブドメイン, クライアント) の組
+    → 和集合を取るだけで上位の粒度にまとめられ、任意の期間の Magnitude を正確に計算できる
+
+  hour/2025-04-01-09.npz, day/2025-04-01.npz, week/2025-W14.npz（ISO 週）, month/2025-04.npz
+
+各ファイルには元になったファイルの (名前, 更新時刻, サイズ) を記録し、build では
+  入力 CSV が変わった時間 → その時間を含む日 → その日を含む週・月
+の順に、変わったものだけを作り直す（新しいデータが入った期間だけ更新）。
+
+期間の集計（report / read_range）は、期間内にすっぽり入る月・週はその粒度、残りは日の粒度を使い、
+読むファイルの数が最小になるように組み合わせる。
+日次の結果を作る new-tshark-mag.py（日の Magnitude）、2025/dnsmagnitude-time.py・2025/query-count.py
+（時間範囲の Magnitude・クエリ数）は生 CSV を読み直さず、build(upper=False) で変わった時間・日だけを更新してから
+read_range（1 日）/ read_hours（時間範囲）の集計から計算する。
+visual.py / plot_stability.py / make_boxplots*.py / magnitude-ave-distr.py / 2025/count-ave-distr.py /
+2025/magnitude-time-statistics.py は日ごとの値の平均・分散を出すもので、月の集計からは計算できないため、
+その日次の結果（1 日 1 ファイルの小さな CSV・ウェアハウス）を読む。
+
+実行例:
+    python3 rollup.py build -w 1 --start-date 2025-04-01 --end-date 2025-04-30
+    python3 rollup.py build -w 0 --start-date 2023-11-01 --end-date 2023-11-30 --input-dir /mnt/qnap2/shimada/input/
+    python3 rollup.py report -w 1 --start-date 2025-04-01 --end-date 2025-06-30
+"""
+
+import os
+import argparse
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from magnitude_engine import hourly_files, load_columns, encode_frame, distinct_pairs, magnitude_from_counts
+from netclass import KEY_DTYPE
+
+ROLLUP_DIR = "/home/shimada/analysis/rollup"
+COLUMNS = ("ip.dst", "ipv6.dst", "dns.qry.name", "dns.qry.type")
+
+# ==== 集計の作成とマージ ====
+
+def empty_aggregate():
+    return {
+        "subdomains": np.array([], dtype=str),
+        "counts": np.zeros(0, dtype=np.int64),
+        "qtype_sub": np.zeros(0, dtype=np.int64),
+        "qtype": np.array([], dtype=str),
+        "qtype_count": np.zeros(0, dtype=np.int64),
+        "clients": np.zeros(0, dtype=KEY_DTYPE),
+        "pair_sub": np.zeros(0, dtype=np.int64),
+        "pair_client": np.zeros(0, dtype=np.int64),
+    }
+
+
+def aggregate_frame(df: pd.DataFrame):
+    """1 時間分の DataFrame から集計を作る"""
+    if df.empty:
+        return empty_aggregate()
+    sub_codes, client_codes, subdomains, client_keys = encode_frame(df)
+    n_sub = len(subdomains)
+    valid = sub_codes >= 0
+    pair_sub, pair_client = distinct_pairs(sub_codes, client_codes, len(client_keys))
+
+    # qtype の件数は 2025/func.qtype_ratio と同じく、qtype が空の行を除き前後の空白を取って数える
+    qtypes = df["dns.qry.type"].fillna("").astype(str).str.strip().to_numpy(dtype=object)[valid] \
+        if "dns.qry.type" in df.columns else np.full(valid.sum(), "", dtype=object)
+    has_qt = qtypes != ""
+    qt_codes, qt_uniques = pd.factorize(qtypes[has_qt])
+    n_qt = max(len(qt_uniques), 1)
+    keys, qt_count = np.unique(sub_codes[valid][has_qt].astype(np.int64) * n_qt + qt_codes, return_counts=True)
+
+    return {
+        "subdomains": np.asarray(subdomains, dtype=str),
+        "counts": np.bincount(sub_codes[valid], minlength=n_sub).astype(np.int64),
+        "qtype_sub": keys // n_qt,
+        "qtype": np.asarray(qt_uniques, dtype=str)[keys % n_qt] if len(keys) else np.array([], dtype=str),
+        "qtype_count": qt_count.astype(np.int64),
+        "clients": np.asarray(client_keys, dtype=KEY_DTYPE),
+        "pair_sub": pair_sub.astype(np.int64),
+        "pair_client": pair_client.astype(np.int64),
+    }
+
+
+def merge_aggregates(aggs):
+    """
+    複数の集計を 1 つにまとめる。
+    サブドメイン・クライアントはそれぞれの和集合に付け替え、件数は足し、(サブドメイン, クライアント) は重複を除く。
+    """
+    aggs = [a for a in aggs if len(a["subdomains"]) or len(a["clients"])]
+    if not aggs:
+        return empty_aggregate()
+    if len(aggs) == 1:
+        return aggs[0]
+
+    subdomains, sub_inv = np.unique(np.concatenate([a["subdomains"] for a in aggs]), return_inverse=True)
+    clients, client_inv = np.unique(np.concatenate([a["clients"] for a in aggs]), return_inverse=True)
+    sub_maps = np.split(sub_inv, np.cumsum([len(a["subdomains"]) for a in aggs])[:-1])
+    client_maps = np.split(client_inv, np.cumsum([len(a["clients"]) for a in aggs])[:-1])
+    n_sub, n_clients = len(subdomains), max(len(clients), 1)
+
+    counts = np.zeros(n_sub, dtype=np.int64)
+    pair_keys, qt_sub, qt_type, qt_count = [], [], [], []
+    for a, sub_map, client_map in zip(aggs, sub_maps, client_maps):
+        np.add.at(counts, sub_map, a["counts"])
+        pair_keys.append(sub_map[a["pair_sub"]].astype(np.int64) * n_clients + client_map[a["pair_client"]])
+        qt_sub.append(sub_map[a["qtype_sub"]])
+        qt_type.append(a["qtype"])
+        qt_count.append(a["qtype_count"])
+    pair_keys = np.unique(np.concatenate(pair_keys))
+
+    qt = pd.DataFrame({"sub": np.concatenate(qt_sub), "qtype": np.concatenate(qt_type),
+                       "count": np.concatenate(qt_count)})
+    qt = qt.groupby(["sub", "qtype"], as_index=False, sort=True)["count"].sum()
+
+    return {
+        "subdomains": subdomains,
+        "counts": counts,
+        "qtype_sub": qt["sub"].to_numpy(dtype=np.int64),
+        "qtype": qt["qtype"].to_numpy(dtype=str),
+        "qtype_count": qt["count"].to_numpy(dtype=np.int64),
+        "clients": clients,
+        "pair_sub": pair_keys // n_clients,
+        "pair_client": pair_keys % n_clients,
+    }
+
+
+def magnitude_frame(agg):
+    """集計からサブドメインごとの count, clients, dnsmagnitude を求める"""
+    clients = np.bincount(agg["pair_sub"], minlength=len(agg["subdomains"]))
+    return pd.DataFrame({
+        "subdomain": agg["subdomains"],
+        "count": agg["counts"],
+        "clients": clients,
+        "dnsmagnitude": magnitude_from_counts(clients, len(agg["clients"])),
+    }).sort_values("dnsmagnitude", ascending=False)
+
+
+def qtype_frame(agg):
+    qt = pd.DataFrame({
+        "subdomain": agg["subdomains"][agg["qtype_sub"]],
+        "qtype": agg["qtype"],
+        "count": agg["qtype_count"],
+    })
+    # 空の qtype を数えていた以前の集計ファイルから読んだ場合も除く
+    return qt[qt["qtype"] != ""]
+
+# ==== 保存（元ファイルの記録付き） ====
+
+def partition_path(rollup_dir, where, grain, name):
+    return os.path.join(rollup_dir, f"where={where}", grain, f"{name}.npz")
+
+
+def file_stamp(path):
+    """元ファイルの (名前, 更新時刻, サイズ)。これが変われば作り直す"""
+    st = os.stat(path)
+    return f"{os.path.basename(path)}:{st.st_mtime_ns}:{st.st_size}"
+
+
+def stored_sources(path):
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as z:
+        return list(z["sources"])
+
+
+def save_aggregate(agg, sources, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, sources=np.asarray(sources, dtype=str), **agg)
+    os.replace(tmp_path, path)
+
+
+def load_aggregate(path):
+    with np.load(path, allow_pickle=False) as z:
+        return {k: z[k] for k in empty_aggregate()}
+
+
+def refresh(path, children, build):
+    """
+    children（元ファイルのパスのリスト）の記録が保存済みのものと違うときだけ build(children) で作り直す。
+    戻り値: 作り直したかどうか
+    """
+    sources = [file_stamp(p) for p in children]
+    if stored_sources(path) == sources:
+        return False
+    save_aggregate(build(children), sources, path)
+    return True
+
+# ==== 粒度ごとの更新 ====
+
+def week_name(date):
+    iso = date.isocalendar()
+    return f"{iso[0]}-W{iso[1]:02d}"
+
+
+def build(where, start_date, end_date, input_dir=None, rollup_dir=ROLLUP_DIR, upper=True):
+    """
+    期間の時間・日（upper=True なら週・月も）の集計のうち、元データが変わったものだけを作り直す。
+    日次の分析（new-tshark-mag.py など）は upper=False で時間・日だけを更新してから read_range / read_hours で読む。
+    """
+    start_dt = datetime.strptime(start_date, "%Y-%m-%d")
+    end_dt = datetime.strptime(end_date, "%Y-%m-%d")
+    merge_files = lambda paths: merge_aggregates([load_aggregate(p) for p in paths])
+    touched_weeks, touched_months = {}, {}
+    rebuilt = {"hour": 0, "day": 0, "week": 0, "month": 0}
+
+    cur = start_dt
+    while cur <= end_dt:
+        date_str = cur.strftime("%Y-%m-%d")
+        hour_paths = []
+        for csv_path in hourly_files(*date_str.split("-"), where, input_dir):
+            name = os.path.basename(csv_path).split(".")[0]
+            hour_path = partition_path(rollup_dir, where, "hour", name)
+            if refresh(hour_path, [csv_path], lambda p: aggregate_frame(load_columns(p, COLUMNS))):
+                rebuilt["hour"] += 1
+                print(f"時間: {name}")
+            hour_paths.append(hour_path)
+        if hour_paths:
+            day_path = partition_path(rollup_dir, where, "day", date_str)
+            if refresh(day_path, hour_paths, merge_files):
+                rebuilt["day"] += 1
+                print(f"日: {date_str}")
+            touched_weeks[week_name(cur)] = cur - timedelta(days=cur.weekday())
+            touched_months[cur.strftime("%Y-%m")] = cur.replace(day=1)
+        cur += timedelta(days=1)
+
+    # 週・月は、含まれる日の集計（範囲外の日も含む）から作る
+    if not upper:
+        touched_weeks, touched_months = {}, {}
+    for grain, touched, span in (("week", touched_weeks, lambda d: (d, d + timedelta(days=6))),
+                                 ("month", touched_months, lambda d: (d, (d + timedelta(days=32)).replace(day=1) - timedelta(days=1)))):
+        for name, first in sorted(touched.items()):
+            lo, hi = span(first)
+            day_paths = [partition_path(rollup_dir, where, "day", d.strftime("%Y-%m-%d"))
+                         for d in pd.date_range(lo, hi)]
+            day_paths = [p for p in day_paths if os.path.exists(p)]
+            if refresh(partition_path(rollup_dir, where, grain, name), day_paths, merge_files):
+                rebuilt[grain] += 1
+                print(f"{'週' if grain == 'week' else '月'}: {name}")
+
+    print(f"[DONE] 作り直し: 時間 {rebuilt['hour']}, 日 {rebuilt['day']}, 週 {rebuilt['week']}, 月 {rebuilt['month']}")
+
+# ==== 期間の読み出し ====
+
+def plan_range(where, start_date, end_date, rollup_dir=ROLLUP_DIR):
+    """
+    期間をカバーする最も粗い粒度のファイルの組を返す。
+    月初から月末まで入る月は month、月曜から日曜まで入る週は week、残りは day を使う
+    （上位の粒度のファイルが、その期間の日のファイルと同じ元データから作られている場合に限る）。
+    """
+    start_dt = datetime.strptime(start_date, "%Y-%m-%d")
+    end_dt = datetime.strptime(end_date, "%Y-%m-%d")
+    day_path = lambda d: partition_path(rollup_dir, where, "day", d.strftime("%Y-%m-%d"))
+
+    def covering(grain, name, lo, hi):
+        path = partition_path(rollup_dir, where, grain, name)
+        if hi > end_dt or not os.path.exists(path):
+            return None
+        days = [day_path(d) for d in pd.date_range(lo, hi) if os.path.exists(day_path(d))]
+        # 日の集計が後から更新されていて上位が古い場合は使わない
+        if stored_sources(path) != [file_stamp(p) for p in days]:
+            return None
+        return path
+
+    # 先に期間内にすっぽり入る月を決め、その残りを週・日で埋める
+    months = {}
+    for first in pd.date_range(start_dt, end_dt, freq="MS"):
+        month_end = (first + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        path = covering("month", first.strftime("%Y-%m"), first, month_end)
+        if path:
+            months[first.to_pydatetime()] = (month_end.to_pydatetime(), path)
+    in_month = lambda d: any(lo <= d <= hi for lo, (hi, _) in months.items())
+
+    plan = []
+    cur = start_dt
+    while cur <= end_dt:
+        if cur in months:
+            month_end, path = months[cur]
+            plan.append(path)
+            cur = month_end + timedelta(days=1)
+            continue
+        week_end = cur + timedelta(days=6)
+        if cur.weekday() == 0 and not in_month(week_end):
+            path = covering("week", week_name(cur), cur, week_end)
+            if path:
+                plan.append(path)
+                cur = week_end + timedelta(days=1)
+                continue
+        if os.path.exists(day_path(cur)):
+            plan.append(day_path(cur))
+        cur += timedelta(days=1)
+    return plan
+
+
+def read_range(where, start_date, end_date, rollup_dir=ROLLUP_DIR):
+    """期間全体の集計を、最も粗い粒度のファイルをマージして返す"""
+    plan = plan_range(where, start_date, end_date, rollup_dir)
+    grains = pd.Series([os.path.basename(os.path.dirname(p)) for p in plan], dtype=object).value_counts()
+    print(f"読み込むファイル: {len(plan)} ({', '.join(f'{g} {n}' for g, n in grains.items())})")
+    return merge_aggregates([load_aggregate(p) for p in plan])
+
+
+def read_hours(where, date_str, start_hour=0, end_hour=23, rollup_dir=ROLLUP_DIR):
+    """1 日のうち start_hour 時〜end_hour 時の時間の集計をマージして返す（時間範囲の Magnitude・クエリ数用）"""
+    paths = [partition_path(rollup_dir, where, "hour", f"{date_str}-{h:02d}") for h in range(start_hour, end_hour + 1)]
+    return merge_aggregates([load_aggregate(p) for p in paths if os.path.exists(p)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="時間・日・週・月の事前集計（ロールアップ）の更新と期間集計")
+    parser.add_argument("--rollup-dir", default=ROLLUP_DIR, help=f"ロールアップの保存先（デフォルト: {ROLLUP_DIR}）")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("build", help="新しい・変わったデータの時間/日/週/月だけを作り直す")
+    p.add_argument("-w", type=int, choices=[0, 1], required=True, help="0は権威1はリゾルバ")
+    p.add_argument("--start-date", required=True)
+    p.add_argument("--end-date", required=True)
+    p.add_argument("--input-dir", help="入力ディレクトリ（省略時は where から決定）")
+
+    p = sub.add_parser("report", help="期間全体のクエリ数・qtype・Magnitude を出力する")
+    p.add_argument("-w", type=int, choices=[0, 1], required=True, help="0は権威1はリゾルバ")
+    p.add_argument("--start-date", required=True)
+    p.add_argument("--end-date", required=True)
+    p.add_argument("--output-dir", default="/home/shimada/analysis/output-rollup", help="出力ディレクトリ")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build(args.w, args.start_date, args.end_date, args.input_dir, args.rollup_dir)
+        return 0
+
+    agg = read_range(args.w, args.start_date, args.end_date, args.rollup_dir)
+    label = f"{args.start_date}_to_{args.end_date}"
+    os.makedirs(args.output_dir, exist_ok=True)
+    mag_path = os.path.join(args.output_dir, f"magnitude-{args.w}-{label}.csv")
+    qtype_path = os.path.join(args.output_dir, f"qtype-{args.w}-{label}.csv")
+    magnitude_frame(agg).to_csv(mag_path, index=False)
+    qtype_frame(agg).to_csv(qtype_path, index=False)
+    print(f"A_tot: {len(agg['clients']):,}, サブドメイン数: {len(agg['subdomains']):,}")
+    print(f"[DONE] {mag_path}, {qtype_path}")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
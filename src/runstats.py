@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+逐次更新できる平均・分散の集計状態（2025/count-ave-distr.py、magnitude-ave-distr.py、
+2025/magnitude-time-statistics.py で共通）
+
+(n, mean, m2) を保持し、日を追加するたびに Chan の並列公式でマージする。
+月末に全日を読み直さなくても、新しい日だけを読み込んで統計を更新できる。
+
+状態は {state_dir}/{name}.state.csv（キーごとの n, mean, m2）と {name}.days.csv（集計済みの日と、
+その日の入力ファイルの指紋 = サイズ・更新時刻）に一時ファイル + os.replace で保存する。
+集計済みの日の入力ファイルが変わった・無くなった場合は、その日の寄与だけを取り除けないので状態を作り直す。
+中央値・四分位数が必要な Magnitude の統計では、日ごとの値も {name}.values.csv に保存する。
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+RUNNING_STATS_COLUMNS = ['n', 'mean', 'm2']
+
+# ==== 集計状態 ====
+
+def running_stats(df, keys, value_col):
+    """keys ごとの (n, mean, m2) を groupby で一括計算"""
+    g = df.groupby(keys)[value_col]
+    dev = df[value_col] - g.transform('mean')
+    out = pd.DataFrame({
+        'n': g.count(),
+        'mean': g.mean(),
+        'm2': (dev * dev).groupby([df[k] for k in keys]).sum(),
+    })
+    return out.reset_index()
+
+
+def merge_running_stats(a, b, keys):
+    """2 つの集計状態をマージ（どちらか片方にしか無いキーはそのまま残る）"""
+    if a is None or a.empty:
+        return b.copy()
+    if b is None or b.empty:
+        return a.copy()
+    m = pd.merge(a, b, on=keys, how='outer', suffixes=('_a', '_b'))
+    for col in RUNNING_STATS_COLUMNS:
+        m[f'{col}_a'] = m[f'{col}_a'].fillna(0.0)
+        m[f'{col}_b'] = m[f'{col}_b'].fillna(0.0)
+    n = m['n_a'] + m['n_b']
+    delta = m['mean_b'] - m['mean_a']
+    m['n'] = n
+    m['mean'] = (m['n_a'] * m['mean_a'] + m['n_b'] * m['mean_b']) / n
+    m['m2'] = m['m2_a'] + m['m2_b'] + delta * delta * m['n_a'] * m['n_b'] / n
+    return m[list(keys) + RUNNING_STATS_COLUMNS]
+
+
+def finalize_running_stats(state, total_n=None):
+    """
+    集計状態から mean / pvariance / variance を計算する。
+    total_n を与えると、出現しなかった日を 0 として補ったものとして扱う
+    （(total_n - n) 個の 0 とマージするのと同じ）。
+    """
+    out = state.copy()
+    if total_n is not None:
+        zeros = (total_n - out['n']).clip(lower=0)
+        n = out['n'] + zeros
+        out['m2'] = out['m2'] + out['mean'] ** 2 * out['n'] * zeros / n
+        out['mean'] = out['mean'] * out['n'] / n
+        out['n'] = n
+    out['pvariance'] = out['m2'] / out['n']
+    out['variance'] = (out['m2'] / (out['n'] - 1)).where(out['n'] > 1, 0.0)
+    return out
+
+# ==== 保存（入力ファイルの指紋付き） ====
+
+def input_fingerprint(path):
+    """入力ファイルの指紋（memo.fingerprint と同じくサイズ・更新時刻。中身は読まない）"""
+    st = os.stat(path)
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+
+def state_paths(state_dir, name):
+    base = os.path.join(state_dir, name)
+    return base + ".state.csv", base + ".days.csv", base + ".values.csv"
+
+
+def load_state(state_dir, name, entries, keys, with_values=False):
+    """
+    保存済みの集計状態を読む。entries: 今回の対象 [(date_str, path), ...]
+    戻り値: (state, values, days)。days は {date_str: 指紋}。
+    集計済みの日の指紋が今回の入力と違えば（再計算された・消えた日がある）、空の状態を返して作り直させる。
+    """
+    stats_path, days_path, values_path = state_paths(state_dir, name)
+    if not (os.path.exists(stats_path) and os.path.exists(days_path)) \
+            or (with_values and not os.path.exists(values_path)):
+        return None, None, {}
+    days = pd.read_csv(days_path, dtype=str)
+    current = {d: input_fingerprint(p) for d, p in entries}
+    if 'fingerprint' not in days.columns \
+            or any(current.get(d) != f for d, f in zip(days['date'], days['fingerprint'])):
+        print(f"[INFO] 集計済みの日の入力が変わったため集計状態を作り直します: {name}")
+        return None, None, {}
+    text = {k: str for k in keys}
+    state = pd.read_csv(stats_path, dtype=text)
+    values = pd.read_csv(values_path, dtype={**text, 'date': str}) if with_values else None
+    return state, values, dict(zip(days['date'], days['fingerprint']))
+
+
+def save_state(state_dir, name, state, days, values=None):
+    """集計状態を保存する。days: {date_str: 指紋}"""
+    os.makedirs(state_dir, exist_ok=True)
+    stats_path, days_path, values_path = state_paths(state_dir, name)
+    tables = [(stats_path, state),
+              (days_path, pd.DataFrame(sorted(days.items()), columns=['date', 'fingerprint']))]
+    if values is not None:
+        tables.append((values_path, values))
+    for path, df in tables:
+        tmp_path = path + ".tmp"
+        df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+# ==== Magnitude の統計 ====
+
+def read_magnitude_files(entries):
+    """日ごとの Magnitude CSV（subdomain/domain 列と magnitude/dnsmagnitude 列）を [date, subdomain, magnitude] にまとめる"""
+    frames = []
+    for date_str, path in entries:
+        try:
+            df = pd.read_csv(path, dtype={'subdomain': str, 'domain': str})
+        except Exception as e:
+            print(f"エラー: {path} の処理中 - {str(e)}")
+            continue
+        sub_col = 'subdomain' if 'subdomain' in df.columns else 'domain' if 'domain' in df.columns else None
+        mag_col = 'magnitude' if 'magnitude' in df.columns else 'dnsmagnitude' if 'dnsmagnitude' in df.columns else None
+        if sub_col is None or mag_col is None:
+            print(f"警告: サブドメイン列または magnitude 列が見つかりません: {os.path.basename(path)}")
+            continue
+        print(f"処理中: {os.path.basename(path)} (レコード数: {len(df)})")
+        frames.append(pd.DataFrame({
+            'date': date_str,
+            'subdomain': df[sub_col].astype(str).str.strip(),
+            'magnitude': df[mag_col].astype(float),
+        }))
+    if not frames:
+        return pd.DataFrame({'date': pd.Series(dtype=str), 'subdomain': pd.Series(dtype=str),
+                             'magnitude': pd.Series(dtype=float)})
+    return pd.concat(frames, ignore_index=True)
+
+
+def magnitude_statistics(entries, state_dir=None, name=None):
+    """
+    サブドメインごとの Magnitude の統計 {subdomain: {mean, variance, std_dev, median, min, max, q25, q75, count}} を返す。
+    state_dir を指定すると、集計済みの日は読み直さず、新しい日だけを読んで状態を更新する
+    （平均・分散は (n, mean, m2) のマージ、中央値・四分位数・最小・最大は保存した日ごとの値から求める）。
+    戻り値: (統計, 集計した日数)
+    """
+    state, values, days = (None, None, {})
+    if state_dir:
+        state, values, days = load_state(state_dir, name, entries, ['subdomain'], with_values=True)
+    new_entries = [(d, p) for d, p in entries if d not in days]
+    if state_dir:
+        print(f"新規 {len(new_entries)}日 / 集計済み {len(days)}日")
+
+    new_values = read_magnitude_files(new_entries)
+    if not new_values.empty:
+        state = merge_running_stats(state, running_stats(new_values, ['subdomain'], 'magnitude'), ['subdomain'])
+    values = new_values if values is None else pd.concat([values, new_values], ignore_index=True)
+    days.update({d: input_fingerprint(p) for d, p in new_entries})
+    if state is None or state.empty:
+        return {}, len(days)
+    if state_dir:
+        save_state(state_dir, name, state, days, values)
+
+    stats = finalize_running_stats(state).set_index('subdomain')
+    g = values.groupby('subdomain')['magnitude']
+    quantiles = g.quantile([0.25, 0.5, 0.75]).unstack()
+    table = pd.DataFrame({
+        'mean': stats['mean'],
+        'variance': stats['variance'],
+        'std_dev': np.sqrt(stats['variance']),
+        'median': quantiles[0.5],
+        'min': g.min(),
+        'max': g.max(),
+        'q25': quantiles[0.25],
+        'q75': quantiles[0.75],
+        'count': stats['n'],
+    })
+    out = table.to_dict(orient='index')
+    for row in out.values():
+        row['count'] = int(row['count'])
+    return out, len(days)
@@ -14,6 +14,9 @@
 - scatter_queries_vs_magnitude_{where}.png
 - boxplot_magnitude_mean_auth_vs_resolver.png
 - heatmap_magnitude_top{N}.png
+- summary_{where}.csv, merged_{where}.csv（図を描く元の表）
+
+図は render.py で表から並列に描き、表が前回と変わっていない図は描き直さない（--force で全部描く）。
 """
 
 import os
@@ -22,7 +25,8 @@ from datetime import datetime, timedelta
 
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
+
+from render import figure_job, new_figure, render_all
 
 # ======== I/O ========
 
@@ -144,11 +148,11 @@ def summarize_monthly_magnitude(df_mag: pd.DataFrame) -> pd.DataFrame:
 
 
 # ======== 可視化 ========
+# 描画関数は render.py のワーカーで、書き出した表（summary_{where}.csv, merged_{where}.csv）から描く
 
-def save_corr_and_scatter(df_merge: pd.DataFrame, where: int, period_str: str, out_dir: str,
-                          xlim: tuple = None, ylim: tuple = (0, 10)):
+def write_corr(df_merge: pd.DataFrame, where: int, period_str: str, out_dir: str):
     """
-    x=q_mean, y=mag_mean の散布図と Pearson/Spearman 相関を保存
+    q_mean と mag_mean の Pearson/Spearman 相関を保存
     """
     if df_merge.empty:
         print(f"[INFO] 相関/散布図: データ無し（where={where}）")
@@ -164,47 +168,52 @@ def save_corr_and_scatter(df_merge: pd.DataFrame, where: int, period_str: str, o
         f.write(f"Pearson r:  {pearson:.4f}\n")
         f.write(f"Spearman ρ: {spearman:.4f}\n")
 
-    plt.figure(figsize=(7,5))
-    plt.scatter(df_merge["q_mean"].values, df_merge["mag_mean"].values, s=12)
-    plt.xlabel("Query mean (平均クエリ数/日)")
-    plt.ylabel("DNS Magnitude mean (人気度指標)")
-    plt.title(f"where={where}  Query mean vs Magnitude mean ({period_str})")
-    plt.grid(True, linestyle="--", alpha=0.4)
+
+def draw_scatter(df_merge: pd.DataFrame, where: int, period_str: str,
+                 xlim: tuple = None, ylim: tuple = (0, 10)):
+    """
+    x=q_mean, y=mag_mean の散布図
+    """
+    if df_merge.empty:
+        return None
+
+    fig = new_figure((7,5))
+    ax = fig.subplots()
+    ax.scatter(df_merge["q_mean"].values, df_merge["mag_mean"].values, s=12)
+    ax.set_xlabel("Query mean (平均クエリ数/日)")
+    ax.set_ylabel("DNS Magnitude mean (人気度指標)")
+    ax.set_title(f"where={where}  Query mean vs Magnitude mean ({period_str})")
+    ax.grid(True, linestyle="--", alpha=0.4)
 
     # 軸を固定
     if xlim:
-        plt.xlim(xlim)
+        ax.set_xlim(xlim)
     if ylim:
-        plt.ylim(ylim)
+        ax.set_ylim(ylim)
 
-    out_path = os.path.join(out_dir, f"scatter_queries_vs_magnitude_{where}.png")
-    plt.tight_layout()
-    plt.savefig(out_path, dpi=160)
-    plt.close()
+    fig.tight_layout()
+    return fig
 
 
-
-
-def save_boxplot_mag(mag0: pd.DataFrame, mag1: pd.DataFrame, period_str: str, out_dir: str):
+def draw_boxplot_mag(mag0: pd.DataFrame, mag1: pd.DataFrame, period_str: str):
     """
     権威 vs リゾルバの Magnitude平均の箱ひげ図
     """
     if mag0.empty or mag1.empty:
         print("[INFO] 箱ひげ図: 片方が空データのためスキップ")
-        return
-    plt.figure(figsize=(6,5))
+        return None
+    fig = new_figure((6,5))
+    ax = fig.subplots()
     data = [mag0["mag_mean"].dropna().values, mag1["mag_mean"].dropna().values]
-    plt.boxplot(data, labels=["Authoritative(0)", "Resolver(1)"], showfliers=False)
-    plt.ylabel("DNS Magnitude mean")
-    plt.title(f"Distribution of Magnitude mean ({period_str})")
-    plt.grid(True, axis="y", linestyle="--", alpha=0.4)
-    out_box = os.path.join(out_dir, f"boxplot_magnitude_mean_auth_vs_resolver.png")
-    plt.tight_layout()
-    plt.savefig(out_box, dpi=160)
-    plt.close()
+    ax.boxplot(data, tick_labels=["Authoritative(0)", "Resolver(1)"], showfliers=False)
+    ax.set_ylabel("DNS Magnitude mean")
+    ax.set_title(f"Distribution of Magnitude mean ({period_str})")
+    ax.grid(True, axis="y", linestyle="--", alpha=0.4)
+    fig.tight_layout()
+    return fig
 
 
-def save_heatmap_mag(mag0: pd.DataFrame, mag1: pd.DataFrame, topn: int, period_str: str, out_dir: str):
+def draw_heatmap_mag(mag0: pd.DataFrame, mag1: pd.DataFrame, topn: int, period_str: str):
     """
     共通サブドメインについて、mag_mean の平均が高い上位Nを 2行×N列のヒートマップで表示
     """
@@ -215,22 +224,21 @@ def save_heatmap_mag(mag0: pd.DataFrame, mag1: pd.DataFrame, topn: int, period_s
     )
     if both.empty:
         print("[INFO] ヒートマップ: 共通サブドメインがないためスキップ")
-        return
+        return None
     both["mag_mean_avg"] = (both["mag_mean_0"] + both["mag_mean_1"]) / 2.0
     top = both.sort_values("mag_mean_avg", ascending=False).head(topn)
 
     heat = np.vstack([top["mag_mean_0"].values, top["mag_mean_1"].values])
 
-    plt.figure(figsize=(max(10, topn*0.35), 3.8))
-    im = plt.imshow(heat, aspect="auto")
-    plt.colorbar(im, fraction=0.046, pad=0.04)
-    plt.yticks([0,1], ["Authoritative(0)","Resolver(1)"])
-    plt.xticks(range(len(top)), top["subdomain"].tolist(), rotation=90)
-    plt.title(f"DNS Magnitude mean Heatmap (Top {topn}, {period_str})")
-    plt.tight_layout()
-    out_heat = os.path.join(out_dir, f"heatmap_magnitude_top{topn}.png")
-    plt.savefig(out_heat, dpi=160)
-    plt.close()
+    fig = new_figure((max(10, topn*0.35), 3.8))
+    ax = fig.subplots()
+    im = ax.imshow(heat, aspect="auto")
+    fig.colorbar(im, ax=ax, fraction=0.046, pad=0.04)
+    ax.set_yticks([0,1], labels=["Authoritative(0)","Resolver(1)"])
+    ax.set_xticks(range(len(top)), labels=top["subdomain"].tolist(), rotation=90)
+    ax.set_title(f"DNS Magnitude mean Heatmap (Top {topn}, {period_str})")
+    fig.tight_layout()
+    return fig
 
 
 def main():
@@ -241,6 +249,8 @@ def main():
     parser.add_argument("--end-date",   default="2025-04-30", help="終了日 YYYY-MM-DD（デフォルト: 2025-04-30）")
     parser.add_argument("--out-dir",    default="./figures",  help="図・相関テキストの出力先（デフォルト: ./figures）")
     parser.add_argument("--topn",       type=int, default=30, help="ヒートマップの上位件数（デフォルト: 30）")
+    parser.add_argument("--workers",    type=int, default=None, help="図を描く並列数（デフォルト: CPU 数）")
+    parser.add_argument("--force",      action="store_true", help="入力の表が変わっていない図も描き直す")
     args = parser.parse_args()
 
     os.makedirs(args.out_dir, exist_ok=True)
@@ -261,23 +271,39 @@ def main():
                           on="subdomain", how="inner")
         results[where] = dict(qsum=qsum, msum=msum, merged=merged)
 
+    # 図は表から描く（表が前回と同じ図は描き直さない）
+    tables = {}
+    for where in (0, 1):
+        tables[where] = {
+            "summary": os.path.join(args.out_dir, f"summary_{where}.csv"),
+            "merged": os.path.join(args.out_dir, f"merged_{where}.csv"),
+        }
+        results[where]["msum"].to_csv(tables[where]["summary"], index=False)
+        results[where]["merged"].to_csv(tables[where]["merged"], index=False)
+
     # 軸範囲を両方のデータから決定
     all_q = pd.concat([results[0]["merged"]["q_mean"], results[1]["merged"]["q_mean"]])
     xmin, xmax = all_q.min(), all_q.max()
-    xlim = (0, xmax * 1.05)  # 5%余裕を持たせる
+    xlim = (0, float(xmax) * 1.05)  # 5%余裕を持たせる
     ylim = (0, 10)           # Magnitudeは0〜10に固定
 
     # 相関・散布図（共通スケールで出力）
+    jobs = []
     for where in (0, 1):
-        save_corr_and_scatter(results[where]["merged"], where=where,
-                              period_str=period_str, out_dir=args.out_dir,
-                              xlim=xlim, ylim=ylim)
+        write_corr(results[where]["merged"], where=where, period_str=period_str, out_dir=args.out_dir)
+        jobs.append(figure_job(draw_scatter, os.path.join(args.out_dir, f"scatter_queries_vs_magnitude_{where}.png"),
+                               [tables[where]["merged"]], dpi=160,
+                               where=where, period_str=period_str, xlim=xlim, ylim=ylim))
 
     # 箱ひげ図（Magnitude平均の分布: 権威 vs リゾルバ）
-    save_boxplot_mag(results[0]["msum"], results[1]["msum"], period_str=period_str, out_dir=args.out_dir)
+    jobs.append(figure_job(draw_boxplot_mag, os.path.join(args.out_dir, "boxplot_magnitude_mean_auth_vs_resolver.png"),
+                           [tables[0]["summary"], tables[1]["summary"]], dpi=160, period_str=period_str))
 
     # ヒートマップ（共通サブドメインの上位N）
-    save_heatmap_mag(results[0]["msum"], results[1]["msum"], args.topn, period_str=period_str, out_dir=args.out_dir)
+    jobs.append(figure_job(draw_heatmap_mag, os.path.join(args.out_dir, f"heatmap_magnitude_top{args.topn}.png"),
+                           [tables[0]["summary"], tables[1]["summary"]], dpi=160, topn=args.topn, period_str=period_str))
+
+    render_all(jobs, workers=args.workers, force=args.force)
 
     print("完了：図と相関テキストを保存しました ->", os.path.abspath(args.out_dir))
 
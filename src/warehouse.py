@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+分析結果の単一ファイル・ウェアハウス（SQLite）
+
+output / output-2025 / output-time / network_analysis / qtype などに日ごと・範囲ごとに
+散らばっていた結果 CSV を、1 つの SQLite ファイルの 1 テーブルに追記する。
+各 writer（func.write_magnitude_csv, write_network_magnitude_csv, 2025/func.write_csv,
+new-tshark-mag.py, 2025/query-count.py, magnitude-ave-distr.py,
+2025/magnitude-time-statistics.py, 2025/count-ave-distr.py など）は CSV を書くのと同時にここへ追記する。
+
+テーブル results（1 行 = 1 つの値）:
+    metric        TEXT     magnitude / count / qtype / vlan_magnitude / vlan_count / magnitude_prefix / magnitude_ci /
+                           split_count, split_qtype, split_rcode, split_magnitude（run_analysis_v2.py split の結果）/
+                           qtype_ratio（日全体、subdomain は ''）/ magnitude_stats, count_stats（期間の統計量、key に統計量名）など
+    where_        INTEGER  0=権威, 1=リゾルバ, -1=不明
+    date          TEXT     YYYY-MM-DD（期間の集計は開始日、期間は time_range に入れる）
+    time_range    TEXT     時間範囲（'00-23' など、日次は ''）
+    network_type  TEXT     internal / external / other / vlan-<id> など（無ければ ''）
+    packet_type   TEXT     query / response / response_error（無ければ ''）
+    subdomain     TEXT
+    key           TEXT     qtype や rcode など値の内訳（無ければ ''）
+    value         REAL
+  (metric, where_, date, time_range, network_type, packet_type, subdomain, key) は一意で、
+  同じ日を再計算したときは (metric, where_, date, time_range, network_type, packet_type) の単位で置き換わる。(where_, date, time_range, network_type, subdomain) に索引。
+
+環境変数:
+    DNSMAG_WAREHOUSE  … DB ファイルのパス（デフォルト: /home/shimada/analysis/warehouse.sqlite、空文字で追記しない）
+    DNSMAG_WRITE_CSV  … 0 にすると writer は CSV を書かずウェアハウスにだけ追記する
+
+CSV はウェアハウスからの書き出し（ビュー）として作れる:
+    python3 warehouse.py export --metric magnitude -w 1 --start-date 2025-04-01 --end-date 2025-04-30 -o mag.csv
+既存の日次 CSV の取り込み:
+    python3 warehouse.py import --metric magnitude -w 1 --dir /home/shimada/analysis/output \
+        --start-date 2025-04-01 --end-date 2025-06-30
+"""
+
+import os
+import sqlite3
+import argparse
+from contextlib import closing
+
+import pandas as pd
+
+DEFAULT_PATH = "/home/shimada/analysis/warehouse.sqlite"
+
+# このプロセスで追記に失敗した回数（memo.run_cached が失敗した計算をキャッシュしないために見る）
+_failures = 0
+
+DIMENSIONS = ["metric", "where_", "date", "time_range", "network_type", "packet_type", "subdomain", "key"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    metric       TEXT    NOT NULL,
+    where_       INTEGER NOT NULL DEFAULT -1,
+    date         TEXT    NOT NULL,
+    time_range   TEXT    NOT NULL DEFAULT '',
+    network_type TEXT    NOT NULL DEFAULT '',
+    packet_type  TEXT    NOT NULL DEFAULT '',
+    subdomain    TEXT    NOT NULL,
+    key          TEXT    NOT NULL DEFAULT '',
+    value        REAL,
+    PRIMARY KEY (metric, where_, date, time_range, network_type, packet_type, subdomain, key)
+);
+CREATE INDEX IF NOT EXISTS idx_results_lookup
+    ON results (where_, date, time_range, network_type, subdomain);
+"""
+
+def warehouse_path():
+    """DB ファイルのパス（DNSMAG_WAREHOUSE が空文字なら None = 追記しない）"""
+    path = os.environ.get("DNSMAG_WAREHOUSE", DEFAULT_PATH)
+    return path or None
+
+
+def failure_count():
+    """このプロセスでウェアハウスへの追記に失敗した回数"""
+    return _failures
+
+
+def csv_enabled():
+    """writer が CSV も書くかどうか（DNSMAG_WRITE_CSV=0 で無効）"""
+    return os.environ.get("DNSMAG_WRITE_CSV", "1") != "0"
+
+
+def connect(path=None):
+    path = path or warehouse_path()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=60)
+    # 複数の集計プロセスから同時に追記できるよう WAL にする
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def append(metric, rows, where=-1, date="", time_range="", network_type="", packet_type="", path=None):
+    """
+    結果を追記する。
+    (metric, where, date, time_range, network_type, packet_type) のスライスは rows で置き換える
+    （再計算で消えたサブドメインの古い行も残さない。rows が空ならスライスを消すだけ）。
+    rows: [(subdomain, value), ...] または [(subdomain, key, value), ...]
+    ウェアハウスが無効・書き込み失敗時は警告だけ出して処理を続ける。
+    """
+    global _failures
+    path = path or warehouse_path()
+    if path is None:
+        return 0
+    where = int(where) if where is not None else -1
+    slice_key = (metric, where, date, time_range or "", network_type or "", packet_type or "")
+    records = []
+    for row in rows:
+        subdomain, key, value = row if len(row) == 3 else (row[0], "", row[1])
+        records.append(slice_key + (str(subdomain), str(key), None if value is None else float(value)))
+    try:
+        with closing(connect(path)) as conn, conn:
+            conn.execute(f"DELETE FROM results WHERE {' AND '.join(f'{c} = ?' for c in DIMENSIONS[:6])}", slice_key)
+            conn.executemany(f"INSERT OR REPLACE INTO results ({', '.join(DIMENSIONS)}, value) "
+                             f"VALUES ({', '.join('?' * (len(DIMENSIONS) + 1))})", records)
+    except (sqlite3.Error, OSError) as e:
+        print(f"[WARN] ウェアハウスへの追記に失敗しました: {path}: {e}")
+        _failures += 1
+        return 0
+    return len(records)
+
+
+def query(metric, where=None, start_date=None, end_date=None, time_range=None,
+          network_type=None, packet_type=None, subdomain=None, path=None):
+    """条件に合う行を DataFrame で返す（None の条件は指定なし）"""
+    conds, params = ["metric = ?"], [metric]
+    for col, val in (("where_", where), ("time_range", time_range), ("network_type", network_type),
+                     ("packet_type", packet_type), ("subdomain", subdomain)):
+        if val is not None:
+            conds.append(f"{col} = ?")
+            params.append(val)
+    if start_date:
+        conds.append("date >= ?")
+        params.append(start_date)
+    if end_date:
+        conds.append("date <= ?")
+        params.append(end_date)
+    sql = f"SELECT {', '.join(DIMENSIONS)}, value FROM results WHERE {' AND '.join(conds)} ORDER BY date, subdomain, key"
+    with closing(connect(path)) as conn:
+        return pd.read_sql_query(sql, conn, params=params)
+
+
+def read_daily_magnitude_for_range(where, start_date, end_date, path=None):
+    """visual.read_daily_magnitude_for_range と同じ列 ['date','subdomain','magnitude'] を 1 回の問い合わせで返す"""
+    df = query("magnitude", where, start_date, end_date, time_range="", network_type="",
+               packet_type="", path=path)
+    return df.rename(columns={"value": "magnitude"})[["date", "subdomain", "magnitude"]]
+
+
+def read_daily_counts_for_range(where, start_date, end_date, packet_type="query", path=None):
+    """
+    visual.read_daily_counts_for_range と同じ列 ['date','subdomain','count'] を 1 回の問い合わせで返す。
+    packet_type は 2025/func.write_csv・multi_analysis.py と同じく query がデフォルト（import も query で取り込む）
+    """
+    df = query("count", where, start_date, end_date, time_range="", network_type="",
+               packet_type=packet_type, path=path)
+    return df.rename(columns={"value": "count"})[["date", "subdomain", "count"]]
+
+# ==== CLI ====
+
+def export_csv(args):
+    df = query(args.metric, args.w, args.start_date, args.end_date, args.time_range,
+               args.network_type, args.packet_type, path=args.db)
+    # 値が入っていない次元は列ごと落とす
+    keep = [c for c in DIMENSIONS if c in ("date", "subdomain") or (df[c].astype(str) != "").any()]
+    df = df[keep + ["value"]].rename(columns={"where_": "where"})
+    if args.output:
+        df.to_csv(args.output, index=False)
+        print(f"[DONE] {len(df)}行 -> {args.output}")
+    else:
+        print(df.to_csv(index=False), end="")
+
+
+def import_csv(args):
+    """既存の日次 CSV（magnitude: {where}-YYYY-MM-DD.csv, count: count-{where}-YYYY-MM-DD.csv）を取り込む"""
+    import visual
+
+    if args.metric == "magnitude":
+        df = visual.read_daily_magnitude_for_range(args.dir, args.w, args.start_date, args.end_date)
+        value_col = "magnitude"
+    elif args.metric == "count":
+        df = visual.read_daily_counts_for_range(args.dir, args.w, args.start_date, args.end_date)
+        value_col = "count"
+    else:
+        raise SystemExit(f"取り込みに対応していない metric です: {args.metric}")
+
+    # クエリ数は日次の writer と同じ packet_type で取り込む（マグニチュードは packet_type なし）
+    packet_type = args.packet_type if args.metric == "count" else ""
+    total = 0
+    for date, g in df.groupby("date"):
+        total += append(args.metric, g[["subdomain", value_col]].itertuples(index=False, name=None),
+                        where=args.w, date=str(date), packet_type=packet_type, path=args.db)
+    print(f"[DONE] {total}行を取り込みました ({args.metric}, where={args.w})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="分析結果ウェアハウス（SQLite）の書き出し・取り込み")
+    parser.add_argument("--db", default=None, help=f"DB ファイル（デフォルト: $DNSMAG_WAREHOUSE または {DEFAULT_PATH}）")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("export", help="条件に合う結果を CSV に書き出す")
+    p.add_argument("--metric", required=True)
+    p.add_argument("-w", type=int, default=None, help="0=権威, 1=リゾルバ")
+    p.add_argument("--start-date")
+    p.add_argument("--end-date")
+    p.add_argument("--time-range")
+    p.add_argument("--network-type")
+    p.add_argument("--packet-type")
+    p.add_argument("-o", "--output", help="出力 CSV（省略時は標準出力）")
+    p.set_defaults(func=export_csv)
+
+    p = sub.add_parser("import", help="既存の日次 CSV を取り込む")
+    p.add_argument("--metric", required=True, choices=["magnitude", "count"])
+    p.add_argument("-w", type=int, required=True, choices=[0, 1])
+    p.add_argument("--dir", required=True, help="日次 CSV のディレクトリ")
+    p.add_argument("--start-date", required=True)
+    p.add_argument("--end-date", required=True)
+    p.add_argument("--packet-type", default="query", help="count の取り込み先の packet_type（デフォルト: query）")
+    p.set_defaults(func=import_csv)
+
+    args = parser.parse_args()
+    args.func(args)
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
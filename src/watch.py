@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+dnscap のダンプディレクトリを監視し、新しいダンプを取り込む
+
+書き終わったダンプ（dump-YYYYMMDDHHMM.gz）が現れるたびに
+  1. extract.py と同じフィルタで時間ごとの CSV を抽出する（既定は all: 1 回の解析で 3 つの出力）
+  2. 権威・リゾルバの CSV から rollup の時間・日・週・月の集計を更新する（変わった分だけ作り直す）
+  3. JST で 23 時のダンプを取り込んだら（または翌日以降のダンプが来たら）その日を締め、
+     日の集計から日次の magnitude / count / qtype を書き出し、anomaly_stream の EWMA 状態を更新する
+ので、日次のマグニチュードは日付が変わって 23 時台のダンプが書き終わった数分後には揃う。
+締めた後にその日のダンプを取り込んだ場合（取り込み失敗の再試行が遅れて成功した、ダンプが遅れて届いたなど）は、
+その日を締め直して日次の結果を書き直す（anomaly_stream の状態は同じ日を二度は更新しない）。
+
+書き終わりの判定:
+  - inotify_simple が入っていれば IN_CLOSE_WRITE / IN_MOVED_TO のイベントで検知する
+  - 入っていない場合や --poll（NAS のマウントではイベントが届かない）では --interval 秒ごとに一覧を取り、
+    サイズが前回と同じで、更新から --settle 秒以上たったものを書き終わったとみなす
+  - inotify でも --interval ごとに一覧を取り直す（取りこぼし対策）
+
+取り込んだダンプ（名前・サイズ・更新時刻）と締めた日は {state-dir}/watch-dumps.csv, watch-days.csv に
+一時ファイル + os.replace で記録し、再起動しても同じダンプを二度処理しない。
+
+実行例:
+    python3 watch.py
+    python3 watch.py --profile resolver --poll --interval 60
+"""
+
+import os
+import glob
+import time
+import argparse
+
+import pandas as pd
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+import anomaly_stream
+from extract import DUMP_DIR, PROFILES, dump_time, output_name, parse_jst, run_extract
+from multi_analysis import write_magnitude, write_count, write_qtype
+from rollup import ROLLUP_DIR, build, partition_path, load_aggregate, magnitude_frame
+
+STATE_DIR = "/home/shimada/analysis/watch"
+ANOMALY_DIR = "/home/shimada/analysis/anomaly"
+# 集計する出力（query-response は rollup の入力形式ではないので抽出だけ）
+PROFILE_WHERE = {"auth": 0, "resolver": 1}
+
+# ==== 取り込みの記録 ====
+
+def load_records(path, columns):
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=columns)
+    return pd.read_csv(path, dtype=str)
+
+
+def save_records(path, df):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + ".tmp"
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def dump_stamp(path):
+    st = os.stat(path)
+    return os.path.basename(path), str(st.st_size), str(st.st_mtime_ns)
+
+# ==== 書き終わったダンプの検出 ====
+
+def finished_dumps(dump_dir, done, sizes, settle, closed_names=()):
+    """
+    まだ取り込んでいない、書き終わったダンプを時刻順に返す。
+    closed_names（inotify で書き終わりのイベントが来た名前）はすぐに書き終わりとみなす。
+    それ以外は、sizes（前回見たサイズ、呼び出し側で保持）と同じサイズで settle 秒以上更新されていなければ書き終わりとみなす。
+    sizes が None のときは更新時刻だけで判定する（--once）。
+    """
+    ready = []
+    now = time.time()
+    for path in sorted(glob.glob(os.path.join(dump_dir, "dump-*.gz"))):
+        name = os.path.basename(path)
+        if name in done or dump_time(path) is None:
+            continue
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        stable = sizes is None or sizes.get(name) == st.st_size
+        if name in closed_names or (stable and now - st.st_mtime >= settle):
+            ready.append(path)
+        if sizes is not None:
+            sizes[name] = st.st_size
+    return ready
+
+
+def wait_for_changes(notifier, interval):
+    """inotify のイベントか interval 秒のどちらか早い方まで待ち、書き終わったファイルの名前を返す"""
+    if notifier is None:
+        time.sleep(interval)
+        return set()
+    return {event.name for event in notifier.read(timeout=int(interval * 1000))}
+
+# ==== 取り込み ====
+
+def ingest(dump, output_dirs, tshark, rollup_dir):
+    """1 つのダンプを抽出し、rollup の集計を更新する。戻り値: ダンプの JST の日付と時"""
+    t = dump_time(dump)
+    name = output_name(t)
+    outputs = {n: os.path.join(d, name) for n, d in output_dirs.items()}
+    t0 = time.time()
+    rows = run_extract(dump, outputs, tshark)
+    print(f"{os.path.basename(dump)}: " + ", ".join(f"{n} {rows[n]:,}行" for n in outputs)
+          + f" ({time.time() - t0:.1f}秒)")
+    date_str, hour = name[:10], int(name[11:13])
+    for n, where in PROFILE_WHERE.items():
+        if n in output_dirs:
+            build(where, date_str, date_str, output_dirs[n], rollup_dir)
+    return date_str, hour
+
+
+def close_day(date_str, output_dirs, rollup_dir, anomaly_dir, update_anomaly=True):
+    """日の集計から日次の結果を書き出し、異常検知の状態を更新する（締め直しでは update_anomaly=False）"""
+    for n, where in PROFILE_WHERE.items():
+        if n not in output_dirs:
+            continue
+        day_path = partition_path(rollup_dir, where, "day", date_str)
+        if not os.path.exists(day_path):
+            continue
+        agg = load_aggregate(day_path)
+        if not len(agg["subdomains"]):
+            continue
+        write_magnitude(agg, where, date_str)
+        write_count(agg, where, date_str, "response")
+        write_qtype(agg, where, date_str, "response")
+        if not update_anomaly:
+            continue
+        mag = magnitude_frame(agg).dropna(subset=["dnsmagnitude"])
+        values = {
+            "magnitude": anomaly_stream.period_values(mag["subdomain"], mag["dnsmagnitude"], "magnitude"),
+            "count": anomaly_stream.period_values(agg["subdomains"], agg["counts"], "count"),
+        }
+        anomaly_stream.update_period(anomaly_dir, where, date_str, values)
+    print(f"[DONE] {date_str} を{'締めました' if update_anomaly else '締め直しました'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="dnscap のダンプディレクトリを監視し、新しいダンプを取り込む")
+    parser.add_argument("--profile", choices=sorted(PROFILES) + ["all"], default="all", help="抽出するプロファイル（デフォルト: all）")
+    parser.add_argument("--dump-dir", default=DUMP_DIR, help=f"監視するディレクトリ（デフォルト: {DUMP_DIR}）")
+    parser.add_argument("--output-dir", help="抽出の出力先（省略時はプロファイルの出力先。all のときはその下にプロファイル名のディレクトリ）")
+    parser.add_argument("--state-dir", default=STATE_DIR, help=f"取り込みの記録（デフォルト: {STATE_DIR}）")
+    parser.add_argument("--rollup-dir", default=ROLLUP_DIR, help=f"rollup の保存先（デフォルト: {ROLLUP_DIR}）")
+    parser.add_argument("--anomaly-dir", default=ANOMALY_DIR, help=f"異常検知の状態（デフォルト: {ANOMALY_DIR}）")
+    parser.add_argument("--since", help="これより前のダンプは取り込まない（YYYYMMDDHHMM, JST）")
+    parser.add_argument("--interval", type=float, default=30, help="一覧を取り直す間隔（秒）")
+    parser.add_argument("--settle", type=float, default=60, help="更新からこの秒数たったら書き終わりとみなす（ポーリング時）")
+    parser.add_argument("--poll", action="store_true", help="inotify を使わずポーリングする（NAS のマウントなど）")
+    parser.add_argument("--once", action="store_true", help="いまある書き終わったダンプを取り込んで終了する")
+    parser.add_argument("--tshark", default="tshark", help="tshark のパス")
+    args = parser.parse_args()
+
+    names = sorted(PROFILES) if args.profile == "all" else [args.profile]
+    if args.output_dir is None:
+        output_dirs = {n: PROFILES[n]["output_dir"] for n in names}
+    elif len(names) == 1:
+        output_dirs = {names[0]: args.output_dir}
+    else:
+        output_dirs = {n: os.path.join(args.output_dir, n) for n in names}
+    for d in output_dirs.values():
+        os.makedirs(d, exist_ok=True)
+
+    dumps_path = os.path.join(args.state_dir, "watch-dumps.csv")
+    days_path = os.path.join(args.state_dir, "watch-days.csv")
+    dumps = load_records(dumps_path, ["dump", "size", "mtime_ns"])
+    days = load_records(days_path, ["date"])
+    done = set(dumps["dump"])
+    closed = set(days["date"])
+    since = parse_jst(args.since) if args.since else None
+    # 取り込み済みでまだ締めていない日（前回の実行の途中の日）
+    open_days = {output_name(dump_time(name))[:10] for name in done} - closed
+
+    notifier = None
+    if not args.poll and INotify is not None:
+        notifier = INotify()
+        notifier.add_watch(args.dump_dir, inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO)
+        print(f"inotify で監視します: {args.dump_dir}")
+    else:
+        print(f"{args.interval:.0f}秒ごとのポーリングで監視します: {args.dump_dir}")
+
+    sizes = None if args.once else {}
+    closed_names = set()
+    while True:
+        for dump in finished_dumps(args.dump_dir, done, sizes, args.settle, closed_names):
+            if since is not None and dump_time(dump) < since:
+                continue
+            try:
+                date_str, hour = ingest(dump, output_dirs, args.tshark, args.rollup_dir)
+            except Exception as e:
+                print(f"[WARN] 取り込み失敗（次の一覧で再試行）: {os.path.basename(dump)}: {e}")
+                if sizes is not None:
+                    sizes.pop(os.path.basename(dump), None)
+                continue
+            done.add(os.path.basename(dump))
+            dumps.loc[len(dumps)] = dump_stamp(dump)
+            save_records(dumps_path, dumps)
+
+            # 締めた後に取り込んだダンプの日は、日次の結果を書き直す
+            if date_str in closed:
+                close_day(date_str, output_dirs, args.rollup_dir, args.anomaly_dir, update_anomaly=False)
+                continue
+
+            # 23 時まで取り込んだ日と、それより後の日のダンプが来た日を締める
+            open_days.add(date_str)
+            to_close = {d for d in open_days if d < date_str}
+            if hour == 23:
+                to_close.add(date_str)
+            for d in sorted(to_close - closed):
+                close_day(d, output_dirs, args.rollup_dir, args.anomaly_dir)
+                closed.add(d)
+                days.loc[len(days)] = [d]
+                save_records(days_path, days)
+            open_days -= to_close
+
+        if args.once:
+            return 0
+        closed_names = wait_for_changes(notifier, args.interval)
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+共有ディレクトリ（/mnt/qnap2）上の SQLite キューによる複数ホストでの分散実行
+
+/mnt/qnap2 をマウントしているどのホストからでもワーカーを起動でき、(where, 日, 時) のタスクを取り合って処理する。
+  - enqueue: 期間の時間ごとのファイルをタスクとして登録する（登録済みのものはそのまま）
+  - work:    タスクを 1 つずつ取り（リース）、その時間の rollup の集計（部分集計）を {rollup-dir}/where={w}/hour/ に書く。
+             処理中は一定間隔でリースを延長し、リースの切れたタスク（落ちたワーカーのもの）は他のワーカーが取り直す。
+             失敗したタスクは --max-attempts 回まで再試行し、それを超えたら failed にする
+  - reduce:  全部の時間が終わった (where, 日) について、rollup.build で時間の集計から日・週・月の集計をまとめ、
+             日次の magnitude / count / qtype を書き出す（multi_analysis.py と同じ出力）
+  - status:  状態ごとの件数と failed のタスクを表示する
+
+キューは {queue-dir}/queue.sqlite。ネットワークファイルシステムでは WAL（共有メモリ）が使えないため、
+ジャーナルは DELETE のまま、タスクの取得は BEGIN IMMEDIATE（書き込みロック）で行う。
+部分集計は rollup.save_aggregate で一時ファイルから置き換えるので、途中で落ちても壊れたファイルは残らない。
+
+1 台で確認するときは --workers でワーカープロセスを複数起動する。
+
+実行例:
+    python3 workqueue.py enqueue -w 0 1 --start-date 2025-04-01 --end-date 2025-04-30
+    python3 workqueue.py work --workers 8          # 各ホストで実行
+    python3 workqueue.py reduce -w 0 1 --start-date 2025-04-01 --end-date 2025-04-30
+    python3 workqueue.py status
+"""
+
+import os
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+import multiprocessing
+from contextlib import closing
+
+import pandas as pd
+
+from magnitude_engine import hourly_files, load_columns
+from multi_analysis import write_magnitude, write_count, write_qtype
+from rollup import COLUMNS, aggregate_frame, build, partition_path, refresh, load_aggregate
+
+QUEUE_DIR = "/mnt/qnap2/shimada/queue"
+LEASE_SECONDS = 600
+MAX_ATTEMPTS = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    "where"     INTEGER NOT NULL,
+    date        TEXT NOT NULL,
+    hour        INTEGER NOT NULL,
+    path        TEXT NOT NULL,
+    status      TEXT NOT NULL DEFAULT 'pending',
+    worker      TEXT,
+    lease_until REAL,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    error       TEXT,
+    updated     REAL,
+    PRIMARY KEY ("where", date, hour)
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status, date);
+"""
+
+
+def connect(queue_dir):
+    os.makedirs(queue_dir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(queue_dir, "queue.sqlite"), timeout=120, isolation_level=None)
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+# ==== キューの操作 ====
+
+def enqueue(conn, wheres, start_date, end_date, input_dir=None):
+    """期間の時間ごとのファイルを pending で登録する。戻り値: 新しく登録した数"""
+    rows = []
+    for date in pd.date_range(start_date, end_date):
+        date_str = date.strftime("%Y-%m-%d")
+        for where in wheres:
+            for path in hourly_files(*date_str.split("-"), where, input_dir):
+                rows.append((where, date_str, int(os.path.basename(path)[11:13]), os.path.abspath(path)))
+    before = conn.total_changes
+    conn.execute("BEGIN IMMEDIATE")
+    conn.executemany('INSERT OR IGNORE INTO tasks ("where", date, hour, path, updated) VALUES (?, ?, ?, ?, ?)',
+                     [r + (time.time(),) for r in rows])
+    conn.execute("COMMIT")
+    return conn.total_changes - before
+
+
+def claim(conn, worker, lease, max_attempts):
+    """
+    pending のタスク、またはリースの切れた running のタスクを 1 つ取る（新しい日から）。
+    取れなければ None。
+    最後の試行中にワーカーが落ちて（リースが切れて）試行回数を使い切ったタスクは、ここで failed にする。
+    """
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("UPDATE tasks SET status = 'failed', error = 'lease expired', updated = ? "
+                     "WHERE status = 'running' AND lease_until < ? AND attempts >= ?", (now, now, max_attempts))
+        row = conn.execute(
+            'SELECT "where", date, hour, path, attempts FROM tasks '
+            "WHERE (status = 'pending' OR (status = 'running' AND lease_until < ?)) AND attempts < ? "
+            "ORDER BY date DESC, hour LIMIT 1", (now, max_attempts)).fetchone()
+        if row is not None:
+            conn.execute('UPDATE tasks SET status = \'running\', worker = ?, lease_until = ?, attempts = attempts + 1, '
+                         'updated = ? WHERE "where" = ? AND date = ? AND hour = ?',
+                         (worker, now + lease, now, row[0], row[1], row[2]))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return row
+
+
+def _own(sql, params):
+    # 自分がリースを持っている間だけ更新する（リースが切れて他のワーカーが取ったタスクには書かない）
+    return sql + ' WHERE "where" = ? AND date = ? AND hour = ? AND worker = ? AND status = \'running\'', params
+
+
+def renew(conn, task, worker, lease):
+    sql, params = _own("UPDATE tasks SET lease_until = ?", (time.time() + lease,) + tuple(task[:3]) + (worker,))
+    return conn.execute(sql, params).rowcount == 1
+
+
+def finish(conn, task, worker, error=None, max_attempts=MAX_ATTEMPTS):
+    """成功なら done、失敗なら再試行できる回数が残っていれば pending、残っていなければ failed にする"""
+    if error is None:
+        status = "done"
+    else:
+        status = "pending" if task[4] + 1 < max_attempts else "failed"
+    sql, params = _own("UPDATE tasks SET status = ?, error = ?, lease_until = NULL, updated = ?",
+                       (status, error, time.time()) + tuple(task[:3]) + (worker,))
+    conn.execute(sql, params)
+    return status
+
+# ==== ワーカー ====
+
+def run_hour(task, rollup_dir):
+    """1 時間分の部分集計を rollup の hour パーティションに書く（入力が変わっていなければ作り直さない）"""
+    where, date_str, hour, path = task[:4]
+    name = f"{date_str}-{hour:02d}"
+    refresh(partition_path(rollup_dir, where, "hour", name), [path],
+            lambda p: aggregate_frame(load_columns(p, COLUMNS)))
+
+
+def _keep_lease(queue_dir, task, worker, lease, stop):
+    with closing(connect(queue_dir)) as conn:
+        while not stop.wait(lease / 3):
+            try:
+                if not renew(conn, task, worker, lease):
+                    print(f"[WARN] リースを失いました: {task[:3]}")
+                    return
+            except sqlite3.Error as e:
+                print(f"[WARN] リースを延長できません: {e}")
+
+
+def work(queue_dir, rollup_dir, lease=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS, idle_exit=True, poll=10):
+    """タスクが無くなるまで（idle_exit=False なら待ち続けて）処理する。戻り値: 処理した数"""
+    worker = worker_id()
+    n = 0
+    with closing(connect(queue_dir)) as conn:
+        while True:
+            task = claim(conn, worker, lease, max_attempts)
+            if task is None:
+                if idle_exit:
+                    return n
+                time.sleep(poll)
+                continue
+            stop = threading.Event()
+            keeper = threading.Thread(target=_keep_lease, args=(queue_dir, task, worker, lease, stop), daemon=True)
+            keeper.start()
+            t0 = time.time()
+            error = None
+            try:
+                run_hour(task, rollup_dir)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            finally:
+                stop.set()
+                keeper.join()
+            status = finish(conn, task, worker, error, max_attempts)
+            n += 1
+            print(f"[{worker}] where={task[0]} {task[1]} {task[2]:02d}時: {status} ({time.time() - t0:.1f}秒)"
+                  + (f" {error}" if error else ""))
+
+
+def _work_process(queue_dir, rollup_dir, lease, max_attempts, idle_exit):
+    work(queue_dir, rollup_dir, lease, max_attempts, idle_exit)
+
+# ==== リデューサー ====
+
+def reduce_days(conn, wheres, start_date, end_date, input_dir, rollup_dir):
+    """全部の時間が done の (where, 日) について、日・週・月の集計を作り、日次の結果を書き出す"""
+    rows = conn.execute(
+        'SELECT "where", date, SUM(status = \'done\'), COUNT(*) FROM tasks '
+        'WHERE date BETWEEN ? AND ? GROUP BY "where", date ORDER BY "where", date',
+        (start_date, end_date)).fetchall()
+    reduced = 0
+    for where, date_str, done, total in rows:
+        if where not in wheres:
+            continue
+        if done < total:
+            print(f"[WARN] 未完了のため飛ばします: where={where} {date_str} ({done}/{total})")
+            continue
+        build(where, date_str, date_str, input_dir, rollup_dir)
+        agg = load_aggregate(partition_path(rollup_dir, where, "day", date_str))
+        write_magnitude(agg, where, date_str)
+        write_count(agg, where, date_str, "response")
+        write_qtype(agg, where, date_str, "response")
+        reduced += 1
+    return reduced
+
+
+def main():
+    parser = argparse.ArgumentParser(description="共有ディレクトリ上の SQLite キューによる分散実行")
+    parser.add_argument("--queue-dir", default=QUEUE_DIR, help=f"キューの場所（全ホストから見える場所、デフォルト: {QUEUE_DIR}）")
+    parser.add_argument("--rollup-dir", help="部分集計の保存先（デフォルト: {queue-dir}/rollup）")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    for name, help_text in (("enqueue", "期間の時間ごとのタスクを登録する"), ("reduce", "部分集計をまとめて日次の結果を書き出す")):
+        p = sub.add_parser(name, help=help_text)
+        p.add_argument("-w", type=int, nargs="+", choices=[0, 1], required=True, help="0は権威1はリゾルバ（複数指定可）")
+        p.add_argument("--start-date", required=True)
+        p.add_argument("--end-date", required=True)
+        p.add_argument("--input-dir", help="入力ディレクトリ（省略時は where から決定）")
+
+    p = sub.add_parser("work", help="タスクを取って処理する（各ホストで実行）")
+    p.add_argument("--workers", type=int, default=1, help="このホストで起動するワーカープロセス数")
+    p.add_argument("--lease", type=float, default=LEASE_SECONDS, help="リースの秒数（この間に延長されなければ他のワーカーが取り直す）")
+    p.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS, help="1 タスクの最大試行回数")
+    p.add_argument("--wait", action="store_true", help="タスクが無くなっても終了せず、新しいタスクを待つ")
+
+    p = sub.add_parser("status", help="状態ごとの件数を表示する")
+    p.add_argument("--retry-failed", action="store_true", help="failed のタスクとリースの切れた running のタスクを pending に戻す")
+    args = parser.parse_args()
+
+    rollup_dir = args.rollup_dir or os.path.join(args.queue_dir, "rollup")
+    if args.command == "work":
+        if args.workers == 1:
+            n = work(args.queue_dir, rollup_dir, args.lease, args.max_attempts, not args.wait)
+            print(f"[DONE] {n}件処理しました")
+            return 0
+        procs = [multiprocessing.Process(target=_work_process,
+                                         args=(args.queue_dir, rollup_dir, args.lease, args.max_attempts, not args.wait))
+                 for _ in range(args.workers)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+        print(f"[DONE] ワーカー {args.workers}個が終了しました")
+        return 0 if all(proc.exitcode == 0 for proc in procs) else 1
+
+    with closing(connect(args.queue_dir)) as conn:
+        if args.command == "enqueue":
+            n = enqueue(conn, args.w, args.start_date, args.end_date, args.input_dir)
+            print(f"[DONE] {n}件登録しました")
+        elif args.command == "reduce":
+            n = reduce_days(conn, args.w, args.start_date, args.end_date, args.input_dir, rollup_dir)
+            print(f"[DONE] {n}日分をまとめました")
+        else:
+            if args.retry_failed:
+                n = conn.execute("UPDATE tasks SET status = 'pending', attempts = 0, lease_until = NULL "
+                                 "WHERE status = 'failed' OR (status = 'running' AND lease_until < ?)",
+                                 (time.time(),)).rowcount
+                print(f"{n}件を pending に戻しました")
+            for status, count in conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status ORDER BY status"):
+                print(f"{status}\t{count}")
+            for where, date, hour, worker, error in conn.execute(
+                    'SELECT "where", date, hour, worker, error FROM tasks WHERE status = \'failed\' ORDER BY date, hour'):
+                print(f"[WARN] failed: where={where} {date} {hour:02d}時 ({worker}): {error}")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())